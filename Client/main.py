@@ -10,10 +10,11 @@ import cgi
 import time
 import datetime
 import re
+from bisect import bisect_left
 
 from PyQt5.QtCore import pyqtSlot, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QMainWindow, QDialog, QMessageBox, QWidget, QFormLayout, QScrollArea, QTableWidgetItem
-from PyQt5.QtGui import QColor
+from PyQt5.QtGui import QColor, QTextCursor
 from PyQt5.uic import loadUi
 
 # Load classes and functions from shared libs
@@ -29,14 +30,23 @@ from configManager import *
 _app = None
 _mainGui = None
 _serverSocket = None
+_serverStream = None
 _username = ""
 _userId = None
 _admin = False
+_oldestMessageId = None # The id of the oldest message from the server being displayed
+_moreHistory = False # Whether the server has older messages to send
+_historyRequested = False # Whether a page of history is on its way
+_onlineUsers = [] # Usernames of online users, sorted
+_presenceSequence = None # The sequence number of the last presence change applied to _onlineUsers, or None until the server has sent the full list
+_packetHandlers = Dispatcher() # Packet type to handler function
+_commandResponseHandlers = Dispatcher() # Command name to the handler for its response
 
 NONPRINTINGCHAR = '\u200B' # Used to replace a character in a string whilst keeping indexes the same
 MAXTRANSMISSIONSIZE = None
 COMMANDCHAR = None
 DEBUG = None
+HISTORYPAGESIZE = None
 
 
 # Classes
@@ -58,7 +68,11 @@ class MainWindow(QMainWindow):
 
   Properties:
     writeSignal (QSignal): Signal to trigger message creation.
-    usersChangedSignal (QSignal): Signal to update online users.
+    usersChangedSignal (QSignal): Signal to replace the list of online users.
+    userJoinedSignal (QSignal): Signal to add one user to the list of online users.
+    userLeftSignal (QSignal): Signal to remove one user from the list of online users.
+    historySignal (QSignal): Signal to display a page of older messages above the current ones.
+    scrollAnchor (int): Distance from the bottom of the messages to keep the view at while older messages are added, or None to follow new messages.
 
   ToDo:
     Seperate this class out!
@@ -67,8 +81,11 @@ class MainWindow(QMainWindow):
   # Signals for updating the GUI
   writeSignal = pyqtSignal(Message)
   usersChangedSignal = pyqtSignal(list)
+  userJoinedSignal = pyqtSignal(int, str, int)
+  userLeftSignal = pyqtSignal(int, int)
   updateMessageSignal = pyqtSignal(int, str, bool)
   deleteMessageSignal = pyqtSignal(int)
+  historySignal = pyqtSignal(list)
 
   def __init__(self, *args):
     """ Initialises the UI and connects all signals and button clicks. """
@@ -80,9 +97,14 @@ class MainWindow(QMainWindow):
       # Point the signals to the corresponding functions
       self.writeSignal.connect(self.WriteLine) 
       self.usersChangedSignal.connect(self.UpdateConnectedUsers)
+      self.userJoinedSignal.connect(self.InsertConnectedUser)
+      self.userLeftSignal.connect(self.RemoveConnectedUser)
       self.updateMessageSignal.connect(self.updateMessageContents)
       self.deleteMessageSignal.connect(self.deleteMessage)
+      self.historySignal.connect(self.WriteHistory)
+      self.scrollAnchor = None
       self.messageScrollArea.verticalScrollBar().rangeChanged.connect(self.ScrollLengthChanged)
+      self.messageScrollArea.verticalScrollBar().valueChanged.connect(self.ScrollValueChanged)
       self.messageWidget.setLayout(self.messageLayout)
         
     except Exception:
@@ -153,8 +175,37 @@ class MainWindow(QMainWindow):
     except Exception:
       reportError()
 
+  def WriteHistory(self, messages):
+    """
+    Displays a page of older messages above the current ones, without moving the messages being looked at.
+
+    Args:
+      messages (list of Message): The messages to display, oldest first.
+    """
+    try:
+      scrollBar = self.messageScrollArea.verticalScrollBar()
+      self.scrollAnchor = scrollBar.maximum() - scrollBar.value() # Restored in ScrollLengthChanged() once the layout has grown
+      for row, message in enumerate(messages):
+        newWidget = MessageWidget(message=message)
+        newWidget.updateText()
+        self.messageLayout.insertRow(row, newWidget)
+        newWidget.setFixedWidth(self.messageScrollArea.width() - 10)
+    except Exception:
+      reportError()
+
   def ScrollLengthChanged(self):
-    self.messageScrollArea.verticalScrollBar().setValue(self.messageScrollArea.verticalScrollBar().maximum())
+    scrollBar = self.messageScrollArea.verticalScrollBar()
+    if self.scrollAnchor != None: # Older messages were added above, so keep the same messages in view
+      scrollBar.setValue(scrollBar.maximum() - self.scrollAnchor)
+      self.scrollAnchor = None
+    else:
+      scrollBar.setValue(scrollBar.maximum())
+    if scrollBar.maximum() == 0: # Not enough messages to scroll yet, so fetch more until there are
+      RequestHistory()
+
+  def ScrollValueChanged(self, value):
+    if value == self.messageScrollArea.verticalScrollBar().minimum():
+      RequestHistory()
 
     
   def UpdateConnectedUsers(self, userList):
@@ -167,9 +218,50 @@ class MainWindow(QMainWindow):
     userCount = len(userList)
     self.userCountLabel.setText(f"Users Online: {userCount}")
     
-    self.userListBox.clear()
-    for user in userList:
-      self.userListBox.insertHtml(f"{user} <br>")
+    self.userListBox.setPlainText("\n".join(userList)) # One block per user, so users can be added and removed by position
+
+  def InsertConnectedUser(self, index, username, userCount):
+    """
+    Adds one user to the online users GUI elements, without rebuilding the list.
+
+    Args:
+      index (int): The position of the user in the sorted list.
+      username (string): The username to add.
+      userCount (int): The number of online users, including the new one.
+    """
+    self.userCountLabel.setText(f"Users Online: {userCount}")
+    document = self.userListBox.document()
+    if userCount == 1: # The document's only block is empty
+      QTextCursor(document).insertText(username)
+    elif index < userCount - 1: # Split the block currently at the position
+      cursor = QTextCursor(document.findBlockByNumber(index))
+      cursor.insertText(username)
+      cursor.insertBlock()
+    else:
+      cursor = QTextCursor(document)
+      cursor.movePosition(QTextCursor.End)
+      cursor.insertBlock()
+      cursor.insertText(username)
+
+  def RemoveConnectedUser(self, index, userCount):
+    """
+    Removes one user from the online users GUI elements, without rebuilding the list.
+
+    Args:
+      index (int): The position of the user in the sorted list.
+      userCount (int): The number of online users, not including the one removed.
+    """
+    self.userCountLabel.setText(f"Users Online: {userCount}")
+    block = self.userListBox.document().findBlockByNumber(index)
+    cursor = QTextCursor(block)
+    if block.next().isValid(): # Take the line break after the user with it
+      cursor.movePosition(QTextCursor.NextBlock, QTextCursor.KeepAnchor)
+    elif index > 0: # Last user; take the line break before it instead
+      cursor.movePosition(QTextCursor.PreviousCharacter)
+      cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+    else:
+      cursor.movePosition(QTextCursor.EndOfBlock, QTextCursor.KeepAnchor)
+    cursor.removeSelectedText()
 
 
   def onSendClick(self):
@@ -313,7 +405,7 @@ class MessageOptions(QDialog):
       errNotifier.exec_()
     else:
       reportPacket = ReportPacket(self.message.messageId, _userId, reason)
-      _serverSocket.send(encode(reportPacket))
+      _serverStream.sendPacket(reportPacket)
       successNotifier = QMessageBox()
       successNotifier.setIcon(QMessageBox.Information)
       successNotifier.setText("Successfully reported message.")
@@ -322,7 +414,7 @@ class MessageOptions(QDialog):
 
   def editMessageContents(self):
     editMessagePacket = EditMessagePacket(self.message.messageId, self.editMessage.text())
-    _serverSocket.send(encode(editMessagePacket))
+    _serverStream.sendPacket(editMessagePacket)
     successNotifier = QMessageBox()
     successNotifier.setIcon(QMessageBox.Information)
     successNotifier.setText("Successfully edited message.")
@@ -331,7 +423,7 @@ class MessageOptions(QDialog):
 
   def deleteMessage(self):
     deleteMessagePacket = DeleteMessagePacket(self.message.messageId)
-    _serverSocket.send(encode(deleteMessagePacket))
+    _serverStream.sendPacket(deleteMessagePacket)
     successNotifier = QMessageBox()
     successNotifier.setIcon(QMessageBox.Information)
     successNotifier.setText("Successfully deleted message.")
@@ -348,7 +440,7 @@ class AdminSettingsWindow(QDialog):
       self.userListComboBox.currentIndexChanged.connect(self.ComboBoxUpdated)
       self.toggleAdminStatusBtn.clicked.connect(self.toggleAdminStatus)
       requestUserListPacket = Packet("REQUESTUSERLIST")
-      _serverSocket.send(encode(requestUserListPacket))
+      _serverStream.sendPacket(requestUserListPacket)
       self.selectedUserAdmin = None
       self.selectedUserId = None
 
@@ -365,7 +457,7 @@ class AdminSettingsWindow(QDialog):
   def ComboBoxUpdated(self):
     """ Event for when a new user is selected from the combobox. Fetches information about that user. """
     requestUserInfoPacket = RequestUserInfoPacket(self.userListComboBox.currentText())
-    _serverSocket.send(encode(requestUserInfoPacket))
+    _serverStream.sendPacket(requestUserInfoPacket)
 
   def UpdateUserInfo(self, userId, messageCount, admin, flags):
     """
@@ -403,7 +495,7 @@ class AdminSettingsWindow(QDialog):
 
   def toggleAdminStatus(self):
     adminStatusPacket = SetAdminStatusPacket(not self.selectedUserAdmin, self.selectedUserId)
-    _serverSocket.send(encode(adminStatusPacket))
+    _serverStream.sendPacket(adminStatusPacket)
     self.ComboBoxUpdated()
 
 class LoginWindow(QDialog):
@@ -458,12 +550,12 @@ class LoginWindow(QDialog):
       password (string): Password to login with, not yet hashed.
     """
     try:
-      global _serverSocket, _username, _userId, _admin
+      global _serverStream, _username, _userId, _admin
       password = hashString(password)
       loginRequest = LoginRequestPacket(username, password)
-      _serverSocket.send(encode(loginRequest))
+      _serverStream.sendPacket(loginRequest)
 
-      loginResponsePacket = decode(_serverSocket.recv(MAXTRANSMISSIONSIZE))
+      loginResponsePacket = _serverStream.receivePacket()
 
       if loginResponsePacket.type != "LOGINRESPONSE":
         self.Login(username, password) # Occasionally a left-over packet can make it's way here - if so we'll just try again
@@ -527,9 +619,9 @@ class RegisterWindow(QDialog):
     try:
       password = hashString(password)
       registerPacket = RegisterPacket(username, password)
-      global _serverSocket
-      _serverSocket.send(encode(registerPacket))
-      registerResponse = decode(_serverSocket.recv(MAXTRANSMISSIONSIZE)) # Wait for user creation packet response
+      global _serverStream
+      _serverStream.sendPacket(registerPacket)
+      registerResponse = _serverStream.receivePacket() # Wait for user creation packet response
       if registerResponse.valid:
         successNotifier = QMessageBox()
         successNotifier.setIcon(QMessageBox.Information)
@@ -554,11 +646,11 @@ Args:
 """
 def SendMessage(message):
   try:
-      global _serverSocket, _username
+      global _serverStream, _username
       debugPrint(_userId, DEBUG)
       newMessage = Message(_userId, _username, message)
       newMessagePacket = MessagePacket(newMessage)
-      _serverSocket.send(encode(newMessagePacket))
+      _serverStream.sendPacket(newMessagePacket)
 
   except Exception:
      reportError()
@@ -571,13 +663,13 @@ Args:
 """
 def ParseCommand(command):
   try:
-    global _serverSocket
+    global _serverStream
     command = command[1:] # Strip command char
     args = command.split(" ") 
     command = args[0]
     del args[0]
     commandPacket = CommandPacket(command, args)
-    _serverSocket.send(encode(commandPacket))
+    _serverStream.sendPacket(commandPacket)
     
   except Exception:
     reportError()
@@ -596,6 +688,32 @@ def printMessage(message):
   _mainGui.writeSignal.emit(message)
 
 
+"""
+Asks the server for the page of messages before the oldest one displayed, unless one is already on its way or there are none left.
+"""
+def RequestHistory():
+  try:
+    global _historyRequested
+    if _historyRequested or not _moreHistory or _oldestMessageId == None:
+      return
+    _historyRequested = True
+    _serverStream.sendPacket(HistoryRequestPacket(_oldestMessageId, HISTORYPAGESIZE))
+
+  except Exception:
+    reportError()
+
+
+"""
+Asks the server for the full list of online users, after a presence change has been missed.
+"""
+def RequestOnlineUsers():
+  try:
+    _serverStream.sendPacket(Packet("REQUESTONLINEUSERS"))
+
+  except Exception:
+    reportError()
+
+
 def onProgramExit():
   try:
     global _serverSocket
@@ -608,68 +726,157 @@ def onProgramExit():
 
 def ListenForPackets(server):
   try:
-    global _serverSocket, _mainGui
+    global _serverStream, _mainGui
   
     readyToListen = Packet("READYTOLISTEN") # Tell the server we are ready to listen using generic packet
-    _serverSocket.send(encode(readyToListen))
+    _serverStream.sendPacket(readyToListen)
     
     while True:
-      packet = decode(server.recv(MAXTRANSMISSIONSIZE))
-
-      if packet.type == "MESSAGELIST":
-        for message in packet.messageList:
-          printMessage(message)
-             
-      elif packet.type == "MESSAGE":
-        formatMessage(packet)
-
-      elif packet.type == "ONLINEUSERS":
-        _mainGui.usersChangedSignal.emit(packet.userList)
-
-      elif packet.type == "COMMANDRESPONSE":
-        if packet.success:
-          if packet.command == "help":
-            printMessage(packet.response[0])
-            for i in range(1, len(packet.response)):
-              printMessage(f" - *{packet.response[i][0]}* : {packet.response[i][1]}")
-
-          if packet.command == "markup":
-            printMessage(packet.response[0])
-            printMessage(packet.response[1])
-            for i in range(2, len(packet.response)):
-              printMessage(f" - {packet.response[i][0]}, {packet.response[i][1]} : {packet.response[i][2]}")
+      packet = server.receivePacket()
+      handler = _packetHandlers.get(packet.type)
+      if handler == None:
+        print(f"Unknown packet received: {packet.type}")
+      else:
+        handler(packet)
           
-          elif packet.command == "ping":
-            printMessage(Message(contents=packet.response, colour=INFO))
+  except (ConnectionResetError, ConnectionRefusedError):
+    _mainGui.connectionLostSignal.emit()
 
-          elif packet.command == "whisper":
-            printMessage(Message(contents=formatDateTime(packet.timeSent) + packet.response, colour=INFO))
-            
-        else:
-          printMessage(Message(contents=f"Error executing command '{packet.command}' - {packet.err}", colour=COMMANDERROR))
+  except Exception:
+    reportError() 
 
 
-      elif packet.type == "USERLIST":
-        _mainGui.adminSettings.UserListReceived(packet.userList)
+# Packet handlers, registered in _packetHandlers below
 
+def onMessageList(packet):
+  global _oldestMessageId, _moreHistory
+  if len(packet.messageList) > 0:
+    _oldestMessageId = packet.messageList[0].messageId
+    _moreHistory = True
+  for message in packet.messageList:
+    printMessage(message)
 
-      elif packet.type == "USERINFO":
-        _mainGui.adminSettings.UpdateUserInfo(packet.id, packet.messageCount, packet.admin, packet.flags)
 
-      elif packet.type == "EDITMESSAGE":
-        _mainGui.updateMessageSignal.emit(packet.messageId, packet.newContents, packet.edited)
+def onHistory(packet):
+  global _oldestMessageId, _moreHistory, _historyRequested
+  if len(packet.messageList) > 0:
+    _oldestMessageId = packet.messageList[0].messageId
+  _moreHistory = packet.hasMore
+  _historyRequested = False
+  _mainGui.historySignal.emit(packet.messageList)
 
-      elif packet.type == "DELETEMESSAGE":
-        _mainGui.deleteMessageSignal.emit(packet.messageId)
 
-      else:
-          print(f"Unknown packet received: {packet.type}")
-          
-  except (ConnectionResetError, ConnectionRefusedError):
-    _mainGui.connectionLostSignal.emit()
+def onMessage(packet):
+  formatMessage(packet)
 
-  except Exception:
-    reportError() 
+
+def onOnlineUsers(packet):
+  global _onlineUsers, _presenceSequence
+  _onlineUsers = list(packet.userList)
+  _presenceSequence = packet.sequence
+  _mainGui.usersChangedSignal.emit(list(_onlineUsers))
+
+
+def onPresenceDelta(packet):
+  global _presenceSequence
+  if _presenceSequence == None or packet.sequence <= _presenceSequence: # Still waiting for the full list, or already included in it
+    return
+  if packet.sequence != _presenceSequence + 1: # Missed a change, so the list can no longer be trusted
+    _presenceSequence = None
+    RequestOnlineUsers()
+    return
+  _presenceSequence = packet.sequence
+
+  # The full list may already include changes made just before it was sent, so ignore users that are already present or absent
+  for username in packet.left:
+    index = bisect_left(_onlineUsers, username)
+    if index < len(_onlineUsers) and _onlineUsers[index] == username:
+      del _onlineUsers[index]
+      _mainGui.userLeftSignal.emit(index, len(_onlineUsers))
+  for username in packet.joined:
+    index = bisect_left(_onlineUsers, username)
+    if index == len(_onlineUsers) or _onlineUsers[index] != username:
+      _onlineUsers.insert(index, username)
+      _mainGui.userJoinedSignal.emit(index, username, len(_onlineUsers))
+
+
+def onCommandResponse(packet):
+  if packet.success:
+    handler = _commandResponseHandlers.get(packet.command)
+    if handler != None:
+      handler(packet)
+  else:
+    printMessage(Message(contents=f"Error executing command '{packet.command}' - {packet.err}", colour=COMMANDERROR))
+
+
+def onUserList(packet):
+  _mainGui.adminSettings.UserListReceived(packet.userList)
+
+
+def onUserInfo(packet):
+  _mainGui.adminSettings.UpdateUserInfo(packet.id, packet.messageCount, packet.admin, packet.flags)
+
+
+def onEditMessage(packet):
+  _mainGui.updateMessageSignal.emit(packet.messageId, packet.newContents, packet.edited)
+
+
+def onDeleteMessage(packet):
+  _mainGui.deleteMessageSignal.emit(packet.messageId)
+
+
+# Command response handlers, registered in _commandResponseHandlers below
+
+def onHelpResponse(packet):
+  printMessage(packet.response[0])
+  for i in range(1, len(packet.response)):
+    printMessage(f" - *{packet.response[i][0]}* : {packet.response[i][1]}")
+
+
+def onMarkupResponse(packet):
+  printMessage(packet.response[0])
+  printMessage(packet.response[1])
+  for i in range(2, len(packet.response)):
+    printMessage(f" - {packet.response[i][0]}, {packet.response[i][1]} : {packet.response[i][2]}")
+
+
+def onPingResponse(packet):
+  printMessage(Message(contents=packet.response, colour=INFO))
+
+
+def onWhisperResponse(packet):
+  printMessage(Message(contents=formatDateTime(packet.timeSent) + packet.response, colour=INFO))
+
+
+def onSearchResponse(packet):
+  printMessage(packet.response[0])
+  for i in range(1, len(packet.response)):
+    printMessage(Message(contents=formatDateTime(packet.response[i][0]) + formatUsername(packet.response[i][1]) + packet.response[i][2], colour=INFO))
+
+
+def onStatsResponse(packet):
+  printMessage(packet.response[0])
+  for i in range(1, len(packet.response)):
+    printMessage(Message(contents=packet.response[i].replace("_", "\\_"), colour=INFO)) # Metric names are full of underscores, which would otherwise start italics
+
+
+_packetHandlers.register("MESSAGELIST", onMessageList)
+_packetHandlers.register("HISTORY", onHistory)
+_packetHandlers.register("MESSAGE", onMessage)
+_packetHandlers.register("ONLINEUSERS", onOnlineUsers)
+_packetHandlers.register("PRESENCEDELTA", onPresenceDelta)
+_packetHandlers.register("COMMANDRESPONSE", onCommandResponse)
+_packetHandlers.register("USERLIST", onUserList)
+_packetHandlers.register("USERINFO", onUserInfo)
+_packetHandlers.register("EDITMESSAGE", onEditMessage)
+_packetHandlers.register("DELETEMESSAGE", onDeleteMessage)
+
+_commandResponseHandlers.register("help", onHelpResponse)
+_commandResponseHandlers.register("markup", onMarkupResponse)
+_commandResponseHandlers.register("ping", onPingResponse)
+_commandResponseHandlers.register("whisper", onWhisperResponse)
+_commandResponseHandlers.register("search", onSearchResponse)
+_commandResponseHandlers.register("stats", onStatsResponse)
 
 
 def formatMessage(packet):
@@ -745,12 +952,13 @@ def formatBalsmaiq(message, specialChar, tag):
 
 def __main__():
   try:
-    global _serverSocket, _username, MAXTRANSMISSIONSIZE, COMMANDCHAR, DEBUG
+    global _serverSocket, _serverStream, _username, MAXTRANSMISSIONSIZE, COMMANDCHAR, DEBUG, HISTORYPAGESIZE
 
     _configManager = ClientConfig("config.json")
     MAXTRANSMISSIONSIZE = _configManager.data["maxTransmissionSize"]
     COMMANDCHAR = _configManager.data["commandChar"]
     DEBUG = _configManager.data["debug"]
+    HISTORYPAGESIZE = _configManager.data["historyPageSize"]
 
     atexit.register(onProgramExit)
 
@@ -771,6 +979,7 @@ def __main__():
 
     # Connect to hostname on the port.
     _serverSocket.connect((host, port))
+    _serverStream = PacketStream(_serverSocket, MAXTRANSMISSIONSIZE)
 
     # Display UI
     global GuiDone, _app, _mainGui
@@ -785,7 +994,7 @@ def __main__():
     _mainGui.show()
     
     # Start listener thread for server responses
-    listenerThread = Thread(target=ListenForPackets, args=(_serverSocket,))
+    listenerThread = Thread(target=ListenForPackets, args=(_serverStream,))
     listenerThread.start()
 
     sys.exit(_app.exec_())
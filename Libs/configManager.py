@@ -7,6 +7,8 @@ class ConfigManager():
         if self.data == None:
             self.initJson(file, defaultData)
             self.data = self.loadJson(file)
+        else:
+            self.data = {**defaultData, **self.data} # Fill in any settings added since the file was created
 
     def loadJson(self, file):        
         if os.path.isfile(file):
@@ -26,9 +28,29 @@ class ServerConfig(ConfigManager):
         defaultData = {
 
             "dbFile": "photon.db",
+            "historyLoadCount": 510, # How many recent messages are kept in memory at startup
+            "messageCacheSize": 5000, # The most recent messages kept in memory while running
+            "readPoolSize": 8, # The most read only database connections open at once
+            "loginHistoryCount": 50, # The most messages sent to a client when it logs in, older ones are fetched as the client scrolls up
+            "historyPageSize": 100, # The most messages sent per history request
+            "searchPageSize": 10, # Results shown per page of /search
             "infoLoggingEnabled": True,
-            "maxTransmissionSize": 40960,
-            "port": 9998
+            "consoleLogging": True, # Whether log lines are also printed to the console
+            "logFile": "log.txt",
+            "logFlushInterval": 1.0, # The most seconds a log line waits before it is written to disk
+            "logMaxBytes": 10485760, # The size the log file is rotated at, or 0 to never rotate by size
+            "logRotateInterval": 86400, # The most seconds between log rotations, or 0 to never rotate by time
+            "logBackupCount": 5, # How many rotated log files are kept
+            "journalFile": "journal.bin", # Structured event journal, read with journalReader.py, or "" to disable it
+            "metricsPort": 0, # Serves metrics for scraping on 127.0.0.1 only on this port, eg. 9999, or 0 to disable
+            "maxTransmissionSize": 1048576, # Largest packet accepted, also caps the login history packet
+            "port": 9998,
+            "serverMode": "threaded", # "threaded" or "asyncio"
+            "executorThreads": 16,
+            "listenBacklog": 1024,
+            "outboundQueueSize": 1024,
+            "presenceInterval": 0.25, # Seconds of logins and logouts sent to clients together as one update
+            "slowConsumerPolicy": "dropOldest" # "dropOldest", "coalesce" (also replaces queued lists of online users with newer ones) or "disconnect"
 
             }
             
@@ -39,10 +61,11 @@ class ClientConfig(ConfigManager):
     def __init__(self, file):
         defaultData = {
 
-            "maxTransmissionSize": 40960,
+            "maxTransmissionSize": 16777216, # Largest packet accepted from the server
             "debug": True,
             "commandChar": "/",
-            "port": 9998
+            "port": 9998,
+            "historyPageSize": 50 # How many older messages to ask for when scrolled to the top
 
             }
 
@@ -90,11 +90,13 @@ class OnlineUsersPacket(Packet):
   Sends a list of the usernames of all clients which are online.
 
   Args:
-    userList (list of string): List of usernames of online clients.
+    userList (list of string): List of usernames of online clients, sorted.
+    sequence (int, optional): The sequence number of the last PresenceDeltaPacket the list includes.
   """
-  def __init__(self, userList):
+  def __init__(self, userList, sequence=0):
     Packet.__init__(self, "ONLINEUSERS")
     self.userList = userList
+    self.sequence = sequence
 
 class UserListPacket(Packet):
   """
@@ -199,3 +201,47 @@ class SetAdminStatusPacket(Packet):
     Packet.__init__(self, "SETADMINSTATUS")
     self.userId = userId
     self.admin = admin
+
+class HistoryRequestPacket(Packet):
+  """
+  Asks the server for a page of older messages.
+
+  Args:
+    beforeId (int): Only messages older than this message id are sent.
+    pageSize (int): The most messages to send.
+  """
+  def __init__(self, beforeId, pageSize):
+    Packet.__init__(self, "REQUESTHISTORY")
+    self.beforeId = beforeId
+    self.pageSize = pageSize
+
+class HistoryPacket(Packet):
+  """
+  Sends the client a page of older messages.
+
+  Args:
+    messageList (list of photonUtilities.Message): The messages, oldest first.
+    beforeId (int): The message id the page was requested before.
+    hasMore (bool): Whether there are older messages still to be fetched.
+  """
+  def __init__(self, messageList, beforeId, hasMore):
+    Packet.__init__(self, "HISTORY")
+    self.messageList = messageList
+    self.beforeId = beforeId
+    self.hasMore = hasMore
+
+class PresenceDeltaPacket(Packet):
+  """
+  Tells clients which users have come online or gone offline since the last PresenceDeltaPacket.
+  Each delta has the next sequence number, so a client that misses one can tell and ask for the full list of online users again.
+
+  Args:
+    joined (list of string): Usernames of users who have come online.
+    left (list of string): Usernames of users who have gone offline.
+    sequence (int): The sequence number of this delta.
+  """
+  def __init__(self, joined, left, sequence):
+    Packet.__init__(self, "PRESENCEDELTA")
+    self.joined = joined
+    self.left = left
+    self.sequence = sequence
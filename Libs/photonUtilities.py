@@ -1,59 +1,144 @@
-import pickle
 import traceback
 import datetime
+import struct
+import sys
+import time
+from array import array
+from collections import deque
+from threading import Lock, Condition
+
+from packets import *
 
 # Global Colours
 BLACK = "#000000"
 COMMANDERROR = "#ff3030"
 INFO = "#636363"
 
+# Framing
+FRAMEHEADER = struct.Struct("!I") # Every packet on the wire is prefixed by its length as an unsigned 32 bit int
+MAXFRAMESIZE = 16777216
+RECEIVESIZE = 65536
+
 
 class CircularQueue():
   """
-  A custom circular queue implementation.
+  A thread safe, bounded circular queue.
+  Consumers can block until items arrive rather than polling, and producers can block until there is space.
+
+  Args:
+    maxSize (int): The most items the queue can hold.
   """
   def __init__(self, maxSize):
     if maxSize < 1:
       raise ValueError("Queue size must be at least 1")
-    self.data = [''] * maxSize
-    self.rear = -1
-    self.front= 0
+    self.data = [None] * maxSize
+    self.front = 0
     self.size = 0
     self.maxSize = maxSize
+    self.lock = Lock()
+    self.notEmpty = Condition(self.lock) # Signalled when an item is added
+    self.notFull = Condition(self.lock) # Signalled when an item is removed
 
-  def enQueue(self, item):
+  def put(self, item, block=True, timeout=None):
     """
     Add an item to the queue.
 
     Args:
       item (*): Item to add to the queue.
+      block (bool, optional): Whether to wait for space if the queue is full.
+      timeout (float, optional): The most seconds to wait for space. Waits forever if None.
+
+    Raises:
+      ValueError: If the queue is still full after waiting.
     """
-    if self.size == self.maxSize:
-      raise ValueError("Cannot enqueue when the queue is full")
-    else:
-      self.rear = (self.rear + 1) % self.maxSize
-      self.data[self.rear] = item
-      self.size = self.size + 1
+    with self.lock:
+      if self.size == self.maxSize:
+        if not block or not self.notFull.wait_for(lambda: self.size < self.maxSize, timeout):
+          raise ValueError("Cannot enqueue when the queue is full")
+      self.data[(self.front + self.size) % self.maxSize] = item
+      self.size += 1
+      self.notEmpty.notify()
+
+  def get(self, block=True, timeout=None):
+    """
+    Removes an item from the queue.
+
+    Args:
+      block (bool, optional): Whether to wait for an item if the queue is empty.
+      timeout (float, optional): The most seconds to wait for an item. Waits forever if None.
+
+    Returns:
+      (*): The item at the front of the queue.
+
+    Raises:
+      ValueError: If the queue is still empty after waiting.
+    """
+    with self.lock:
+      if self.size == 0:
+        if not block or not self.notEmpty.wait_for(lambda: self.size > 0, timeout):
+          raise ValueError("Cannot dequeue when the queue is empty")
+      item = self.data[self.front]
+      self.data[self.front] = None # Don't keep the item alive
+      self.front = (self.front + 1) % self.maxSize
+      self.size -= 1
+      self.notFull.notify()
+      return item
+
+  def getBatch(self, count, block=True, timeout=None):
+    """
+    Removes up to count items from the queue at once.
+
+    Args:
+      count (int): The most items to remove.
+      block (bool, optional): Whether to wait for an item if the queue is empty.
+      timeout (float, optional): The most seconds to wait for an item. Waits forever if None.
+
+    Returns:
+      (list of *): The removed items, oldest first. Empty if no items arrived in time.
+    """
+    with self.lock:
+      if self.size == 0:
+        if not block or not self.notEmpty.wait_for(lambda: self.size > 0, timeout):
+          return []
+      count = min(count, self.size)
+      items = []
+      for i in range(count):
+        items.append(self.data[self.front])
+        self.data[self.front] = None
+        self.front = (self.front + 1) % self.maxSize
+      self.size -= count
+      self.notFull.notify(count)
+      return items
+
+  def enQueue(self, item):
+    """
+    Add an item to the queue without waiting.
+
+    Args:
+      item (*): Item to add to the queue.
+    """
+    self.put(item, block=False)
 
   def deQueue(self):
     """
-    Removes an item from the queue.
+    Removes an item from the queue without waiting.
 
     Returns:
       (*): The item at the front of the queue.
     """
-    self.front += 1
-    self.size -= 1
-    return self.data[self.front-1]
+    return self.get(block=False)
 
   def isFull(self):
     """ Determines if the queue is full. """
-    return self.size == self.rear
+    return self.size == self.maxSize
 
   def isEmpty(self):
     """ Determines if the queue is empty. """
     return self.size == 0
 
+  def __len__(self):
+    return self.size
+
 
 class Message():
   """
@@ -132,8 +217,8 @@ def integerMergeSort(mergelist):
       mid = len(mergelist) // 2 # Perform integer division
       lefthalf = mergelist[:mid] # Left half of merglist into lefthalf
       righthalf = mergelist[mid:] # Right half of merglist into righthalf
-      lefthalf = MergeSort(lefthalf)
-      righthalf = MergeSort(righthalf)
+      lefthalf = integerMergeSort(lefthalf)
+      righthalf = integerMergeSort(righthalf)
 
       i = 0
       j = 0
@@ -275,9 +360,633 @@ def debugPrint(message, debug):
     print(message)
 
 
+class Handler:
+  """
+  A function registered with a Dispatcher, along with how long its calls have taken.
+
+  Attributes:
+    function (function): The function that handles the key.
+    minArgs (int): For commands, the fewest arguments the command can be given.
+    usage (string): For commands, how to use the command, eg. "whisper <user> <message>".
+    description (string): For commands, what the command does.
+    calls (int): How many times the handler has been called.
+    totalTime (float): The total time spent in the handler, in seconds.
+    maxTime (float): The longest single call to the handler, in seconds.
+    lock (threading.Lock): Guards the timings, as handlers can run on several threads at once.
+  """
+  def __init__(self, function, minArgs=0, usage="", description=""):
+    self.function = function
+    self.minArgs = minArgs
+    self.usage = usage
+    self.description = description
+    self.calls = 0
+    self.totalTime = 0.0
+    self.maxTime = 0.0
+    self.lock = Lock()
+
+
+  def __call__(self, *args):
+    start = time.perf_counter()
+    try:
+      return self.function(*args)
+    finally:
+      elapsed = time.perf_counter() - start
+      with self.lock:
+        self.calls += 1
+        self.totalTime += elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+
+
+class Dispatcher:
+  """
+  Maps keys, such as packet types or command names, to the handlers for them, so dispatching is a single dictionary lookup.
+  Every call through a handler is timed, so the dispatcher is also the place to look for which handlers are slow.
+
+  Attributes:
+    handlers (dict of string: Handler): The registered handlers, in the order they were registered.
+  """
+  def __init__(self):
+    self.handlers = {}
+
+
+  def register(self, key, function, minArgs=0, usage="", description=""):
+    """
+    Registers the handler for a key, replacing any handler already registered for it.
+
+    Args:
+      key (string): What the handler handles.
+      function (function): The handler.
+      minArgs (int, optional): For commands, the fewest arguments the command can be given.
+      usage (string, optional): For commands, how to use the command.
+      description (string, optional): For commands, what the command does.
+    """
+    self.handlers[key] = Handler(function, minArgs, usage, description)
+
+
+  def get(self, key):
+    """
+    Gets the handler for a key.
+
+    Args:
+      key (string): What to get the handler for.
+
+    Returns:
+      (Handler): The handler, which can be called like the function it wraps, or None if nothing handles the key.
+    """
+    return self.handlers.get(key)
+
+
+  def timings(self):
+    """
+    Gets how long each handler that has been called has taken.
+
+    Returns:
+      (list of (string, int, float, float)): The key, number of calls, total and longest call time in seconds of each handler, slowest in total first.
+    """
+    timings = []
+    for key, handler in self.handlers.items():
+      with handler.lock:
+        if handler.calls > 0:
+          timings.append((key, handler.calls, handler.totalTime, handler.maxTime))
+    timings.sort(key=lambda timing: timing[2], reverse=True)
+    return timings
+
+
+  def __iter__(self):
+    return iter(self.handlers.items())
+
+
+# Wire codec
+# Every packet is encoded as a one byte type id followed by a fixed layout of its fields, then the bytes of any variable length fields in order.
+# Scalars are stored inline; strings and nested structures store their length inline and their bytes afterwards.
+# Messages and string lists put every length first and every string after, so all of their text is decoded with a single call.
+
+BOOLFIELD = 0 # bool
+INTFIELD = 1 # 64 bit signed int
+OPTINTFIELD = 2 # 64 bit signed int, or "" for no value
+STRFIELD = 3 # utf-8 string
+MESSAGEFIELD = 4 # Message
+MESSAGELISTFIELD = 5 # list of Message
+VALUEFIELD = 6 # Any combination of None, bool, int, float, string, list and tuple
+STRLISTFIELD = 7 # list of utf-8 strings
+
+FIELDFORMATS = {BOOLFIELD: "?", INTFIELD: "q", OPTINTFIELD: "q", STRFIELD: "I", MESSAGEFIELD: "I", MESSAGELISTFIELD: "I", VALUEFIELD: "I", STRLISTFIELD: "I"}
+NOINT = -2**31 # Stands in for "" in OPTINTFIELDs and message ids
+
+MESSAGESTRUCT = struct.Struct("!iii?HIHH") # senderId, recipientId, messageId, edited, then the lengths in characters of senderName, contents, timeSent, colour
+COUNTSTRUCT = struct.Struct("!I")
+INTSTRUCT = struct.Struct("!q")
+FLOATSTRUCT = struct.Struct("!d")
+STRSEPARATOR = "\x00" # Separates the strings of a STRLISTFIELD, unless one of them contains it
+LENGTHTYPECODES = {1: "B", 2: "H", 4: "I"} # ...in which case their lengths are given instead, with this array type for each width
+
+VALUENONE = 0
+VALUEFALSE = 1
+VALUETRUE = 2
+VALUEINT = 3
+VALUESTR = 4
+VALUELIST = 5
+VALUETUPLE = 6
+VALUEFLOAT = 7
+
+_packetSchemas = {} # packet type -> PacketSchema
+_packetSchemasById = {} # type id -> PacketSchema
+
+
+def encodeOptionalInt(value):
+  """ Converts an optional id into something that can be packed into an OPTINTFIELD. """
+  if value == "" or value == None:
+    return NOINT
+  return value
+
+
+def decodeOptionalInt(value):
+  """ Reverses encodeOptionalInt(). """
+  if value == NOINT:
+    return ""
+  return value
+
+
+def encodeMessageParts(message):
+  """
+  Encodes a single message into its fixed size header and its text, kept apart so lists of messages can be laid out with every header first and every text after.
+  The header stores the length of each string in characters rather than bytes, so the text of a whole list can be decoded in one go and then sliced.
+
+  Args:
+    message (Message): The message to encode.
+
+  Returns:
+    (bytes, bytes): The encoded header, and the message's senderName, contents, timeSent and colour encoded together.
+  """
+  senderName, contents, timeSent, colour = message.senderName, message.contents, message.timeSent, message.colour
+  header = MESSAGESTRUCT.pack(encodeOptionalInt(message.senderId), encodeOptionalInt(message.recipientId), encodeOptionalInt(message.messageId), bool(message.edited),
+                              len(senderName), len(contents), len(timeSent), len(colour))
+  return (header, (senderName + contents + timeSent + colour).encode())
+
+
+def encodeMessage(message):
+  """
+  Encodes a single message into its binary layout, its header followed by its text.
+
+  Args:
+    message (Message): The message to encode.
+
+  Returns:
+    (bytes): The encoded message.
+  """
+  header, text = encodeMessageParts(message)
+  return header + text
+
+
+def decodeMessages(data, offset, end, count):
+  """
+  Decodes messages laid out as count headers followed by the text of every message.
+
+  Args:
+    data (bytes): The buffer containing the messages.
+    offset (int): Where the first header starts in the buffer.
+    end (int): The offset of the first byte after the last message's text.
+    count (int): The number of messages.
+
+  Returns:
+    (list of Message): The decoded messages.
+  """
+  headersEnd = offset + count * MESSAGESTRUCT.size
+  text = str(data[headersEnd:end], "utf-8")
+  messageList = []
+  position = 0
+  for senderId, recipientId, messageId, edited, senderNameLength, contentsLength, timeSentLength, colourLength in MESSAGESTRUCT.iter_unpack(data[offset:headersEnd]):
+    message = Message.__new__(Message)
+    message.senderId = senderId if senderId != NOINT else ""
+    message.recipientId = recipientId if recipientId != NOINT else ""
+    message.messageId = messageId if messageId != NOINT else ""
+    message.edited = edited
+    contentsStart = position + senderNameLength
+    timeSentStart = contentsStart + contentsLength
+    colourStart = timeSentStart + timeSentLength
+    message.senderName = text[position:contentsStart]
+    message.contents = text[contentsStart:timeSentStart]
+    message.timeSent = text[timeSentStart:colourStart]
+    position = colourStart + colourLength
+    message.colour = text[colourStart:position]
+    messageList.append(message)
+  if position != len(text):
+    raise ValueError("Message lengths do not match their text")
+  return messageList
+
+
+def decodeMessage(data, offset, end):
+  """ Reverses encodeMessage(). """
+  return decodeMessages(data, offset, end, 1)[0]
+
+
+def encodeMessageList(messageList):
+  """ Encodes a list of messages as a count, the header of every message, then the text of every message. """
+  return joinMessageList([encodeMessageParts(message) for message in messageList])
+
+
+def joinMessageList(encodedMessages):
+  """
+  Lays out a list of messages already encoded with encodeMessageParts().
+
+  Args:
+    encodedMessages (list of (bytes, bytes)): The header and text of each message, in order.
+
+  Returns:
+    (bytes): The encoded list.
+  """
+  return COUNTSTRUCT.pack(len(encodedMessages)) + b"".join([header for header, text in encodedMessages]) + b"".join([text for header, text in encodedMessages])
+
+
+def decodeMessageList(data, offset, end):
+  """ Reverses encodeMessageList(). """
+  count = COUNTSTRUCT.unpack_from(data, offset)[0]
+  return decodeMessages(data, offset + COUNTSTRUCT.size, end, count)
+
+
+def encodeValue(value, buffer):
+  """
+  Appends a tagged encoding of a loosely typed value to a buffer.
+
+  Args:
+    value (*): None, or a bool, int, float, string, list or tuple of these.
+    buffer (bytearray): The buffer to append to.
+  """
+  if value == None:
+    buffer.append(VALUENONE)
+  elif value is True:
+    buffer.append(VALUETRUE)
+  elif value is False:
+    buffer.append(VALUEFALSE)
+  elif type(value) is int:
+    buffer.append(VALUEINT)
+    buffer += INTSTRUCT.pack(value)
+  elif type(value) is str:
+    encoded = value.encode()
+    buffer.append(VALUESTR)
+    buffer += COUNTSTRUCT.pack(len(encoded))
+    buffer += encoded
+  elif type(value) is list or type(value) is tuple:
+    buffer.append(VALUELIST if type(value) is list else VALUETUPLE)
+    buffer += COUNTSTRUCT.pack(len(value))
+    for item in value:
+      encodeValue(item, buffer)
+  elif type(value) is float:
+    buffer.append(VALUEFLOAT)
+    buffer += FLOATSTRUCT.pack(value)
+  else:
+    raise ValueError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def decodeValue(data, offset):
+  """
+  Decodes a value written by encodeValue().
+
+  Args:
+    data (bytes): The buffer containing the value.
+    offset (int): Where the value starts in the buffer.
+
+  Returns:
+    (*, int): The decoded value, and the offset of the first byte after it.
+  """
+  tag = data[offset]
+  offset += 1
+  if tag == VALUESTR:
+    length = COUNTSTRUCT.unpack_from(data, offset)[0]
+    offset += COUNTSTRUCT.size
+    return (str(data[offset:offset + length], "utf-8"), offset + length)
+  elif tag == VALUEINT:
+    return (INTSTRUCT.unpack_from(data, offset)[0], offset + INTSTRUCT.size)
+  elif tag == VALUELIST or tag == VALUETUPLE:
+    count = COUNTSTRUCT.unpack_from(data, offset)[0]
+    offset += COUNTSTRUCT.size
+    items = []
+    for i in range(count):
+      item, offset = decodeValue(data, offset)
+      items.append(item)
+    return (items if tag == VALUELIST else tuple(items), offset)
+  elif tag == VALUENONE:
+    return (None, offset)
+  elif tag == VALUETRUE:
+    return (True, offset)
+  elif tag == VALUEFALSE:
+    return (False, offset)
+  elif tag == VALUEFLOAT:
+    return (FLOATSTRUCT.unpack_from(data, offset)[0], offset + FLOATSTRUCT.size)
+  else:
+    raise ValueError(f"Unknown value tag {tag}")
+
+
+def encodeStringList(strings):
+  """
+  Encodes a list of strings as a count and a format byte, then the strings themselves.
+  The strings are separated by NULs when none of them contain one, as usernames and command arguments never do, so they can be decoded and split in one go.
+  Otherwise the format byte gives the width of the lengths that follow, in characters: one byte each when every string is shorter than 256 characters, two when shorter than 65536, otherwise four.
+  """
+  text = STRSEPARATOR.join(strings)
+  if text.count(STRSEPARATOR) == max(len(strings) - 1, 0):
+    return COUNTSTRUCT.pack(len(strings)) + bytes((0,)) + text.encode()
+  lengths = [len(string) for string in strings]
+  longest = max(lengths)
+  width = 1 if longest < 0x100 else 2 if longest < 0x10000 else 4
+  lengths = array(LENGTHTYPECODES[width], lengths)
+  if width > 1 and sys.byteorder == "little":
+    lengths.byteswap()
+  return COUNTSTRUCT.pack(len(strings)) + bytes((width,)) + lengths.tobytes() + "".join(strings).encode()
+
+
+def decodeStringList(data, offset, end):
+  """ Reverses encodeStringList(). """
+  count = COUNTSTRUCT.unpack_from(data, offset)[0]
+  width = data[offset + COUNTSTRUCT.size]
+  offset += COUNTSTRUCT.size + 1
+  if width == 0:
+    strings = str(data[offset:end], "utf-8").split(STRSEPARATOR) if count > 0 else []
+    if len(strings) != count:
+      raise ValueError("String list does not match its count")
+    return strings
+
+  if width not in LENGTHTYPECODES:
+    raise ValueError(f"Unknown string list format {width}")
+  lengths = array(LENGTHTYPECODES[width], data[offset:offset + count * width])
+  if len(lengths) != count:
+    raise ValueError("String list is shorter than its count")
+  if width > 1 and sys.byteorder == "little":
+    lengths.byteswap()
+  text = str(data[offset + count * width:end], "utf-8")
+  strings = []
+  position = 0
+  for length in lengths:
+    strings.append(text[position:position + length])
+    position += length
+  if position != len(text):
+    raise ValueError("String lengths do not match their text")
+  return strings
+
+
+def encodeValueField(value):
+  """ Encodes a VALUEFIELD. """
+  buffer = bytearray()
+  encodeValue(value, buffer)
+  return buffer
+
+
+def decodeValueField(data, offset, end):
+  """ Decodes a VALUEFIELD. """
+  return decodeValue(data, offset)[0]
+
+
+FIELDENCODERS = {STRFIELD: str.encode, MESSAGEFIELD: encodeMessage, MESSAGELISTFIELD: encodeMessageList, VALUEFIELD: encodeValueField, STRLISTFIELD: encodeStringList}
+FIELDDECODERS = {STRFIELD: lambda data, offset, end: str(data[offset:end], "utf-8"), MESSAGEFIELD: decodeMessage,
+                 MESSAGELISTFIELD: decodeMessageList, VALUEFIELD: decodeValueField, STRLISTFIELD: decodeStringList}
+
+
+class PacketSchema():
+  """
+  The binary layout of one packet type.
+
+  Args:
+    typeId (int): The id written at the start of every packet of this type. Must be unique and between 1 and 255.
+    packetType (string): The packet's type string, as set by Packet.__init__().
+    packetClass (class): The class to decode the packet into.
+    fields (list of (string, int)): The attribute name and field kind of every field, in wire order.
+  """
+  def __init__(self, typeId, packetType, packetClass, fields):
+    self.typeId = typeId
+    self.packetType = packetType
+    self.packetClass = packetClass
+    self.fields = fields
+    self.struct = struct.Struct("!B" + "".join([FIELDFORMATS[kind] for name, kind in fields]))
+    self.encoders = [FIELDENCODERS.get(kind) for name, kind in fields]
+    self.decoders = [FIELDDECODERS.get(kind) for name, kind in fields]
+
+  def encode(self, packet):
+    """ Encodes a packet of this type. """
+    values = [self.typeId]
+    variableParts = []
+    for (name, kind), encoder in zip(self.fields, self.encoders):
+      value = getattr(packet, name)
+      if encoder != None:
+        encoded = encoder(value)
+        values.append(len(encoded))
+        variableParts.append(encoded)
+      elif kind == OPTINTFIELD:
+        values.append(encodeOptionalInt(value))
+      elif kind == BOOLFIELD:
+        values.append(bool(value))
+      else:
+        values.append(value)
+    return self.struct.pack(*values) + b"".join(variableParts)
+
+  def decode(self, data):
+    """ Decodes a packet of this type. Fields are set directly on a new instance, bypassing __init__(). """
+    values = self.struct.unpack_from(data)
+    packet = self.packetClass.__new__(self.packetClass)
+    packet.type = self.packetType
+    offset = self.struct.size
+    i = 1
+    for (name, kind), decoder in zip(self.fields, self.decoders):
+      value = values[i]
+      if decoder != None:
+        end = offset + value
+        value = decoder(data, offset, end)
+        offset = end
+      elif kind == OPTINTFIELD:
+        value = decodeOptionalInt(value)
+      setattr(packet, name, value)
+      i += 1
+    return packet
+
+
+def registerPacket(typeId, packetType, packetClass, fields=()):
+  """
+  Registers the binary layout of a packet type so it can be encoded and decoded.
+
+  Args:
+    typeId (int): The id written at the start of every packet of this type. Must be unique and between 1 and 255.
+    packetType (string): The packet's type string, as set by Packet.__init__().
+    packetClass (class): The class to decode the packet into.
+    fields (list of (string, int), optional): The attribute name and field kind of every field, in wire order.
+  """
+  if typeId in _packetSchemasById or packetType in _packetSchemas:
+    raise ValueError(f"Packet {packetType} ({typeId}) is already registered")
+  schema = PacketSchema(typeId, packetType, packetClass, fields)
+  _packetSchemas[packetType] = schema
+  _packetSchemasById[typeId] = schema
+
+
+registerPacket(1, "LOGINREQUEST", LoginRequestPacket, [("username", STRFIELD), ("password", STRFIELD)])
+registerPacket(2, "LOGINRESPONSE", LoginResponsePacket, [("valid", BOOLFIELD), ("err", STRFIELD), ("id", OPTINTFIELD), ("admin", BOOLFIELD)])
+registerPacket(3, "CREATEUSER", RegisterPacket, [("username", STRFIELD), ("password", STRFIELD)])
+registerPacket(4, "REGISTERRESPONSE", RegisterResponsePacket, [("valid", BOOLFIELD), ("err", STRFIELD)])
+registerPacket(5, "MESSAGE", MessagePacket, [("message", MESSAGEFIELD)])
+registerPacket(6, "MESSAGELIST", MessageListPacket, [("messageList", MESSAGELISTFIELD)])
+registerPacket(7, "ONLINEUSERS", OnlineUsersPacket, [("userList", STRLISTFIELD), ("sequence", INTFIELD)])
+registerPacket(8, "USERLIST", UserListPacket, [("userList", VALUEFIELD)])
+registerPacket(9, "REQUESTUSERINFO", RequestUserInfoPacket, [("user", STRFIELD)])
+registerPacket(10, "USERINFO", UserInfoPacket, [("id", INTFIELD), ("messageCount", INTFIELD), ("admin", BOOLFIELD), ("flags", VALUEFIELD)])
+registerPacket(11, "COMMAND", CommandPacket, [("command", STRFIELD), ("args", STRLISTFIELD)])
+registerPacket(12, "COMMANDRESPONSE", CommandResponsePacket, [("command", STRFIELD), ("success", BOOLFIELD), ("err", STRFIELD), ("response", VALUEFIELD), ("timeSent", STRFIELD)])
+registerPacket(13, "REPORTPACKET", ReportPacket, [("messageId", OPTINTFIELD), ("reporterId", OPTINTFIELD), ("reportReason", STRFIELD)])
+registerPacket(14, "DELETEMESSAGE", DeleteMessagePacket, [("messageId", OPTINTFIELD)])
+registerPacket(15, "EDITMESSAGE", EditMessagePacket, [("messageId", OPTINTFIELD), ("newContents", STRFIELD), ("edited", BOOLFIELD)])
+registerPacket(16, "SETADMINSTATUS", SetAdminStatusPacket, [("admin", BOOLFIELD), ("userId", VALUEFIELD)])
+registerPacket(17, "READYTOLISTEN", Packet)
+registerPacket(18, "REQUESTUSERLIST", Packet)
+registerPacket(19, "REQUESTHISTORY", HistoryRequestPacket, [("beforeId", INTFIELD), ("pageSize", INTFIELD)])
+registerPacket(20, "HISTORY", HistoryPacket, [("messageList", MESSAGELISTFIELD), ("beforeId", INTFIELD), ("hasMore", BOOLFIELD)])
+registerPacket(21, "PRESENCEDELTA", PresenceDeltaPacket, [("joined", STRLISTFIELD), ("left", STRLISTFIELD), ("sequence", INTFIELD)])
+registerPacket(22, "REQUESTONLINEUSERS", Packet)
+
+
 def encode(packet):
-  """ Better name for pickle.dumps() """
-  return pickle.dumps(packet)
-def decode(packet):
-  """ Better name for pickle.loads() """
-  return pickle.loads(packet)
+  """
+  Encodes a packet into its binary layout.
+
+  Args:
+    packet (packets.Packet): The packet to encode. Its type must have been registered with registerPacket().
+
+  Returns:
+    (bytes): The encoded packet.
+  """
+  schema = _packetSchemas.get(packet.type)
+  if schema == None:
+    raise ValueError(f"No wire layout registered for packet type {packet.type}")
+  return schema.encode(packet)
+
+
+def decode(data):
+  """
+  Decodes a packet from its binary layout. Unlike pickle, only registered packet types can be produced.
+
+  Args:
+    data (bytes): The encoded packet.
+
+  Returns:
+    (packets.Packet): The decoded packet.
+  """
+  schema = _packetSchemasById.get(data[0]) if len(data) > 0 else None
+  if schema == None:
+    raise ValueError("Received packet with an unknown type id")
+  try:
+    return schema.decode(data)
+  except (struct.error, IndexError, UnicodeDecodeError) as err:
+    raise ValueError(f"Malformed {schema.packetType} packet") from err
+
+
+def encodeMessageListFrame(encodedMessages):
+  """
+  Builds a framed MessageListPacket from messages already encoded with encodeMessageParts(), so cached encodings can be reused.
+
+  Args:
+    encodedMessages (list of (bytes, bytes)): The header and text of each message, in order.
+
+  Returns:
+    (bytes): The framed packet, identical to encodeFrame(MessageListPacket(messages)).
+  """
+  schema = _packetSchemas["MESSAGELIST"]
+  messageList = joinMessageList(encodedMessages)
+  payload = schema.struct.pack(schema.typeId, len(messageList)) + messageList
+  return FRAMEHEADER.pack(len(payload)) + payload
+
+
+def encodeFrame(packet):
+  """
+  Encodes a packet and prefixes it with its length, ready to be written to a socket.
+
+  Args:
+    packet (packets.Packet): The packet to encode.
+
+  Returns:
+    (bytes): The framed packet.
+  """
+  payload = encode(packet)
+  return FRAMEHEADER.pack(len(payload)) + payload
+
+
+class FrameReader():
+  """
+  Reassembles length-prefixed frames from a stream of bytes.
+  A single read may contain several frames, or only part of one; incomplete frames are buffered until the rest arrives.
+
+  Args:
+    maxFrameSize (int, optional): The largest frame that will be accepted. Protects against corrupt or malicious length headers.
+  """
+  def __init__(self, maxFrameSize=MAXFRAMESIZE):
+    self.buffer = bytearray()
+    self.maxFrameSize = maxFrameSize
+
+  def feed(self, data):
+    """
+    Adds received bytes to the buffer and extracts every complete frame.
+
+    Args:
+      data (bytes): The bytes read from the stream.
+
+    Returns:
+      (list of bytes): The payloads of the frames completed by this read, in order.
+    """
+    self.buffer += data
+    frames = []
+    offset = 0
+    available = len(self.buffer)
+    while available - offset >= FRAMEHEADER.size:
+      length = FRAMEHEADER.unpack_from(self.buffer, offset)[0]
+      if length > self.maxFrameSize:
+        raise ValueError(f"Frame of {length} bytes exceeds the maximum frame size of {self.maxFrameSize}")
+      end = offset + FRAMEHEADER.size + length
+      if end > available: # Rest of the frame has not arrived yet
+        break
+      frames.append(bytes(self.buffer[offset + FRAMEHEADER.size:end]))
+      offset = end
+    if offset > 0:
+      del self.buffer[:offset]
+    return frames
+
+
+class PacketStream():
+  """
+  Sends and receives framed packets over a socket.
+
+  Args:
+    socket (socket.socket): The connected socket.
+    maxFrameSize (int, optional): The largest frame that will be accepted.
+  """
+  def __init__(self, socket, maxFrameSize=MAXFRAMESIZE):
+    self.socket = socket
+    self.reader = FrameReader(maxFrameSize)
+    self.pending = deque()
+    self.sendLock = Lock()
+
+  def receivePacket(self):
+    """
+    Waits for the next packet. Frames that arrived in the same read are kept for subsequent calls.
+
+    Returns:
+      (packets.Packet): The received packet.
+    """
+    while len(self.pending) == 0:
+      data = self.socket.recv(RECEIVESIZE)
+      if len(data) == 0: # Socket was closed by the other end
+        raise ConnectionResetError()
+      self.pending.extend(self.reader.feed(data))
+    return decode(self.pending.popleft())
+
+  def sendPacket(self, packet):
+    """
+    Sends a packet.
+
+    Args:
+      packet (packets.Packet): The packet to send.
+    """
+    self.sendFrames([encodeFrame(packet)])
+
+  def sendFrames(self, frames):
+    """
+    Sends already framed packets in a single write.
+
+    Args:
+      frames (list of bytes): The frames to send, as returned by encodeFrame().
+    """
+    with self.sendLock: # Stops frames from different threads being interleaved
+      self.socket.sendall(b"".join(frames))
@@ -1,28 +1,265 @@
 
 import sqlite3                            
 from threading import *
+from concurrent.futures import Future
+import asyncio
+import time
+from contextlib import contextmanager
 
 # Load classes and functions from shared libs
 import sys
 sys.path.insert(0, '../Libs')
 from photonUtilities import *
+from messageStore import *
+from metrics import *
+
+class WriteCommand:
+  """
+  A single SQL statement waiting to be executed by the database writer.
+
+  Attributes:
+    sql (string): The statement to execute.
+    params (tuple): The parameters to bind to the statement.
+    future (concurrent.futures.Future): Resolved by the writer once the statement has been committed.
+    result (*): What the future resolves to. If None, the future resolves to the rowid of the inserted row.
+    queued (float): The time.perf_counter() at which the statement was queued.
+  """
+  def __init__(self, sql, params, result=None):
+    self.sql = sql
+    self.params = params
+    self.future = Future()
+    self.result = result
+    self.queued = time.perf_counter()
+
+
+# Schema migrations, see Database.migrate()
+
+def createBaseSchema(connection):
+  """ Creates the original tables and the server's own user, for a new database. """
+  connection.execute("""CREATE TABLE IF NOT EXISTS "User" (
+                          `user_id` INTEGER NOT NULL,
+                          `name` TEXT NOT NULL,
+                          `password` TEXT,
+                          `admin` INTEGER NOT NULL DEFAULT 0,
+                          PRIMARY KEY(`user_id`))""")
+  connection.execute("""CREATE TABLE IF NOT EXISTS "Flag" (
+                          `flag_id` INTEGER NOT NULL,
+                          `reportedUser_id` INTEGER NOT NULL,
+                          `message_id` INTEGER NOT NULL,
+                          `reporter_id` INTEGER NOT NULL,
+                          `reportReason` TEXT NOT NULL,
+                          PRIMARY KEY(`flag_id`))""")
+  connection.execute("""CREATE TABLE IF NOT EXISTS "Message" (
+                          `message_id` INTEGER NOT NULL,
+                          `sender_id` INTEGER NOT NULL,
+                          `contents` TEXT NOT NULL,
+                          `timeSent` TEXT NOT NULL,
+                          `recipient_id` INTEGER NOT NULL DEFAULT 1,
+                          `colour` TEXT NOT NULL DEFAULT '#000000',
+                          `edited` INTEGER DEFAULT 0,
+                          PRIMARY KEY(`message_id`))""")
+  connection.execute("INSERT OR IGNORE INTO User(user_id, name, admin) VALUES (1, 'SERVER', 1)") # Sends join/leave messages, owns deleted messages and is everyone's recipient
+
+
+def createIndexes(connection):
+  """ Indexes the columns the hot queries look rows up by, so none of them scan a table. """
+  try:
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS User_name ON User(name)") # Logins and userExists()
+  except sqlite3.IntegrityError: # Existing duplicate usernames; still index them for lookups
+    connection.execute("CREATE INDEX IF NOT EXISTS User_name ON User(name)")
+  connection.execute("CREATE INDEX IF NOT EXISTS Message_sender ON Message(sender_id)") # Message counts
+  connection.execute("CREATE INDEX IF NOT EXISTS Message_recipient ON Message(recipient_id, message_id)") # Whispers to a user, newest first
+  connection.execute("CREATE INDEX IF NOT EXISTS Flag_reportedUser ON Flag(reportedUser_id)") # getUserDetails()
+  connection.execute("CREATE INDEX IF NOT EXISTS Flag_message ON Flag(message_id)") # Reports against a message
+
+
+def createSearchIndex(connection):
+  """
+  Creates the full-text index of message contents.
+  It is an external content FTS5 table, so the text is not stored twice, and triggers keep it in step with Message as part of the database writer's own transactions.
+  """
+  connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS MessageSearch USING fts5(contents, content='Message', content_rowid='message_id')")
+  connection.execute("""CREATE TRIGGER IF NOT EXISTS MessageSearch_insert AFTER INSERT ON Message BEGIN
+                          INSERT INTO MessageSearch(rowid, contents) VALUES (new.message_id, new.contents);
+                        END""")
+  connection.execute("""CREATE TRIGGER IF NOT EXISTS MessageSearch_delete AFTER DELETE ON Message BEGIN
+                          INSERT INTO MessageSearch(MessageSearch, rowid, contents) VALUES ('delete', old.message_id, old.contents);
+                        END""")
+  connection.execute("""CREATE TRIGGER IF NOT EXISTS MessageSearch_update AFTER UPDATE OF contents ON Message BEGIN
+                          INSERT INTO MessageSearch(MessageSearch, rowid, contents) VALUES ('delete', old.message_id, old.contents);
+                          INSERT INTO MessageSearch(rowid, contents) VALUES (new.message_id, new.contents);
+                        END""")
+  connection.execute("INSERT INTO MessageSearch(MessageSearch) VALUES ('rebuild')") # Index the messages sent before search existed
+
+
+MIGRATIONS = [createBaseSchema, createIndexes, createSearchIndex] # Only ever append; a database's user_version is how many of these it has had
+
+
+class ReadPool:
+  """
+  A bounded pool of read only connections to the database.
+  In WAL mode readers never block each other or the writer, so each thread reading at once gets a connection of its own; once every connection is in use, further readers wait for one to be returned.
+
+  Attributes:
+    file (string): The path of the database file.
+    size (int): The most connections that can be open at once.
+    idle (list of sqlite3.Connection): Open connections not currently in use.
+    opened (int): The number of connections opened so far.
+    condition (threading.Condition): Wakes a waiting reader when a connection is returned.
+    checkouts (int): How many times a connection has been taken from the pool.
+    waits (int): How many of those had to wait for a connection to be returned.
+    waitTime (float): The total time spent waiting, in seconds.
+    maxWaitTime (float): The longest time spent waiting, in seconds.
+  """
+  def __init__(self, file, size):
+    """
+    Args:
+      file (string): The path of the database file.
+      size (int): The most connections that can be open at once.
+    """
+    if size < 1:
+      raise ValueError("Pool size must be at least 1")
+    self.file = file
+    self.size = size
+    self.idle = []
+    self.opened = 0
+    self.condition = Condition()
+    self.checkouts = 0
+    self.waits = 0
+    self.waitTime = 0.0
+    self.maxWaitTime = 0.0
+
+
+  def checkout(self):
+    """
+    Takes a connection from the pool, opening a new one if none are idle and the pool is not full, otherwise waiting for one to be returned.
+
+    Returns:
+      (sqlite3.Connection): The connection. Must be given back with checkin().
+    """
+    with self.condition:
+      self.checkouts += 1
+      if len(self.idle) == 0 and self.opened >= self.size:
+        start = time.perf_counter()
+        while len(self.idle) == 0:
+          self.condition.wait()
+        waited = time.perf_counter() - start
+        self.waits += 1
+        self.waitTime += waited
+        self.maxWaitTime = max(self.maxWaitTime, waited)
+      if len(self.idle) > 0:
+        return self.idle.pop() # Most recently used first, as its cache is warmest
+      self.opened += 1
+    try:
+      return sqlite3.connect(f"file:{self.file}?mode=ro", uri=True, check_same_thread=False) # Opened outside the lock; may be used by any thread it is checked out to
+    except Exception:
+      with self.condition:
+        self.opened -= 1
+        self.condition.notify()
+      raise
+
+
+  def checkin(self, connection):
+    """
+    Returns a connection to the pool.
+
+    Args:
+      connection (sqlite3.Connection): A connection from checkout().
+    """
+    if connection.in_transaction:
+      connection.rollback() # End the read transaction, so the connection sees the latest writes next time
+    with self.condition:
+      self.idle.append(connection)
+      self.condition.notify()
+
+
+  @contextmanager
+  def cursor(self):
+    """
+    Checks out a connection for the duration of a with block.
+
+    Yields:
+      (sqlite3.Cursor): A cursor on the checked out connection.
+    """
+    connection = self.checkout()
+    try:
+      yield connection.cursor()
+    finally:
+      self.checkin(connection)
+
+
+  def stats(self):
+    """
+    Gets how the pool is being used.
+
+    Returns:
+      (dict of string: *): The pool size, open and idle connections, checkouts, waits, and total and longest wait times in seconds.
+    """
+    with self.condition:
+      return {"size": self.size, "open": self.opened, "idle": len(self.idle), "checkouts": self.checkouts,
+              "waits": self.waits, "waitTime": self.waitTime, "maxWaitTime": self.maxWaitTime}
+
 
 class Database:
   """
   Contains all methods relating to reading and writing from the database.
 
   Attributes:
-    roConnection (sqlite3.Connection): The main read only database connection. Used for most get functions.
-    roCursor  (sqlite3.Cursor): The cursor for the main read only connection.
+    readPool (ReadPool): The read only connections used by every get function.
+    messages (messageStore.MessageStore): The most recent messages, indexed by id.
     writeQueue (photonUtilities.CircularQueue): The queue used for database write commands in the dbWriter() method.
     writeThread (threading.Thread): The separate thread started for the database writer.
+    file (string): The path of the database file.
+    writeBatchSize (int): The most write commands that are committed in one transaction.
+    nextMessageId (int): The id that will be given to the next message added.
+    messageIdLock (threading.Lock): Guards nextMessageId, messageCounts and pendingDeletes.
+    messageCounts (dict of int: int): How many messages each user id has sent, kept up to date as messages are added and deleted.
+    pendingDeletes (set of int): The ids of deleted messages whose deletion has not been committed yet.
+    loginCache (dict of string: (int, string, bool)): Maps usernames to their user id, password hash and admin status.
+    loginCacheNames (dict of int: string): Maps the user ids in the login cache back to their usernames.
+    loginGeneration (int): Counts invalidations of the login cache.
+    loginInvalidated (dict of string or int: int): The loginGeneration of the last invalidation of each username and user id.
+    loginLock (threading.Lock): Guards loginCache, loginCacheNames, loginGeneration and loginInvalidated.
+    searchEnabled (bool): Whether the full-text index of message contents is available.
+    commitTime (metrics.Histogram): How long each transaction of queued writes takes to execute and commit.
+    writeLatency (metrics.Histogram): How long each write takes from being queued to being committed.
   """
-  def __init__(self, file):
-    """ Initialises the database by creating a read only connection and starting the asyncronous writer function """
+  def __init__(self, file, historyLoadCount=510, messageCacheSize=5000, readPoolSize=8, writeBatchSize=512):
+    """
+    Initialises the database by creating the read only connection pool and starting the asyncronous writer function
+
+    Args:
+      file (string): The path of the database file.
+      historyLoadCount (int, optional): How many of the most recent messages to load into memory.
+      messageCacheSize (int, optional): The most messages kept in memory; older messages are only read from the database when needed.
+      readPoolSize (int, optional): The most read only connections open at once.
+      writeBatchSize (int, optional): The most write commands that are committed in one transaction.
+    """
     try:
-      self.roConnection = sqlite3.connect(f"file:{file}?mode=ro", uri=True) # Load database from file in read only mode
-      self.roCursor = self.roConnection.cursor()
-      self.messages = self.loadMessages()
+      self.file = file
+      self.writeBatchSize = writeBatchSize
+      self.commitTime = Histogram()
+      self.writeLatency = Histogram()
+      connection = sqlite3.connect(file, isolation_level=None) # Transactions are managed by migrate()
+      connection.execute("PRAGMA journal_mode=WAL") # Readers no longer block the writer, and commits only append to the log
+      self.migrate(connection)
+      self.searchEnabled = connection.execute("SELECT 1 FROM sqlite_master WHERE name == 'MessageSearch'").fetchone() != None
+      connection.close()
+      self.readPool = ReadPool(file, readPoolSize)
+      self.messages = MessageStore(messageCacheSize, self.loadMessages(min(historyLoadCount, messageCacheSize)), self.loadMessage)
+      with self.readPool.cursor() as cursor:
+        cursor.execute("SELECT max(message_id) FROM Message")
+        self.nextMessageId = (cursor.fetchall()[0][0] or 0) + 1
+      self.messageIdLock = Lock()
+      self.pendingDeletes = set()
+      with self.readPool.cursor() as cursor:
+        cursor.execute("SELECT sender_id, count(*) FROM Message GROUP BY sender_id") # Counted once here, then kept up to date
+        self.messageCounts = dict(cursor.fetchall())
+      self.loginCache = {}
+      self.loginCacheNames = {}
+      self.loginGeneration = 0
+      self.loginInvalidated = {}
+      self.loginLock = Lock()
       self.writeQueue = CircularQueue(999)
       self.writeThread = Thread(target=self.dbWriter)
       self.writeThread.start()
@@ -30,26 +267,107 @@ class Database:
       reportError()
 
     
+  def migrate(self, connection):
+    """
+    Brings the schema up to date by applying, in order, every migration the database has not had yet.
+    The database's user_version is the number of migrations applied. Each migration is applied in a transaction along with the version bump, so one that fails leaves the database as it was after the last one that succeeded.
+
+    Args:
+      connection (sqlite3.Connection): A writable connection to the database, in autocommit mode.
+
+    Returns:
+      (int): The schema version the database is now at.
+    """
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+      try:
+        connection.execute("BEGIN")
+        MIGRATIONS[number - 1](connection)
+        connection.execute(f"PRAGMA user_version = {number}")
+        connection.execute("COMMIT")
+        version = number
+      except sqlite3.Error as err:
+        connection.rollback()
+        reportError(err)
+        break
+    return version
+
+
   def dbWriter(self): 
     """
     Writes all SQL statements in the queue sequentially as writes to the database must be done one at a time.
+    Every statement queued while the previous transaction was committing is executed in a single transaction, so many writes share one commit.
     Should be run asynchronously.
     """
     try:
-      while True:
-        if not self.writeQueue.isEmpty():
-          connection = sqlite3.connect("photon.db")
-          cursor = connection.cursor()
-          command = self.writeQueue.deQueue()
-          cursor.execute(command[0], command[1]) # Execute SQL command
-          connection.commit() # Save changes to DB
-          cursor.execute("SELECT last_insert_rowid()")
-          if len(command) == 4:
-            self.messages[command[3]].messageId = cursor.fetchall()[0][0]
-          command[2].release()  # Release semaphore flag so the client thread can continue
-          connection.close()
+      connection = sqlite3.connect(self.file, isolation_level=None) # Transactions are managed manually below
+      connection.execute("PRAGMA synchronous=NORMAL") # Safe from corruption in WAL mode; only the last commits can be lost on power failure
+      cursor = connection.cursor()
     except Exception:
       reportError()
+      return
+
+    while True:
+      commands = self.writeQueue.getBatch(self.writeBatchSize) # Sleeps until there is something to write
+      start = time.perf_counter()
+      try:
+        results = []
+        cursor.execute("BEGIN")
+        for command in commands:
+          try:
+            cursor.execute(command.sql, command.params) # Execute SQL command
+            results.append(cursor.lastrowid if command.result == None else command.result)
+          except sqlite3.Error as err: # Only this statement is rolled back; the rest of the transaction is unaffected
+            reportError(err)
+            results.append(err)
+        cursor.execute("COMMIT") # Save changes to DB
+      except Exception as err: # Only this batch is lost; the writer carries on with the next
+        reportError(err)
+        try:
+          connection.rollback()
+        except sqlite3.Error:
+          pass
+        results = [err] * len(commands)
+      committed = time.perf_counter()
+      self.commitTime.observe(committed - start)
+      for command, result in zip(commands, results): # Resolve futures only once committed, so callers never see a result that could still be lost
+        self.writeLatency.observe(committed - command.queued)
+        if not command.future.set_running_or_notify_cancel(): # Nothing is waiting for it any more, eg. the coroutine in awaitWrite() was cancelled
+          continue
+        if isinstance(result, Exception):
+          command.future.set_exception(result)
+        else:
+          command.future.set_result(result)
+
+
+  def write(self, sql, params, result=None):
+    """
+    Queues a statement for the database writer.
+
+    Args:
+      sql (string): The statement to execute.
+      params (tuple): The parameters to bind to the statement.
+      result (*, optional): What the returned future resolves to. Defaults to the rowid of the inserted row.
+
+    Returns:
+      (concurrent.futures.Future): Resolves once the statement has been committed. Call result() on it to wait for durability.
+    """
+    command = WriteCommand(sql, params, result)
+    self.writeQueue.put(command)
+    return command.future
+
+
+  async def awaitWrite(self, future):
+    """
+    Waits for a write to be committed without blocking the event loop.
+
+    Args:
+      future (concurrent.futures.Future): A future returned by one of the write methods.
+
+    Returns:
+      (*): The result of the future.
+    """
+    return await asyncio.wrap_future(future)
 
 
   def queryLogin(self, username, password):
@@ -64,40 +382,173 @@ class Database:
       (bool): True if login successful, False if unsuccessful.
     """
     try:
-      self.roCursor.execute("SELECT * FROM User")
-      users = self.roCursor.fetchall()
-      for user in users: # [0]: id [1]: name [2]: password [3]: admin
-        if user[1] == username and user[2] == password:
-          if user[3] == 1:
-            return (True, user[0], True)
-          else:
-            return (True, user[0], False)
+      user = self.getLoginDetails(username) # [0]: id [1]: password [2]: admin
+      if user != None and user[1] == password:
+        return (True, user[0], user[2])
       return (False)
     except Exception:
       reportError()
 
 
+  def getLoginDetails(self, username):
+    """
+    Gets the details needed to log a user in, from the login cache if possible.
+
+    Args:
+      username (string): the username of the user account to look up.
+
+    Returns:
+      (int, string, bool): The user id, password hash and admin status, or None if there is no such user.
+    """
+    with self.loginLock:
+      user = self.loginCache.get(username)
+      generation = self.loginGeneration
+    if user == None:
+      with self.readPool.cursor() as cursor:
+        cursor.execute("SELECT user_id, password, admin FROM User WHERE name == ?", (username,))
+        row = cursor.fetchone()
+      if row == None:
+        return None
+      user = (row[0], row[1], bool(row[2]))
+      with self.loginLock:
+        if self.loginInvalidated.get(username, 0) <= generation and self.loginInvalidated.get(user[0], 0) <= generation: # Not cached if a write to the user committed while it was being read, as the row read may be from before it
+          self.loginCache[username] = user
+          self.loginCacheNames[user[0]] = username
+    return user
+
+
+  def invalidateLogin(self, username=None, userId=None):
+    """
+    Removes a user from the login cache so their details are read from the database next time, and stops any lookup of the user already under way from caching what it read.
+
+    Args:
+      username (string, optional): The username of the user to remove.
+      userId (int, optional): The id of the user to remove.
+    """
+    with self.loginLock:
+      self.loginGeneration += 1
+      if username == None:
+        userId = int(userId)
+        username = self.loginCacheNames.pop(userId, None)
+      user = self.loginCache.pop(username, None)
+      if user != None:
+        self.loginCacheNames.pop(user[0], None)
+        userId = user[0]
+      for key in (username, userId):
+        if key != None:
+          self.loginInvalidated[key] = self.loginGeneration
+
+
   def loadMessages(self, count=510): # Load last x messages from database
     """
-    Loads the most recent messages from the database, and stores them globally.
+    Loads the most recent messages from the database, along with their senders' names, in a single query.
 
     Args:
       count (int, optional): the amount of messages to load from the database.
+
+    Returns:
+      (list of Message): The messages, oldest first.
     """
     try:
         constructedMessages = []
-        self.roCursor.execute("SELECT * FROM Message limit ? offset (SELECT count(*) FROM Message)-?", (str(count), str(count)))
-        messages = self.roCursor.fetchall()
+        with self.readPool.cursor() as cursor:
+          cursor.execute("""SELECT Recent.message_id, Recent.sender_id, User.name, Recent.contents, Recent.timeSent, Recent.recipient_id, Recent.colour, Recent.edited
+                           FROM (SELECT * FROM Message ORDER BY message_id DESC LIMIT ?) AS Recent
+                           LEFT JOIN User ON User.user_id == Recent.sender_id
+                           ORDER BY Recent.message_id""", (count,))
+          messages = cursor.fetchall()
         for message in messages:
-          self.roCursor.execute("SELECT name FROM User WHERE user_id == ?", (str(message[1]),))
-          username = self.roCursor.fetchall()[0][0]
-          constructedMessage = Message(messageId=message[0], senderId=message[1], senderName=username, contents=message[2], timeSent=message[3], recipientId=message[4], colour=message[5], edited=message[6])
-          constructedMessages.append(constructedMessage)
+          constructedMessages.append(self.constructMessage(message))
         return constructedMessages
     except Exception:
         reportError()
 
 
+  def loadMessage(self, messageId):
+    """
+    Loads a single message from the database.
+
+    Args:
+      messageId (int): The id of the message.
+
+    Returns:
+      (Message): The message, or None if there is no such message.
+    """
+    with self.readPool.cursor() as cursor:
+      cursor.execute("""SELECT Message.message_id, Message.sender_id, User.name, Message.contents, Message.timeSent, Message.recipient_id, Message.colour, Message.edited
+                       FROM Message LEFT JOIN User ON User.user_id == Message.sender_id
+                       WHERE Message.message_id == ?""", (messageId,))
+      message = cursor.fetchone()
+    if message == None:
+      return None
+    return self.constructMessage(message)
+
+
+  def loadHistory(self, userId, beforeId, count):
+    """
+    Loads a page of the messages a user can see that are older than a given message.
+    The message id is used as the cursor, so each page is a single range scan down the primary key however far back it is.
+
+    Args:
+      userId (int): The id of the user.
+      beforeId (int): Only messages with a lower id are loaded.
+      count (int): The most messages to load.
+
+    Returns:
+      (list of Message): The messages, oldest first.
+    """
+    with self.readPool.cursor() as cursor:
+      cursor.execute("""SELECT Page.message_id, Page.sender_id, User.name, Page.contents, Page.timeSent, Page.recipient_id, Page.colour, Page.edited
+                       FROM (SELECT * FROM Message
+                             WHERE message_id < ? AND (recipient_id == 1 OR sender_id == ? OR recipient_id == ?)
+                             ORDER BY message_id DESC LIMIT ?) AS Page
+                       LEFT JOIN User ON User.user_id == Page.sender_id
+                       ORDER BY Page.message_id""", (beforeId, userId, userId, count))
+      messages = cursor.fetchall()
+    return [self.constructMessage(message) for message in messages]
+
+
+  def searchMessages(self, userId, terms, count, offset=0, depth=1000):
+    """
+    Searches the contents of the messages a user can see, best matches first.
+    Only the most recent matches are ranked, so a search for a word in most messages costs no more than one for a rare word; FTS5 can walk matches newest first and stop early, but has to score every candidate it ranks.
+    Deleted messages and server messages are left out.
+
+    Args:
+      userId (int): The id of the user searching.
+      terms (list of string): Words that must all appear in a message.
+      count (int): The most messages to return.
+      offset (int, optional): How many of the best matches to skip, for paging.
+      depth (int, optional): How many of the most recent matches to rank.
+
+    Returns:
+      (list of Message): The matching messages.
+    """
+    query = " ".join('"' + term.replace('"', '""') + '"' for term in terms) # Quote every term so user input cannot be read as FTS5 query syntax
+    with self.readPool.cursor() as cursor:
+      cursor.execute("""SELECT Message.message_id, Message.sender_id, User.name, Message.contents, Message.timeSent, Message.recipient_id, Message.colour, Message.edited
+                       FROM (SELECT rowid, rank FROM MessageSearch WHERE MessageSearch MATCH ? ORDER BY rowid DESC LIMIT ?) AS Recent
+                       JOIN Message ON Message.message_id == Recent.rowid
+                       LEFT JOIN User ON User.user_id == Message.sender_id
+                       WHERE Message.sender_id != 1 AND (Message.recipient_id == 1 OR Message.sender_id == ? OR Message.recipient_id == ?)
+                       ORDER BY Recent.rank LIMIT ? OFFSET ?""", (query, depth, userId, userId, count, offset))
+      messages = cursor.fetchall()
+    return [self.constructMessage(message) for message in messages]
+
+
+  def constructMessage(self, row):
+    """
+    Constructs a message from a row of a query joining Message with its sender's name.
+
+    Args:
+      row (tuple): (message_id, sender_id, name, contents, timeSent, recipient_id, colour, edited)
+
+    Returns:
+      (Message): The constructed message.
+    """
+    return Message(messageId=row[0], senderId=row[1], senderName=row[2] or "", contents=row[3], timeSent=row[4], recipientId=row[5], colour=row[6], edited=row[7])
+
+
   def userExists(self, username):
     """
     Check to see if a user with specific username exists.
@@ -108,8 +559,10 @@ class Database:
     Returns:
       (bool): True if the user exists, False if the user does not.
     """
-    self.roCursor.execute("SELECT name FROM User WHERE name == ?", (username,))
-    if len(self.roCursor.fetchall()) > 0:
+    with self.readPool.cursor() as cursor:
+      cursor.execute("SELECT name FROM User WHERE name == ?", (username,))
+      users = cursor.fetchall()
+    if len(users) > 0:
       return True
     else:
       return False
@@ -125,16 +578,15 @@ class Database:
     ToDo:
       Limit the amount of users that can be fetched at once.
     """
-    connection = sqlite3.connect("file:photon.db?mode=ro", uri=True)
-    cursor = connection.cursor()
-    cursor.execute("SELECT user_id, name, admin FROM User WHERE name != 'SERVER'")
-    users = cursor.fetchall()
-    return users
+    with self.readPool.cursor() as cursor:
+      cursor.execute("SELECT user_id, name, admin FROM User WHERE name != 'SERVER'")
+      return cursor.fetchall()
   
 
   def getUserDetails(self, user):
     """
     Gets the userId, message count, admin and reports for a specific user.
+    The user and all of their reports, with the reported messages and reporters' names, are fetched in a single query.
 
     Args:
       user (string): the username of the user who's info should be fetched.
@@ -143,28 +595,25 @@ class Database:
       (int, int, bool list of (string, string, string, int)): The details of the user, corresponding to (user id, message count, whether admin, list of (reported message, report reason, reporter name, reporter id).
     """
     try:
-      connection = sqlite3.connect("file:photon.db?mode=ro", uri=True)
-      cursor = connection.cursor()
-      cursor.execute("SELECT user_id, admin FROM User WHERE name == ?", (user,))
-      ret = cursor.fetchall()[0]
-      userId = ret[0]
-      admin = bool(ret[1])
-      cursor.execute("SELECT count(*) FROM Message WHERE sender_id == ?", (userId,))
-      messageCount = cursor.fetchall()[0][0]
-      cursor.execute("SELECT * FROM Flag WHERE reportedUser_id == ?", (userId,))
-      flagged = cursor.fetchall()
-      flags = []
-      for flag in flagged:
-        cursor.execute("SELECT contents FROM Message WHERE message_id == ?", (flag[2],))
-        message = cursor.fetchall()[0][0]
-        cursor.execute("SELECT name FROM User WHERE user_id == ?", (flag[3],))      
-        reporterName = cursor.fetchall()[0][0]
-        flags.append((message, flag[4], reporterName, flag[3]))
-                     
+      with self.readPool.cursor() as cursor:
+        cursor.execute("""SELECT User.user_id, User.admin, Flag.flag_id, Message.contents, Flag.reportReason, Reporter.name, Flag.reporter_id
+                          FROM User
+                          LEFT JOIN Flag ON Flag.reportedUser_id == User.user_id
+                          LEFT JOIN Message ON Message.message_id == Flag.message_id
+                          LEFT JOIN User AS Reporter ON Reporter.user_id == Flag.reporter_id
+                          WHERE User.name == ?
+                          ORDER BY Flag.flag_id""", (user,))
+        rows = cursor.fetchall()
+      userId = rows[0][0]
+      admin = bool(rows[0][1])
+      flags = [(row[3] or "", row[4], row[5] or "", row[6]) for row in rows if row[2] != None] # A user with no reports has one row of nulls
+      with self.messageIdLock:
+        messageCount = self.messageCounts.get(userId, 0)
       return (userId, messageCount, admin, flags)
     except Exception:
       reportError()
-  
+
+
   def addUser(self, username, password):
     """
     Creates a new user entry in the database.
@@ -172,49 +621,77 @@ class Database:
     Args:
       username (string): the username of the account to create.
       password (string): the password of the account to create - this should be hashed.
+
+    Returns:
+      (concurrent.futures.Future): Resolves to the id of the new user once committed.
     """
-    semaphore = Semaphore(value=0) # Create a semaphore to be used to signal once the database write has been completed
-    self.writeQueue.enQueue(("INSERT into User(name, password) values (?, ?)", (username, password), semaphore))
-    semaphore.acquire() # Wait until semaphore has been released IE has db write is complete
+    self.invalidateLogin(username=username)
+    future = self.write("INSERT into User(name, password) values (?, ?)", (username, password))
+    future.add_done_callback(lambda future: self.invalidateLogin(username=username)) # In case the user was looked up, and cached, before the write was committed
+    return future
 
 
   def addMessage(self, message):
     """
     Creates a new message entry in the database.
+    The message is given its id straight away, so it can be sent to clients before the write has been committed.
 
     Args:
       message (Message): The instance of message class containing the information that needs to be written.
 
     Returns:
-      
+      (concurrent.futures.Future): Resolves to the message once committed.
     """
-    semaphore = Semaphore(value=0) # Create a semaphore to be used to tell once the database write has been completed
-    self.messages.append(message)
-    messageIndex = len(self.messages) - 1
-    self.writeQueue.enQueue(("INSERT into Message(sender_id, contents, timeSent, recipient_id, colour) values (?,?,?,?,?)", (str(message.senderId), message.contents, message.timeSent, message.recipientId, message.colour), semaphore, messageIndex))
-    semaphore.acquire() # Wait until semaphore has been released IE has db write is complete
-    return self.messages[messageIndex] # Message object will have been updated with it's ID by the DB writer
+    with self.messageIdLock: # Ids are handed out here rather than by SQLite; every message insert goes through this method
+      message.messageId = self.nextMessageId
+      self.nextMessageId += 1
+      self.messageCounts[message.senderId] = self.messageCounts.get(message.senderId, 0) + 1
+      self.messages.add(message)
+    return self.write("INSERT into Message(message_id, sender_id, contents, timeSent, recipient_id, colour) values (?,?,?,?,?,?)", (message.messageId, str(message.senderId), message.contents, message.timeSent, message.recipientId, message.colour), message)
 
   def addReport(self, messageId, reporterId, reportReason):
-    connection = sqlite3.connect("file:photon.db?mode=ro", uri=True)
-    cursor = connection.cursor()
-    cursor.execute("SELECT sender_id FROM Message where message_id == ?", (messageId,))
-    reportedUserId = cursor.fetchall()[0][0]
-    semaphore = Semaphore(value=0) # Create a semaphore to be used to tell once the database write has been completed
-    self.writeQueue.enQueue(("INSERT into Flag(reportedUser_id, message_id, reporter_id, reportReason) values (?,?,?,?)", (reportedUserId, messageId, reporterId, reportReason), semaphore))
-    semaphore.acquire() # Wait until semaphore has been released IE has db write is complete
+    message = self.messages.get(messageId) # Found in memory for recent messages, even if their write has not been committed yet
+    if message == None:
+      future = Future()
+      future.set_exception(ValueError(f"No message with id {messageId} to report"))
+      return future
+    reportedUserId = message.senderId
+    return self.write("INSERT into Flag(reportedUser_id, message_id, reporter_id, reportReason) values (?,?,?,?)", (reportedUserId, messageId, reporterId, reportReason))
 
   def editMessage(self, messageId, newContent):
-    semaphore = Semaphore(value=0) # Create a semaphore to be used to tell once the database write has been completed
-    self.writeQueue.enQueue(("UPDATE Message SET contents=?,edited=? WHERE message_id=?", (newContent, True, messageId), semaphore))
-    semaphore.acquire() # Wait until semaphore has been released IE has db write is complete
+    return self.write("UPDATE Message SET contents=?,edited=? WHERE message_id=?", (newContent, True, messageId))
 
   def deleteMessage(self, messageId):
-    semaphore = Semaphore(value=0) # Create a semaphore to be used to tell once the database write has been completed
-    self.writeQueue.enQueue(("UPDATE Message SET contents=?,sender_id=?,colour=? WHERE message_id=?", ("_message deleted_", 1, INFO, messageId), semaphore))
-    semaphore.acquire() # Wait until semaphore has been released IE has db write is complete
+    """
+    Replaces a message with the deleted message placeholder, which is sent by the server rather than the original sender, in both the message store and the database.
+    The message is moved from its sender's message count to the server's in the same step, so deleting a message twice at once only moves it once.
+
+    Args:
+      messageId (int): The id of the message.
+
+    Returns:
+      (string): The old contents, or None if there is no such message.
+    """
+    with self.messageIdLock:
+      previous = self.messages.delete(messageId)
+      if previous == None: # Not held in memory
+        message = self.loadMessage(messageId) if messageId not in self.pendingDeletes else None # A pending delete has not been committed yet, so the database still shows the original sender
+        previous = (message.contents, message.senderId) if message != None else None
+      if previous != None and previous[1] != 1:
+        self.messageCounts[previous[1]] -= 1
+        self.messageCounts[1] = self.messageCounts.get(1, 0) + 1
+      self.pendingDeletes.add(messageId)
+    future = self.write("UPDATE Message SET contents=?,sender_id=?,colour=? WHERE message_id=?", ("_message deleted_", 1, INFO, messageId))
+    future.add_done_callback(lambda future: self.finishDelete(messageId))
+    return previous[0] if previous != None else None
+
+  def finishDelete(self, messageId):
+    """ Called once a deletion has been committed, after which the database shows the placeholder's sender. """
+    with self.messageIdLock:
+      self.pendingDeletes.discard(messageId)
 
   def setAdmin(self, admin, userId):
-    semaphore = Semaphore(value=0) # Create a semaphore to be used to tell once the database write has been completed
-    self.writeQueue.enQueue(("UPDATE User SET admin=? WHERE user_id=?", (admin, userId), semaphore))
-    semaphore.acquire() # Wait until semaphore has been released IE has db write is complete
+    self.invalidateLogin(userId=userId)
+    future = self.write("UPDATE User SET admin=? WHERE user_id=?", (admin, userId))
+    future.add_done_callback(lambda future: self.invalidateLogin(userId=userId)) # In case the user was looked up, and cached, before the write was committed
+    return future
@@ -0,0 +1,171 @@
+from threading import *
+import atexit
+import struct
+import time
+
+# Load classes and functions from shared libs
+import sys
+sys.path.insert(0, '../Libs')
+from photonUtilities import *
+
+# Event types
+CONNECTEVENT = 1 # value: 0
+DISCONNECTEVENT = 2 # value: 1 if the client was logged in
+REGISTEREVENT = 3 # value: 1 if the account was created
+LOGINEVENT = 4 # value: 1 if the login was valid
+MESSAGEEVENT = 5 # value: the message id
+COMMANDEVENT = 6 # value: 1 if the command succeeded, detail: the command name
+EDITEVENT = 7 # value: the message id
+DELETEEVENT = 8 # value: the message id
+REPORTEVENT = 9 # value: the message id
+
+EVENTNAMES = {CONNECTEVENT: "connect", DISCONNECTEVENT: "disconnect", REGISTEREVENT: "register", LOGINEVENT: "login", MESSAGEEVENT: "message", COMMANDEVENT: "command", EDITEVENT: "edit", DELETEEVENT: "delete", REPORTEVENT: "report"}
+
+MAGIC = b"PHJ\x01" # Starts every journal file, the last byte being the format version
+RECORD = struct.Struct("<BdIiqIB") # event, timestamp, connection id, user id, value, duration in microseconds, detail length; followed by the detail
+MAXDURATION = 2 ** 32 - 1
+
+
+class JournalEvent:
+  """
+  One event read back from a journal.
+
+  Attributes:
+    event (int): The event type, one of the constants above.
+    name (string): The name of the event type.
+    timestamp (float): When the event happened, in seconds since the epoch.
+    connectionId (int): The id of the connection the event happened on.
+    userId (int): The id of the user, or -1 if the connection had not logged in.
+    value (int): The event's value; see the constants above. -1 if a packet gave no id.
+    duration (float): How long the server took to handle the event, in seconds.
+    detail (string): Extra text for the event, if any.
+  """
+  def __init__(self, event, timestamp, connectionId, userId, value, duration, detail):
+    self.event = event
+    self.name = EVENTNAMES.get(event, str(event))
+    self.timestamp = timestamp
+    self.connectionId = connectionId
+    self.userId = userId
+    self.value = value
+    self.duration = duration
+    self.detail = detail
+
+
+class Journal:
+  """
+  An append only binary journal of server events, for working out latency and throughput offline.
+  Each event is one fixed size record plus an optional short detail string. Records are packed on the caller's thread and written in batches by a separate thread.
+
+  Attributes:
+    file (string): The path of the journal, or "" if the journal is disabled.
+    flushInterval (float): The most seconds a record can sit in the file buffer before it is flushed to disk.
+    recordQueue (photonUtilities.CircularQueue): Packed records waiting to be written.
+    writerThread (threading.Thread): The thread that writes queued records.
+    dropped (int): Records thrown away because the queue was full.
+  """
+  BATCHSIZE = 1024 # The most records taken off the queue per write
+
+  def __init__(self, file, flushInterval=1.0, queueSize=65536):
+    """
+    Opens the journal and starts the writer thread.
+
+    Args:
+      file (string): The path of the journal, which is created if it does not exist. Nothing is recorded if "".
+      flushInterval (float, optional): The most seconds a record can sit in the file buffer before it is flushed to disk.
+      queueSize (int, optional): The most records that can be waiting to be written.
+    """
+    self.file = file
+    self.flushInterval = flushInterval
+    self.dropped = 0
+    self.running = True
+    self.recordQueue = CircularQueue(queueSize)
+    self.writerThread = None
+    if file != "":
+      self.writerThread = Thread(target=self.writeRecords, daemon=True)
+      self.writerThread.start()
+      atexit.register(self.close) # Write out anything still queued when the server stops
+
+
+  def record(self, event, connectionId=0, userId=-1, value=0, duration=0, detail=""):
+    """
+    Queues an event to be written. Never blocks; if the writer has fallen too far behind, the event is dropped and counted instead.
+
+    Args:
+      event (int): The event type, one of the constants above.
+      connectionId (int, optional): The id of the connection the event happened on.
+      userId (int, optional): The id of the user, or -1 if the connection has not logged in.
+      value (int, optional): The event's value; see the constants above. Recorded as -1 if "" or None, as packets give for an absent id.
+      duration (float, optional): How long the server took to handle the event, in seconds.
+      detail (string, optional): Extra text for the event. Only the first 255 bytes are kept.
+    """
+    if self.writerThread == None:
+      return
+    if value == "" or value == None:
+      value = -1
+    detail = detail.encode("utf-8")[:255]
+    try:
+      record = RECORD.pack(event, time.time(), connectionId, userId, value, min(int(duration * 1000000), MAXDURATION), len(detail)) + detail
+      self.recordQueue.put(record, block=False)
+    except (ValueError, struct.error): # Queue full, or a value that does not fit the record; never worth failing the caller over
+      self.dropped += 1
+
+
+  def writeRecords(self):
+    """
+    Writes queued records in batches, flushing at most every flushInterval seconds.
+    Should be run asynchronously.
+    """
+    with open(self.file, "ab") as journalFile:
+      if journalFile.tell() == 0:
+        journalFile.write(MAGIC)
+      lastFlush = time.monotonic()
+      while self.running or self.recordQueue.size > 0:
+        records = self.recordQueue.getBatch(self.BATCHSIZE, timeout=self.flushInterval) # Sleeps until there is something to write, or it is time to flush
+        if len(records) > 0:
+          journalFile.write(b"".join(records))
+        now = time.monotonic()
+        if now - lastFlush >= self.flushInterval or len(records) == 0:
+          journalFile.flush()
+          lastFlush = now
+
+
+  def close(self):
+    """ Stops the writer once the queue is empty, and waits for it to finish writing. """
+    self.running = False
+    if self.writerThread != None:
+      self.writerThread.join()
+
+
+def readJournal(file):
+  """
+  Reads every event from a journal, oldest first.
+  A record cut short by the server stopping part way through a write is ignored.
+
+  Args:
+    file (string): The path of the journal.
+
+  Yields:
+    (JournalEvent): Each event in the journal.
+
+  Raises:
+    ValueError: If the file is not a journal, or was written by a newer version.
+  """
+  with open(file, "rb") as journalFile:
+    if journalFile.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f"{file} is not a Photon journal")
+    data = b""
+    while True:
+      chunk = journalFile.read(1048576)
+      if len(chunk) == 0:
+        return
+      data += chunk
+      offset = 0
+      while offset + RECORD.size <= len(data):
+        event, timestamp, connectionId, userId, value, duration, detailLength = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + detailLength
+        if end > len(data): # The rest of the record is in the next chunk
+          break
+        detail = data[offset + RECORD.size:end].decode("utf-8", "replace")
+        yield JournalEvent(event, timestamp, connectionId, userId, value, duration / 1000000, detail)
+        offset = end
+      data = data[offset:]
@@ -0,0 +1,127 @@
+# Filters and summarises the server's event journal.
+# Run from the Server directory, eg.
+#   python journalReader.py journal.bin --event message,command --since "2021-03-19 14:00"
+#   python journalReader.py journal.bin --summary
+#   python journalReader.py journal.bin --event message --throughput 60
+
+import argparse
+import datetime
+import statistics
+
+from journal import *
+
+
+def parseTime(value):
+  """ Accepts either seconds since the epoch or a local date and time such as "2021-03-19 14:00". """
+  try:
+    return float(value)
+  except ValueError:
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def formatTime(timestamp):
+  return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def parseEventTypes(value):
+  """ Turns a comma separated list of event names into a set of event types. """
+  names = {name: event for event, name in EVENTNAMES.items()}
+  eventTypes = set()
+  for name in value.split(","):
+    if name not in names:
+      raise argparse.ArgumentTypeError(f"unknown event type '{name}'")
+    eventTypes.add(names[name])
+  return eventTypes
+
+
+def filterEvents(events, args):
+  """ Yields only the events that match every filter given on the command line. """
+  for event in events:
+    if args.event != None and event.event not in args.event:
+      continue
+    if args.user != None and event.userId != args.user:
+      continue
+    if args.connection != None and event.connectionId != args.connection:
+      continue
+    if args.detail != None and event.detail != args.detail:
+      continue
+    if args.since != None and event.timestamp < args.since:
+      continue
+    if args.until != None and event.timestamp >= args.until:
+      continue
+    yield event
+
+
+def percentile(sortedValues, fraction):
+  return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+def printEvents(events):
+  print(f"{'time':<24}{'event':<12}{'conn':>6}{'user':>8}{'value':>10}{'ms':>10}  detail")
+  for event in events:
+    print(f"{formatTime(event.timestamp):<24}{event.name:<12}{event.connectionId:>6}{event.userId:>8}{event.value:>10}{event.duration * 1000:>10.3f}  {event.detail}")
+
+
+def printSummary(events):
+  """ Prints the count, rate and handling time percentiles of each event type, with commands broken down by name. """
+  durations = {} # Name to list of durations
+  first = None
+  last = None
+  for event in events:
+    first = event.timestamp if first == None else first
+    last = event.timestamp
+    durations.setdefault(event.name, []).append(event.duration)
+    if event.event == COMMANDEVENT:
+      durations.setdefault(f"command {event.detail}", []).append(event.duration)
+
+  if first == None:
+    print("No events")
+    return
+  span = max(last - first, 0.001)
+  print(f"{formatTime(first)} to {formatTime(last)} ({span:.1f}s)")
+  print(f"{'event':<24}{'count':>10}{'per s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'mean ms':>10}")
+  for name in sorted(durations):
+    values = sorted(durations[name])
+    print(f"{name:<24}{len(values):>10}{len(values) / span:>10.2f}{percentile(values, 0.5) * 1000:>10.3f}{percentile(values, 0.9) * 1000:>10.3f}{percentile(values, 0.99) * 1000:>10.3f}{values[-1] * 1000:>10.3f}{statistics.fmean(values) * 1000:>10.3f}")
+
+
+def printThroughput(events, interval):
+  """ Prints how many events of each type happened in every interval of the given number of seconds. """
+  buckets = {} # Bucket start to {name: count}
+  names = set()
+  for event in events:
+    bucket = event.timestamp - event.timestamp % interval
+    counts = buckets.setdefault(bucket, {})
+    counts[event.name] = counts.get(event.name, 0) + 1
+    names.add(event.name)
+
+  names = sorted(names)
+  print(f"{'interval start':<24}" + "".join(f"{name:>12}" for name in names))
+  for bucket in sorted(buckets):
+    print(f"{formatTime(bucket):<24}" + "".join(f"{buckets[bucket].get(name, 0):>12}" for name in names))
+
+
+def __main__():
+  parser = argparse.ArgumentParser(description="Filters and summarises a Photon server event journal.")
+  parser.add_argument("file", help="the journal file, eg. journal.bin")
+  parser.add_argument("--event", type=parseEventTypes, help="only these event types, comma separated: " + ", ".join(EVENTNAMES.values()))
+  parser.add_argument("--user", type=int, help="only events for this user id")
+  parser.add_argument("--connection", type=int, help="only events on this connection id")
+  parser.add_argument("--detail", help="only events with this detail, eg. a command name")
+  parser.add_argument("--since", type=parseTime, help="only events at or after this time")
+  parser.add_argument("--until", type=parseTime, help="only events before this time")
+  parser.add_argument("--summary", action="store_true", help="print counts, rates and handling times per event type instead of the events")
+  parser.add_argument("--throughput", type=float, metavar="SECONDS", help="print event counts per interval of this many seconds instead of the events")
+  args = parser.parse_args()
+
+  events = filterEvents(readJournal(args.file), args)
+  if args.summary:
+    printSummary(events)
+  elif args.throughput != None:
+    printThroughput(events, args.throughput)
+  else:
+    printEvents(events)
+
+
+if __name__ == "__main__":
+  __main__()
@@ -1,37 +1,109 @@
 from threading import *
+import atexit
+import os
+import time
 
 # Load classes and functions from shared libs
 import sys
 sys.path.insert(0, '../Libs')
 from photonUtilities import *
+from metrics import *
 
 class Logger:
     """
     A simple logger to log server actions.
+    Lines are queued by the caller and written in batches by a separate thread, through one buffered file handle, so logging never waits on the disk or the console.
 
-    Attributes:   
+    Attributes:
     logQueue (photonUtilities.CircularQueue): The queue used for log write commands in the logWriter() method.
     logThread (threading.Thread): The separate thread started for the logger.
+    file (string): The path of the log file.
+    consoleLogging (bool): Whether lines are also printed to the console.
+    flushInterval (float): The most seconds a written line can sit in the file buffer before it is flushed to disk.
+    maxBytes (int): The size the log file can reach before it is rotated. Never rotated by size if 0.
+    rotateInterval (float): The most seconds between rotations. Never rotated by time if 0.
+    backupCount (int): How many rotated log files are kept, as log.txt.1 (newest) to log.txt.backupCount (oldest).
+    dropped (int): Lines thrown away since the last write because the queue was full.
+    droppedTotal (int): Lines thrown away since the logger started.
+    writeTime (metrics.Histogram): How long each batch of lines takes to write.
     """
-    def __init__(self):
+    BATCHSIZE = 512 # The most lines taken off the queue per write
+
+    def __init__(self, file="log.txt", consoleLogging=True, flushInterval=1.0, maxBytes=10485760, rotateInterval=86400, backupCount=5, queueSize=8192):
         """" Initialises the logger. """
-        self.logQueue = CircularQueue(999)
-        self.logThread = Thread(target=self.logWriter)
+        self.file = file
+        self.consoleLogging = consoleLogging
+        self.flushInterval = flushInterval
+        self.maxBytes = maxBytes
+        self.rotateInterval = rotateInterval
+        self.backupCount = backupCount
+        self.dropped = 0
+        self.droppedTotal = 0
+        self.writeTime = Histogram()
+        self.running = True
+        self.logQueue = CircularQueue(queueSize)
+        self.logThread = Thread(target=self.logWriter, daemon=True)
         self.logThread.start()
+        atexit.register(self.close) # Write out anything still queued when the server stops
 
     def logWriter(self):
         """
-        Writes all strings in the queue sequentially.
+        Writes all strings in the queue in batches, flushing at most every flushInterval seconds and rotating the file when needed.
         Should be run asynchronously.
         """
-        while True:
-            if not self.logQueue.isEmpty():
-                with open("log.txt", "a+") as logFile:
-                    logFile.write(self.logQueue.deQueue())
+        logFile = open(self.file, "a", encoding="utf-8")
+        opened = time.monotonic()
+        lastFlush = opened
+        while self.running or self.logQueue.size > 0:
+            lines = self.logQueue.getBatch(self.BATCHSIZE, timeout=self.flushInterval) # Sleeps until there is something to write, or it is time to flush
+            start = time.perf_counter()
+            if self.dropped > 0:
+                dropped, self.dropped = self.dropped, 0
+                self.droppedTotal += dropped
+                lines.append(formatDateTime(getDateTime()) + f"Log queue full; dropped {dropped} lines\n")
+            if len(lines) > 0:
+                text = "".join(lines)
+                logFile.write(text)
+                if self.consoleLogging:
+                    sys.stdout.write(text)
+                self.writeTime.observe(time.perf_counter() - start)
+
+            now = time.monotonic()
+            if now - lastFlush >= self.flushInterval or len(lines) == 0:
+                logFile.flush()
+                if self.consoleLogging:
+                    sys.stdout.flush()
+                lastFlush = now
+
+            if (self.maxBytes > 0 and logFile.tell() >= self.maxBytes) or (self.rotateInterval > 0 and now - opened >= self.rotateInterval):
+                logFile.close()
+                self.rotate()
+                logFile = open(self.file, "a", encoding="utf-8")
+                opened = now
+
+        logFile.close()
+        if self.consoleLogging:
+            sys.stdout.flush()
+
+    def rotate(self):
+        """ Renames log.txt to log.txt.1, log.txt.1 to log.txt.2 and so on, deleting the oldest once there are backupCount of them. """
+        if self.backupCount < 1:
+            os.remove(self.file)
+            return
+        for i in range(self.backupCount - 1, 0, -1):
+            if os.path.exists(f"{self.file}.{i}"):
+                os.replace(f"{self.file}.{i}", f"{self.file}.{i + 1}")
+        os.replace(self.file, f"{self.file}.1")
 
     def log(self, message, enabled=True):
-        """ Appends a string to the queue in the correct format. """
+        """ Appends a string to the queue in the correct format. Never blocks; if the writer has fallen too far behind, the line is dropped and counted instead. """
         if enabled:
-            message = formatDateTime(getDateTime()) + message
-            self.logQueue.enQueue(message + "\n")
-            print(message)
+            try:
+                self.logQueue.put(formatDateTime(getDateTime()) + message + "\n", block=False)
+            except ValueError:
+                self.dropped += 1
+
+    def close(self):
+        """ Stops the writer once the queue is empty, and waits for it to finish writing. """
+        self.running = False
+        self.logThread.join()
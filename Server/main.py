@@ -2,8 +2,12 @@
 
 import socket                                         
 from threading import *
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from collections import deque
 import select
 import re
+import time
 
 # Load classes and functions from shared libs
 import sys
@@ -12,19 +16,44 @@ from packets import *
 from photonUtilities import *
 from database import *
 from logger import *
+from journal import *
+from metrics import *
+from outbound import *
+from presence import *
 from configManager import *
 
 
 
 # Global Variables
 
-_clients  = []
+_presence = PresenceRegistry() # Who is connected, and who is logged in where
+_presenceLock = Lock() # Keeps presence deltas and snapshots queued to clients in sequence order
+_presenceDeltaScheduled = False
 _database = None
 _logger = None
+_journal = None
 _configManager = None
+_packetHandlers = Dispatcher() # Packet type to Client method
+_commandHandlers = Dispatcher() # Command name to Client method
+_metrics = MetricsRegistry() # Reported by /stats and the scrape endpoint; metrics of other components are added by registerMetrics()
+_loginTime = _metrics.histogram("login_seconds", "Time from receiving a login request to replying to it")
+_historyBuildTime = _metrics.histogram("history_build_seconds", "Time to build and queue the message history sent on login")
+_historyPageTime = _metrics.histogram("history_page_seconds", "Time to load and queue a page of older messages")
+_addMessageTime = _metrics.histogram("add_message_seconds", "Time for Database.addMessage() to give a message its id and queue the write")
+_fanOutTime = _metrics.histogram("fanout_seconds", "Time to encode a packet and queue it for every logged in client")
+_messagesReceived = _metrics.counter("messages_total", "Messages received from clients")
+_logins = _metrics.counter("logins_total", "Successful logins")
+_failedLogins = _metrics.counter("failed_logins_total", "Rejected logins")
+_framesFannedOut = _metrics.counter("fanout_frames_total", "Frames queued to clients by sendToClients()")
 
 INFOLOGGINGENABLED = None
 MAXTRANSMISSIONSIZE = None
+LOGINHISTORYCOUNT = None
+HISTORYPAGESIZE = None
+SEARCHPAGESIZE = None
+OUTBOUNDQUEUESIZE = None
+SLOWCONSUMERPOLICY = None
+PRESENCEINTERVAL = None
 
 
 
@@ -36,330 +65,737 @@ class Client:
 
   Properties:
     socket (socket.socket): The websocket that this client is connected through.
+    stream (photonUtilities.PacketStream): Frames packets sent and received over the socket.
     address (string): The IP of the connected client.
-    id (int): the id of the connected client (not constant between sessions).
-    thread (threading.thread): The asyncronous listener thread for this client.
+    id (int): the id of the connection, given by _presence (not constant between sessions).
+    listenerThread (threading.thread): The asyncronous listener thread for this client.
+    writerThread (threading.thread): The asyncronous thread that writes queued packets to this client.
+    outbound (outbound.OutboundQueue): Packets waiting to be written to this client.
     username (string): The username of the user.
     userid (int): The id of the user account (constant between sessions).
     admin (bool): Denotes whether the user account is admin.
+    packetReceived (float): The time.perf_counter() at which the packet currently being handled was received.
   """
   def __init__(self, clientSocket, clientAddress):
     """
-    Initialises the connection process, starts asynchronous listener thread and handles login handshake and account creation
+    Initialises the client state. Call start() to begin the login handshake.
 
     Args:
       clientSocket (socket.socket): the websocket that the connection is handled over.
-      clientAddress (string, int): The IP and id of the connected client.
-
-    ToDo:
-      Break this up!
+      clientAddress (string, int): The IP and port of the connected client.
+    """
+    self.socket = clientSocket
+    self.stream = PacketStream(clientSocket, MAXTRANSMISSIONSIZE) if clientSocket != None else None
+    self.address = clientAddress[0]
+    self.id = None
+    self.listenerThread = None
+    self.writerThread = None
+    self.outbound = OutboundQueue(OUTBOUNDQUEUESIZE, SLOWCONSUMERPOLICY)
+    self.username = "UNKNOWN"
+    self.userid = ""
+    self.admin = False
+    self.packetReceived = time.perf_counter()
+    self.id = _presence.connect(self)
+
+
+  def start(self):
+    """ Starts the listener thread, which handles the login handshake before listening for packets, and the writer thread. """
+    self.writerThread = Thread(target=self.writeFrames)
+    self.writerThread.start()
+    self.listenerThread = Thread(target=self.run)
+    self.listenerThread.start()
+
+
+  def run(self):
+    """
+    Handles login handshake and account creation, then listens for packets. Should be called asyncronously in it's own thread.
     """
     try:
-      global _database, _clients
-      self.socket = clientSocket
-      self.address = clientAddress[0]
-      self.id = clientAddress[1]
-      self.thread = None
-      self.username = "UNKNOWN"
-      self.userid = ""
-      self.admin = False
-      _clients.append(self)
+      self.connected()
 
-      _logger.log(f"Received a connection from {self.address}, id {self.id}", INFOLOGGINGENABLED)
+      loggedIn = False
+      while not loggedIn:
+        loggedIn = self.handleLoginPacket(self.receivePacket()) # Wait for client login packet TODO: time this out
+          
+      readyToListenPacket = self.receivePacket() # Wait until the client is ready to receive packets
+      self.completeLogin()
+      self.ListenForPackets()
 
-      # Client Login
-      loginInvalid = True
-      while loginInvalid:
-        loginRequestPacket = decode(self.socket.recv(MAXTRANSMISSIONSIZE)) # Wait for client login packet TODO: time this out
+    except OSError: # Lost connection with client, or it was closed by close()
+      pass
+    except Exception as err: # Eg. a malformed packet; the connection is dropped rather than left logged in with no listener
+      reportError(err, _logger)
+    finally:
+      try:
+        self.disconnect()
+      except Exception as err:
+        reportError(err, _logger)
+      self.socket.close() # Only closed here, so it is never closed while this thread is still reading from it
 
-        if loginRequestPacket.type == "CREATEUSER":
 
-          usernameExists = _database.userExists(loginRequestPacket.username)
+  def receivePacket(self):
+    """
+    Waits for the next packet from the client.
 
-          if usernameExists:
-            userRegistered = RegisterResponsePacket(False, "A user with that name already exists")
+    Returns:
+      (packets.Packet): The received packet.
+    """
+    packet = self.stream.receivePacket()
+    self.packetReceived = time.perf_counter()
+    return packet
 
-          else:
-            _database.addUser(loginRequestPacket.username, loginRequestPacket.password)
-            userRegistered = RegisterResponsePacket(True)
-            _logger.log(f"Attempted to register user: {loginRequestPacket.username}. Successful: {userRegistered.valid}", INFOLOGGINGENABLED)
 
-          self.socket.send(encode(userRegistered))
-        
-        elif loginRequestPacket.type == "LOGINREQUEST":
-          err = "Incorrect username or password"
-          for client in _clients:
-            if client.username == loginRequestPacket.username:
-              valid = False
-              err = "That user is already logged in"
-              break
-            
-          else:              
-            ret = _database.queryLogin(loginRequestPacket.username, loginRequestPacket.password) # Query credentials against database
-            if ret != False:
-              valid = ret[0]
-            else:
-              valid = ret
-            
-          if not valid:
-            _logger.log(f"Invalid login from: {self.address}, id {self.id} - {err}", INFOLOGGINGENABLED)
-            loginResponse = LoginResponsePacket(valid=False, err=err) # Tell the client the login was invalid
-            self.socket.send(encode(loginResponse))
-
-          else:
-            _logger.log(f"Valid login from: {self.address}, id {self.id}", INFOLOGGINGENABLED)
-            loginResponse = LoginResponsePacket(True, userId=ret[1], admin=ret[2]) # Tell the client the login was valid
-            self.socket.send(encode(loginResponse))
-            self.userid = ret[1]
-            self.username = loginRequestPacket.username
-            self.admin = ret[2]
-            loginInvalid = False
-          
-      readyToListenPacket = decode(self.socket.recv(MAXTRANSMISSIONSIZE)) # Wait until the client is ready to receive packets
-
-      # Get as many previous messages as possible that will fit into the max transmision size
-      messagesToSend = []
-      newMessagesToSend = []
-      for message in reversed(_database.messages): # reversed as we want the latest messages
-        if message.recipientId == 1 or message.senderId == self.userid or message.recipientId == self.userid:
-          newMessagesToSend.append(message)
-          if len(encode(newMessagesToSend)) >= MAXTRANSMISSIONSIZE - 200: # We need a buffer of ~200 as when we construct the class the encoded size increases
-            newMessagesToSend = messagesToSend
-            break
-          else:
-            messagesToSend = newMessagesToSend
-      newMessageListPacket = MessageListPacket(reversed(messagesToSend)) # Send the client the previous messages
-      self.socket.send(encode(newMessageListPacket))
-
-      
-      newMessage = generateJoinLeaveMessage("joined", self.username)
-      newMessage = _database.addMessage(newMessage)
-      announceUserPacket = MessagePacket(newMessage) # Client has joined message
-      sendToClients(announceUserPacket)
+  def sendPacket(self, packet):
+    """
+    Sends a packet to this client.
 
-      self.listenerThread = Thread(target=self.ListenForPackets) # Start thread to listen for packets from client
-      self.listenerThread.start()
-
-      sendOnlineUsersPacket() # Tell clients a new user has joined
-
-    except ConnectionResetError: # Lost connection with client
-      _logger.log(f"Lost connection with: {self.address}, id {self.id}; closing connection", INFOLOGGINGENABLED)
-      
-      self.socket.close() # Close socket
-      for i in range(0, len(_clients)):
-        if _clients[i].id == self.id:
-          del _clients[i] # Delete class instance
-          break
-
-      if self.username != "UNKNOWN":
-        newMessage = generateJoinLeaveMessage("left", self.username)
-        newMessage = _database.addMessage(newMessage)
-        announceUserPacket = MessagePacket(newMessage)
-        sendToClients(announceUserPacket)
-        sendOnlineUsersPacket() # Tell clients a user has left
-          
-      return # Return from thread
-    except Exception as err:
-      reportError(err, _logger)
+    Args:
+      packet (packets.Packet): The packet to send.
+    """
+    self.sendFrame(encodeFrame(packet))
 
 
-  def ListenForPackets(self):
+  def sendFrame(self, frame, coalesceKey=None):
     """
-    Listens for all communication from client. Should be called asyncronously in it's own thread.
+    Queues an already encoded packet to be sent to this client. Safe to call from any thread.
 
-    ToDo:
-    Break this up?
+    Args:
+      frame (bytes): The framed packet, as returned by photonUtilities.encodeFrame().
+      coalesceKey (string, optional): Queued packets with the same key supersede each other; see outbound.OutboundQueue.put().
+    """
+    if not self.outbound.put(frame, coalesceKey):
+      _logger.log(f"Outbound queue full for {self.address}, id {self.id}; disconnecting slow client", INFOLOGGINGENABLED)
+      self.close()
+
+
+  def writeFrames(self):
+    """
+    Writes queued packets to the client until the connection is closed. Should be called asyncronously in it's own thread.
     """
     try:
-      global _clients, _database, _logger
       while True:
-        
-        packet = decode(self.socket.recv(MAXTRANSMISSIONSIZE)) # Wait for message from client
-        if packet.type == "MESSAGE":
-          packet.message.timeSent = getDateTime() # Update the message with the time it was received
-          packet.message = _database.addMessage(packet.message)
-          sendToClients(packet)
-          _logger.log(f"{packet.message.senderName}: {packet.message.contents}", INFOLOGGINGENABLED)
-
-        elif packet.type == "COMMAND":
-          command = packet.command
-          args = packet.args
-          success = False
-          err = ""
-          response = ""
-          targetClient = self
-          _logger.log(f"User {self.username}, {self.id} executed command {command} with args {args}", INFOLOGGINGENABLED)
-
-          if command == "help":
-            success = True
-            response = ["!*Available Commands*!",
-                        ("help","provides a list of available commands"),
-                        ("ping","pings the server"),
-                        ("whisper <user> <message>","sends a direct message to <user>"),
-                        ("markup","displays balsamiq markup syntax")
-                        ]
-
-          elif command == "markup":
-            success = True
-            response = ["!*Markup Syntax*!",
-                        "Formats can be combined and symbols can be escaped with '\\'",
-                        ("bold", "*example*", "\*example*"),
-                        ("italic", "_example_", "\_example_"),
-                        ("strikethrough", "~example~", "\~example~"),
-                        ("underline", "!example!", "\!example!")
-                        ]
-          
-          elif command == "ping":
-            success = True
-            response = "Pong!"
-
-          elif command == "whisper":
-            targetName = args[0]
-            del args[0]
-            for client in _clients:
-              if client.username == targetName:
-                targetClient = client
-                success = True
-                message = "_ (Whisper) " + " ".join(args) + "_"
-                response = formatUsername(self.username) + message
-                newMessage = Message(self.userid, self.username, message, getDateTime(), targetClient.userid, INFO)
-                newMessage = _database.addMessage(newMessage)
-                break
-            else:
-              err = f"Could not find user with name {targetName}"
-
-          else:
-            err = "Unrecognised command"
-
-          response = CommandResponsePacket(command, success, err, response, getDateTime())
-          self.socket.send(encode(response))
-          if targetClient != self:
-            targetClient.socket.send(encode(response))
-
-        elif packet.type == "REQUESTUSERLIST":
-          userlist = _database.listUsers()
-          self.socket.send(encode(UserListPacket(userlist)))
-
-        elif packet.type == "REQUESTUSERINFO":
-          userinfo = _database.getUserDetails(packet.user)
-          userInfoPacket = UserInfoPacket(userinfo[0], userinfo[1], userinfo[2], userinfo[3])
-          self.socket.send(encode(userInfoPacket))
-
-        elif packet.type == "REPORTPACKET":
-          _database.addReport(packet.messageId, packet.reporterId, packet.reportReason)
-          _logger.log(f"{self.username} registered report: {packet.reportReason}", INFOLOGGINGENABLED)
-
-        elif packet.type == "EDITMESSAGE":
-          _database.editMessage(packet.messageId, packet.newContents)
-          packet.newContents
-          i = 0
-          oldMessage = None
-          for message in _database.messages:
-            if message.messageId == packet.messageId:
-              oldMessage = _database.messages[i].contents
-              _database.messages[i].contents = packet.newContents
-              _database.messages[i].edited = True
-              break
-            i+=1            
-          sendToClients(packet) # Tell clients that the message has been edited.          
-          _logger.log(f"{self.username} edited message from '{oldMessage}' to '{packet.newContents}'", INFOLOGGINGENABLED)
-
-        elif packet.type == "DELETEMESSAGE":
-          _database.deleteMessage(packet.messageId)
-          i = 0
-          oldMessage = None
-          for message in _database.messages:
-            if message.messageId == packet.messageId:
-              oldMessage = _database.messages[i].contents
-              _database.messages[i].contents = "_message deleted_"
-              _database.messages[i].senderId = 1
-              _database.messages[i].senderName = "SERVER"
-              _database.messages[i].colour = INFO
-              break
-            i+=1            
-          sendToClients(packet) # Tell clients that the message has been deleted.
-          _logger.log(f"{self.username} deleted message: {oldMessage}", INFOLOGGINGENABLED)
-
-        elif packet.type == "SETADMINSTATUS":
-          _database.setAdmin(packet.admin, packet.userId)
-          _logger.log(f"User id {packet.userId} set to admin: {packet.admin}", INFOLOGGINGENABLED)
+        frames = self.outbound.getBatch()
+        if frames == None: # Connection closed
+          return
+        self.stream.sendFrames(frames) # Everything queued since the last write goes out in one call
+    except OSError: # Lost connection with client; the listener thread will tidy up
+      self.close()
+
+
+  def close(self):
+    """ Closes the connection to the client. Safe to call from any thread; the socket itself is closed by the listener thread once it wakes. """
+    self.outbound.close()
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR) # Wakes the listener thread if it is waiting for a packet
+    except OSError: # Already closed
+      pass
+
+
+  def recordEvent(self, event, value=0, detail="", timed=True):
+    """
+    Records an event on this connection in the journal, timed from when the packet being handled was received.
+
+    Args:
+      event (int): The event type, one of the constants in journal.
+      value (int, optional): The event's value; see journal.
+      detail (string, optional): Extra text for the event.
+      timed (bool, optional): False if the event was not caused by a packet, so has no duration.
+    """
+    duration = time.perf_counter() - self.packetReceived if timed else 0
+    _journal.record(event, self.id, self.userid if self.userid != "" else -1, value, duration, detail)
 
-        else:
-          _logger.log(f"Unknown packet received: {packet.type}", INFOLOGGINGENABLED)
-          
-    except ConnectionResetError: # Lost connection with client
-      _logger.log(f"Lost connection with: {self.address}, id {self.id}; closing connection", INFOLOGGINGENABLED)
-      
-      self.socket.close() # Close socket
-      for i in range(0, len(_clients)):
-        if _clients[i].id == self.id:
-          del _clients[i] # Delete class instance
-          break
 
+  def connected(self):
+    """ Logs the new connection, which was registered with _presence when the client was created. """
+    _logger.log(f"Received a connection from {self.address}, id {self.id}", INFOLOGGINGENABLED)
+    self.recordEvent(CONNECTEVENT)
+
+
+  def handleLoginPacket(self, loginRequestPacket):
+    """
+    Handles one packet of the login handshake.
+
+    Args:
+      loginRequestPacket (packets.Packet): Either a RegisterPacket or a LoginRequestPacket.
+
+    Returns:
+      (bool): True once the client has logged in successfully.
+    """
+    if loginRequestPacket.type == "CREATEUSER":
+
+      usernameExists = _database.userExists(loginRequestPacket.username)
+
+      if usernameExists:
+        userRegistered = RegisterResponsePacket(False, "A user with that name already exists")
+
+      else:
+        _database.addUser(loginRequestPacket.username, loginRequestPacket.password).result() # The account must exist before the client tries to log in with it
+        userRegistered = RegisterResponsePacket(True)
+        _logger.log(f"Attempted to register user: {loginRequestPacket.username}. Successful: {userRegistered.valid}", INFOLOGGINGENABLED)
+
+      self.sendPacket(userRegistered)
+      self.recordEvent(REGISTEREVENT, int(userRegistered.valid))
+    
+    elif loginRequestPacket.type == "LOGINREQUEST":
+      err = "Incorrect username or password"
+      if _presence.getByUsername(loginRequestPacket.username) != None:
+        valid = False
+        err = "That user is already logged in"
+        
+      else:              
+        ret = _database.queryLogin(loginRequestPacket.username, loginRequestPacket.password) # Query credentials against database
+        if ret != False:
+          valid = ret[0]
+        else:
+          valid = ret
+        if valid and not _presence.login(self, loginRequestPacket.username, ret[1]): # Logged in on another connection since the check above
+          valid = False
+          err = "That user is already logged in"
+        
+      if not valid:
+        _logger.log(f"Invalid login from: {self.address}, id {self.id} - {err}", INFOLOGGINGENABLED)
+        loginResponse = LoginResponsePacket(valid=False, err=err) # Tell the client the login was invalid
+        self.sendPacket(loginResponse)
+        _failedLogins.inc()
+        _loginTime.observe(time.perf_counter() - self.packetReceived)
+        self.recordEvent(LOGINEVENT, 0)
+
+      else:
+        _logger.log(f"Valid login from: {self.address}, id {self.id}", INFOLOGGINGENABLED)
+        loginResponse = LoginResponsePacket(True, userId=ret[1], admin=ret[2]) # Tell the client the login was valid
+        self.sendPacket(loginResponse)
+        self.userid = ret[1]
+        self.username = loginRequestPacket.username
+        self.admin = ret[2]
+        _logins.inc()
+        _loginTime.observe(time.perf_counter() - self.packetReceived)
+        self.recordEvent(LOGINEVENT, 1)
+        schedulePresenceDelta() # Tell clients a new user has joined
+        return True
+
+    return False
+
+
+  def completeLogin(self):
+    """ Sends the message history to the newly logged in client and announces them to everyone else. """
+    # Get as many previous messages as possible that will fit into the max transmision size
+    start = time.perf_counter()
+    byteBudget = MAXTRANSMISSIONSIZE - len(encode(MessageListPacket([])))
+    messagesToSend = _database.messages.encodedHistory(self.userid, LOGINHISTORYCOUNT, byteBudget)
+    self.sendFrame(encodeMessageListFrame(messagesToSend)) # Send the client the previous messages
+    _historyBuildTime.observe(time.perf_counter() - start)
+
+    newMessage = generateJoinLeaveMessage("joined", self.username)
+    _database.addMessage(newMessage)
+    announceUserPacket = MessagePacket(newMessage) # Client has joined message
+    sendToClients(announceUserPacket)
+
+    sendPresenceSnapshot(self) # Later changes arrive as presence deltas
+
+
+  def disconnect(self):
+    """ Tidies up after the connection to the client has been lost. """
+    _logger.log(f"Lost connection with: {self.address}, id {self.id}; closing connection", INFOLOGGINGENABLED)
+    
+    self.close() # Close socket
+    wasLoggedIn = _presence.disconnect(self, self.username, self.userid)
+    self.recordEvent(DISCONNECTEVENT, int(wasLoggedIn), timed=False)
+    if wasLoggedIn:
       newMessage = generateJoinLeaveMessage("left", self.username)
-      newMessage = _database.addMessage(newMessage)
+      _database.addMessage(newMessage)
       announceUserPacket = MessagePacket(newMessage)
       sendToClients(announceUserPacket)
-      sendOnlineUsersPacket() # Tell clients a user has left
-      
+      schedulePresenceDelta() # Tell clients a user has left
+
+
+  def ListenForPackets(self):
+    """
+    Listens for all communication from client. Should be called asyncronously in it's own thread.
+    """
+    while True:
+      self.handlePacket(self.receivePacket()) # Wait for message from client
+
+
+  def handlePacket(self, packet):
+    """
+    Handles a single packet received from the client once logged in, with the handler registered for its type in _packetHandlers.
+
+    Args:
+      packet (packets.Packet): The packet to handle.
+    """
+    try:
+      handler = _packetHandlers.get(packet.type)
+      if handler == None:
+        _logger.log(f"Unknown packet received: {packet.type}", INFOLOGGINGENABLED)
+      else:
+        handler(self, packet)
+        
+    except ConnectionResetError:
+      raise # Let the caller tidy up the connection
     except Exception as err:
       reportError(err, _logger)
 
 
+  # Packet handlers, registered in _packetHandlers below
+
+  def onMessage(self, packet):
+    packet.message.timeSent = getDateTime() # Update the message with the time it was received
+    start = time.perf_counter()
+    _database.addMessage(packet.message) # Sent without waiting for the write to be committed; the message already has its id
+    _addMessageTime.observe(time.perf_counter() - start)
+    _messagesReceived.inc()
+    sendToClients(packet)
+    _logger.log(f"{packet.message.senderName}: {packet.message.contents}", INFOLOGGINGENABLED)
+    self.recordEvent(MESSAGEEVENT, packet.message.messageId)
+
+
+  def onCommand(self, packet):
+    """ Runs a command with the handler registered for it in _commandHandlers, and sends the response. """
+    command = packet.command
+    args = packet.args
+    _logger.log(f"User {self.username}, {self.id} executed command {command} with args {args}", INFOLOGGINGENABLED)
+
+    handler = _commandHandlers.get(command)
+    if handler == None:
+      success, err, response, targetClient = False, "Unrecognised command", "", self
+    elif len(args) < handler.minArgs:
+      success, err, response, targetClient = False, f"Usage: {handler.usage}", "", self
+    else:
+      success, err, response, targetClient = handler(self, args)
+
+    response = CommandResponsePacket(command, success, err, response, getDateTime())
+    self.sendPacket(response)
+    if targetClient != self:
+      targetClient.sendPacket(response)
+    self.recordEvent(COMMANDEVENT, int(success), command)
+
+
+  def onHistoryRequest(self, packet):
+    pageSize = max(1, min(packet.pageSize, HISTORYPAGESIZE))
+    messages = _database.loadHistory(self.userid, packet.beforeId, pageSize + 1) # One extra to tell whether there are any more
+    hasMore = len(messages) > pageSize
+    messages = messages[-pageSize:]
+    # Drop the oldest messages if the page will not fit into the max transmission size, always keeping at least one so the client can move on
+    size = len(encode(HistoryPacket([], packet.beforeId, hasMore)))
+    for i in range(len(messages) - 1, -1, -1):
+      size += len(encodeMessage(messages[i]))
+      if size > MAXTRANSMISSIONSIZE and i < len(messages) - 1:
+        messages = messages[i + 1:]
+        hasMore = True
+        break
+    self.sendPacket(HistoryPacket(messages, packet.beforeId, hasMore))
+    _historyPageTime.observe(time.perf_counter() - self.packetReceived)
+
+
+  def onOnlineUsersRequest(self, packet):
+    sendPresenceSnapshot(self)
+
+
+  def onUserListRequest(self, packet):
+    userlist = _database.listUsers()
+    self.sendPacket(UserListPacket(userlist))
+
+
+  def onUserInfoRequest(self, packet):
+    userinfo = _database.getUserDetails(packet.user)
+    userInfoPacket = UserInfoPacket(userinfo[0], userinfo[1], userinfo[2], userinfo[3])
+    self.sendPacket(userInfoPacket)
+
+
+  def onReport(self, packet):
+    future = _database.addReport(packet.messageId, packet.reporterId, packet.reportReason)
+    if future.done() and future.exception() != None: # Rejected before being queued, eg. the message does not exist
+      _logger.log(f"{self.username} sent an invalid report: {future.exception()}", INFOLOGGINGENABLED)
+      return
+    _logger.log(f"{self.username} registered report: {packet.reportReason}", INFOLOGGINGENABLED)
+    self.recordEvent(REPORTEVENT, packet.messageId)
+
+
+  def onEditMessage(self, packet):
+    oldMessage = _database.messages.edit(packet.messageId, packet.newContents)
+    _database.editMessage(packet.messageId, packet.newContents)
+    sendToClients(packet) # Tell clients that the message has been edited.          
+    _logger.log(f"{self.username} edited message from '{oldMessage}' to '{packet.newContents}'", INFOLOGGINGENABLED)
+    self.recordEvent(EDITEVENT, packet.messageId)
+
+
+  def onDeleteMessage(self, packet):
+    oldMessage = _database.deleteMessage(packet.messageId)
+    sendToClients(packet) # Tell clients that the message has been deleted.
+    _logger.log(f"{self.username} deleted message: {oldMessage}", INFOLOGGINGENABLED)
+    self.recordEvent(DELETEEVENT, packet.messageId)
+
+
+  def onSetAdminStatus(self, packet):
+    _database.setAdmin(packet.admin, packet.userId)
+    _logger.log(f"User id {packet.userId} set to admin: {packet.admin}", INFOLOGGINGENABLED)
+
+
+  # Command handlers, registered in _commandHandlers below
+  # Each is given the command's arguments and returns (whether it succeeded, error message, response, the other client to send the response to, or self)
+
+  def commandHelp(self, args):
+    response = ["!*Available Commands*!"]
+    response += [(handler.usage, handler.description) for command, handler in _commandHandlers]
+    return True, "", response, self
+
+
+  def commandMarkup(self, args):
+    response = ["!*Markup Syntax*!",
+                "Formats can be combined and symbols can be escaped with '\\'",
+                ("bold", "*example*", "\*example*"),
+                ("italic", "_example_", "\_example_"),
+                ("strikethrough", "~example~", "\~example~"),
+                ("underline", "!example!", "\!example!")
+                ]
+    return True, "", response, self
+
+
+  def commandPing(self, args):
+    return True, "", "Pong!", self
+
+
+  def commandSearch(self, args):
+    page = 1
+    terms = []
+    for arg in args:
+      if re.fullmatch(r"page:\d+", arg):
+        page = max(1, int(arg[5:]))
+      elif arg != "":
+        terms.append(arg)
+    if not _database.searchEnabled:
+      return False, "Search is not available on this server", "", self
+    if len(terms) == 0:
+      return False, "Nothing to search for", "", self
+
+    results = _database.searchMessages(self.userid, terms, SEARCHPAGESIZE, (page - 1) * SEARCHPAGESIZE)
+    if len(results) == 0:
+      response = [f"No results for '{' '.join(terms)}' on page {page}"]
+    else:
+      response = [f"!*Results for '{' '.join(terms)}', page {page}*!"]
+      response += [(message.timeSent, message.senderName, message.contents) for message in results]
+    return True, "", response, self
+
+
+  def commandWhisper(self, args):
+    targetName = args[0]
+    client = _presence.getByUsername(targetName)
+    if client == None:
+      return False, f"Could not find user with name {targetName}", "", self
+    message = "_ (Whisper) " + " ".join(args[1:]) + "_"
+    response = formatUsername(self.username) + message
+    newMessage = Message(self.userid, self.username, message, getDateTime(), client.userid, INFO)
+    _database.addMessage(newMessage)
+    return True, "", response, client
+
+
+  def commandStats(self, args):
+    if not self.admin:
+      return False, "Only admins can view server stats", "", self
+    return True, "", ["!*Server Stats*!"] + _metrics.summary(), self
+
+
+# Handlers for the packets logged in clients send, by packet type
+_packetHandlers.register("MESSAGE", Client.onMessage)
+_packetHandlers.register("COMMAND", Client.onCommand)
+_packetHandlers.register("REQUESTHISTORY", Client.onHistoryRequest)
+_packetHandlers.register("REQUESTONLINEUSERS", Client.onOnlineUsersRequest)
+_packetHandlers.register("REQUESTUSERLIST", Client.onUserListRequest)
+_packetHandlers.register("REQUESTUSERINFO", Client.onUserInfoRequest)
+_packetHandlers.register("REPORTPACKET", Client.onReport)
+_packetHandlers.register("EDITMESSAGE", Client.onEditMessage)
+_packetHandlers.register("DELETEMESSAGE", Client.onDeleteMessage)
+_packetHandlers.register("SETADMINSTATUS", Client.onSetAdminStatus)
+
+# Commands, in the order /help lists them
+_commandHandlers.register("help", Client.commandHelp, usage="help", description="provides a list of available commands")
+_commandHandlers.register("ping", Client.commandPing, usage="ping", description="pings the server")
+_commandHandlers.register("whisper", Client.commandWhisper, minArgs=1, usage="whisper <user> <message>", description="sends a direct message to <user>")
+_commandHandlers.register("search", Client.commandSearch, usage="search <words> [page:<n>]", description="searches the messages you can see")
+_commandHandlers.register("markup", Client.commandMarkup, usage="markup", description="displays balsamiq markup syntax")
+_commandHandlers.register("stats", Client.commandStats, usage="stats", description="shows server performance stats (admin only)")
+
+
+class AsyncClient(Client):
+  """
+  A client connection handled by the asyncio event loop rather than its own thread.
+  Socket reads happen on the event loop; login, history delivery and packet handling run in the loop's executor so that blocking database calls never stall other connections.
+
+  Properties:
+    reader (asyncio.StreamReader): The stream that packets are read from.
+    writer (asyncio.StreamWriter): The stream that packets are written to.
+    loop (asyncio.AbstractEventLoop): The event loop that owns the streams.
+    frameReader (photonUtilities.FrameReader): Reassembles frames from the bytes read.
+    pendingFrames (collections.deque of bytes): Frames that have been read but not yet handled.
+    outboundReady (asyncio.Event): Set when there are frames in the outbound queue for the writer task.
+  """
+  def __init__(self, reader, writer, loop):
+    """
+    Args:
+      reader (asyncio.StreamReader): The stream that packets are read from.
+      writer (asyncio.StreamWriter): The stream that packets are written to.
+      loop (asyncio.AbstractEventLoop): The event loop that owns the streams.
+    """
+    Client.__init__(self, None, writer.get_extra_info("peername"))
+    self.reader = reader
+    self.writer = writer
+    self.loop = loop
+    self.frameReader = FrameReader(MAXTRANSMISSIONSIZE)
+    self.pendingFrames = deque()
+    self.outboundReady = asyncio.Event()
+
+
+  async def run(self):
+    """ Coroutine equivalent of Client.run(). """
+    writerTask = asyncio.create_task(self.writeFramesAsync())
+    try:
+      self.connected()
+
+      loggedIn = False
+      while not loggedIn:
+        loginRequestPacket = await self.receivePacketAsync()
+        loggedIn = await self.loop.run_in_executor(None, self.handleLoginPacket, loginRequestPacket)
+
+      readyToListenPacket = await self.receivePacketAsync() # Wait until the client is ready to receive packets
+      await self.loop.run_in_executor(None, self.completeLogin)
+
+      while True:
+        packet = await self.receivePacketAsync()
+        await self.loop.run_in_executor(None, self.handlePacket, packet) # Awaited so that each client's packets are handled in order
+
+    except (OSError, asyncio.IncompleteReadError): # Lost connection with client
+      pass
+    except Exception as err: # Eg. a malformed packet; the connection is dropped rather than left logged in with no reader
+      reportError(err, _logger)
+    finally:
+      try:
+        await self.loop.run_in_executor(None, self.disconnect)
+      except Exception as err:
+        reportError(err, _logger)
+      self.close()
+      await writerTask
+
+
+  async def writeFramesAsync(self):
+    """ Coroutine equivalent of Client.writeFrames(). """
+    try:
+      while True:
+        await self.outboundReady.wait()
+        self.outboundReady.clear()
+        frames = self.outbound.getBatch(block=False)
+        if frames == None: # Connection closed
+          return
+        if len(frames) > 0:
+          self.writer.write(b"".join(frames))
+          await self.writer.drain() # Only this client's writer waits if its socket buffer is full
+    except OSError: # Lost connection with client; run() will tidy up
+      self.close()
+
+
+  async def receivePacketAsync(self):
+    """
+    Waits for the next packet from the client without blocking the event loop.
+
+    Returns:
+      (packets.Packet): The received packet.
+    """
+    while len(self.pendingFrames) == 0:
+      data = await self.reader.read(RECEIVESIZE)
+      if len(data) == 0: # Stream was closed by the client
+        raise ConnectionResetError()
+      self.pendingFrames.extend(self.frameReader.feed(data))
+    packet = decode(self.pendingFrames.popleft())
+    self.packetReceived = time.perf_counter()
+    return packet
+
+
+  def sendFrame(self, frame, coalesceKey=None):
+    """
+    Queues an already encoded packet to be sent to this client. Safe to call from any thread.
+
+    Args:
+      frame (bytes): The framed packet, as returned by photonUtilities.encodeFrame().
+      coalesceKey (string, optional): Queued packets with the same key supersede each other; see outbound.OutboundQueue.put().
+    """
+    Client.sendFrame(self, frame, coalesceKey)
+    if not self.outboundReady.is_set(): # The writer has not yet been woken for an earlier frame
+      self.loop.call_soon_threadsafe(self.outboundReady.set)
+
+
+  def close(self):
+    """ Closes the connection to the client. Safe to call from any thread. """
+    self.outbound.close()
+    self.loop.call_soon_threadsafe(self.outboundReady.set) # Lets the writer task see the queue has closed
+    self.loop.call_soon_threadsafe(self.writer.transport.abort) # Unlike close(), does not wait for a slow client to read what is buffered, so the reader sees the end of the stream straight away
+
+
 
 # Functions
 
-def sendToClients(packet):
+def sendToClients(packet, coalesceKey=None):
   """
-  Sends a packet to every connected client.
+  Sends a packet to every logged in client.
+  The packet is encoded once and the same frame is queued for every client, so a failure sending to one client does not affect the others.
 
   Args:
     packet (packets.packet): The packet instance to send to the clients.
+    coalesceKey (string, optional): Queued packets with the same key supersede each other; see outbound.OutboundQueue.put().
+  """
+  start = time.perf_counter()
+  try:
+    frame = encodeFrame(packet)
+  except Exception as err:
+    reportError(err, _logger)
+    return
+
+  clients = _presence.loggedIn() # A copy, as clients may disconnect while we are sending
+  for client in clients:
+    try:
+      client.sendFrame(frame, coalesceKey)
+    except OSError: # Client has lost connection; its listener will tidy up after it
+      pass
+    except Exception as err:
+      reportError(err, _logger)
+  _framesFannedOut.inc(len(clients))
+  _fanOutTime.observe(time.perf_counter() - start)
+
+
+def schedulePresenceDelta():
+  """
+  Sends clients every login and logout over the next PRESENCEINTERVAL seconds as a single presence delta.
+  A burst of logins then costs each client one small packet, rather than the full list of online users per login.
   """
+  global _presenceDeltaScheduled
+  with _presenceLock:
+    if _presenceDeltaScheduled:
+      return
+    _presenceDeltaScheduled = True
+  timer = Timer(PRESENCEINTERVAL, sendPresenceDelta)
+  timer.daemon = True
+  timer.start()
+
+
+def sendPresenceDelta():
+  """
+  Sends clients who has logged in and left since the last presence delta.
+  Deltas are never coalesced, as each one builds on the last; a client that misses one asks for the full list instead.
+  """
+  global _presenceDeltaScheduled
   try:
-    global _clients
-    for client in _clients:
-      client.socket.send(encode(packet))    
-  except ConnectionResetError: # Client has lost connection
-    pass    
+    with _presenceLock:
+      _presenceDeltaScheduled = False
+      delta = _presence.takeDelta()
+      if delta != None:
+        sendToClients(PresenceDeltaPacket(delta[0], delta[1], delta[2]))
   except Exception as err:
     reportError(err, _logger)
 
 
-def sendOnlineUsersPacket():
+def sendPresenceSnapshot(client):
   """
-  Constructs and sends a packet containing all users that are online.
+  Sends a client the full list of online users.
+
+  Args:
+    client (Client): The client to send the list to.
   """
   try:
-    global _clients
-    users = []
-    for client in _clients:
-      users.append(client.username)
-    users = stringListMergeSort(users)
-    onlineUsersPacket = OnlineUsersPacket(users)
-    sendToClients(onlineUsersPacket)
+    with _presenceLock:
+      users, sequence = _presence.snapshot()
+      client.sendFrame(encodeFrame(OnlineUsersPacket(users, sequence)), "presence") # Under the coalesce policy, a newer list replaces one still queued
   except Exception as err:
     reportError(err, _logger)
 
 
+def registerMetrics():
+  """
+  Adds the metrics kept by the database, logger, journal, connections and handler registries to _metrics.
+  Called once they have all been created.
+  """
+  _metrics.add("db_commit_seconds", _database.commitTime, "Time to execute and commit each transaction of queued writes")
+  _metrics.add("db_write_latency_seconds", _database.writeLatency, "Time from a write being queued to it being committed")
+  _metrics.gauge("db_write_queue_depth", lambda: _database.writeQueue.size, "Writes waiting for the database writer")
+  _metrics.gauge("db_read_pool", _database.readPool.stats, "Read only connection pool usage", label="stat")
+  _metrics.add("log_write_seconds", _logger.writeTime, "Time to write each batch of log lines")
+  _metrics.gauge("log_queue_depth", lambda: _logger.logQueue.size, "Log lines waiting to be written")
+  _metrics.gauge("log_dropped_total", lambda: _logger.droppedTotal + _logger.dropped, "Log lines dropped because the queue was full")
+  _metrics.gauge("journal_queue_depth", lambda: _journal.recordQueue.size, "Journal events waiting to be written")
+  _metrics.gauge("journal_dropped_total", lambda: _journal.dropped, "Journal events dropped because the queue was full")
+  _metrics.gauge("connections", lambda: len(_presence), "Open connections")
+  _metrics.gauge("logged_in_users", lambda: len(_presence.loggedIn()), "Logged in users")
+  _metrics.gauge("outbound_queue_depth_max", lambda: max([len(client.outbound.frames) for client in _presence.loggedIn()], default=0), "Frames waiting to be written to the slowest logged in client")
+  _metrics.gauge("outbound_dropped_total", lambda: sum(client.outbound.dropped for client in _presence.loggedIn()), "Frames dropped for logged in clients because their queue was full")
+  for name, dispatcher in (("packet", _packetHandlers), ("command", _commandHandlers)):
+    _metrics.gauge(f"{name}_handler_calls_total", lambda dispatcher=dispatcher: {timing[0]: timing[1] for timing in dispatcher.timings()}, f"Calls to each {name} handler", label=name)
+    _metrics.gauge(f"{name}_handler_seconds_total", lambda dispatcher=dispatcher: {timing[0]: timing[2] for timing in dispatcher.timings()}, f"Total time spent in each {name} handler", label=name)
+    _metrics.gauge(f"{name}_handler_max_seconds", lambda dispatcher=dispatcher: {timing[0]: timing[3] for timing in dispatcher.timings()}, f"Longest call to each {name} handler", label=name)
+
+
+def serveAsync(serverSocket):
+  """
+  Accepts and handles every connection on a single asyncio event loop.
+
+  Args:
+    serverSocket (socket.socket): The bound and listening server socket.
+  """
+  async def acceptConnections():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(_configManager.data["executorThreads"])) # Blocking work (mostly database calls) is handed off to these threads
+
+    def onConnection(reader, writer):
+      return AsyncClient(reader, writer, loop).run()
+
+    server = await asyncio.start_server(onConnection, sock=serverSocket, backlog=_configManager.data["listenBacklog"])
+    async with server:
+      await server.serve_forever()
+
+  asyncio.run(acceptConnections())
+
+
+def serveThreaded(serverSocket):
+  """
+  Accepts connections and gives each one its own listener thread.
+
+  Args:
+    serverSocket (socket.socket): The bound and listening server socket.
+  """
+  while True:
+    # Wait for connections
+    clientSocket, clientAddress = serverSocket.accept()
+    newClient = Client(clientSocket, clientAddress)
+    newClient.start()
+
+
 def __main__():
   """
   The main body of the program; it all starts here.
-  Loads database, then listens for connections and assigns them new threads as they come in.
+  Loads database, then listens for connections and hands them to the configured server mode.
   """
   try:
-    global _database, _logger, INFOLOGGINGENABLED, MAXTRANSMISSIONSIZE
-    _logger = Logger()
-
+    global _database, _logger, _journal, _configManager, INFOLOGGINGENABLED, MAXTRANSMISSIONSIZE, LOGINHISTORYCOUNT, HISTORYPAGESIZE, SEARCHPAGESIZE, OUTBOUNDQUEUESIZE, SLOWCONSUMERPOLICY, PRESENCEINTERVAL
     _configManager = ServerConfig("config.json")
+    _logger = Logger(_configManager.data["logFile"], _configManager.data["consoleLogging"], _configManager.data["logFlushInterval"], _configManager.data["logMaxBytes"], _configManager.data["logRotateInterval"], _configManager.data["logBackupCount"])
+    _journal = Journal(_configManager.data["journalFile"], _configManager.data["logFlushInterval"])
+
     INFOLOGGINGENABLED = _configManager.data["infoLoggingEnabled"]
     MAXTRANSMISSIONSIZE = _configManager.data["maxTransmissionSize"]
+    LOGINHISTORYCOUNT = _configManager.data["loginHistoryCount"]
+    HISTORYPAGESIZE = _configManager.data["historyPageSize"]
+    SEARCHPAGESIZE = _configManager.data["searchPageSize"]
+    OUTBOUNDQUEUESIZE = _configManager.data["outboundQueueSize"]
+    SLOWCONSUMERPOLICY = _configManager.data["slowConsumerPolicy"]
+    PRESENCEINTERVAL = _configManager.data["presenceInterval"]
     
     _logger.log("Server started up", INFOLOGGINGENABLED)
 
     _logger.log("Loading Database...", INFOLOGGINGENABLED)
-    _database = Database(_configManager.data["dbFile"])  
-    _database.loadMessages()    
+    _database = Database(_configManager.data["dbFile"], _configManager.data["historyLoadCount"], _configManager.data["messageCacheSize"], _configManager.data["readPoolSize"])
+    registerMetrics()
+    if _configManager.data["metricsPort"] != 0:
+      try:
+        startScrapeServer(_metrics, _configManager.data["metricsPort"])
+        _logger.log(f"Serving metrics at http://127.0.0.1:{_configManager.data['metricsPort']}/metrics", INFOLOGGINGENABLED)
+      except OSError as err: # Eg. the port is in use; chat carries on without the endpoint, and /stats still works
+        _logger.log(f"Could not serve metrics on port {_configManager.data['metricsPort']}: {err}")
     # Create a socket object
     serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
 
@@ -370,14 +806,14 @@ def __main__():
     # Bind to the port
     serverSocket.bind((host, port))
 
-    # Queue up to 5 requests
-    serverSocket.listen(5)                                           
-    _logger.log("Listening for connections...", INFOLOGGINGENABLED)
+    # Queue up to listenBacklog requests
+    serverSocket.listen(_configManager.data["listenBacklog"])
+    _logger.log(f"Listening for connections ({_configManager.data['serverMode']} mode)...", INFOLOGGINGENABLED)
      
-    while True:
-      # Wait for connections
-      clientSocket, clientAddress = serverSocket.accept()
-      newClient = Client(clientSocket, clientAddress)
+    if _configManager.data["serverMode"] == "asyncio":
+      serveAsync(serverSocket)
+    else:
+      serveThreaded(serverSocket)
   except Exception as err:
     reportError(err, _logger)
 
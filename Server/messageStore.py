@@ -0,0 +1,195 @@
+from threading import *
+from collections import deque
+
+# Load classes and functions from shared libs
+import sys
+sys.path.insert(0, '../Libs')
+from photonUtilities import *
+
+class MessageStore:
+  """
+  A bounded, in-memory store of the most recent messages, indexed by message id.
+  Once full, adding a message evicts the oldest one. Every message is also written to the database, so evicted messages are loaded from there if they are asked for again.
+
+  Attributes:
+    slots (list of Message): Ring buffer holding the messages.
+    index (dict of int: int): Maps message ids to their slot.
+    oldest (int): The slot of the oldest message.
+    count (int): The number of messages held.
+    capacity (int): The most messages that can be held.
+    loader (function): Loads an evicted message from the database by id; returns None if there is no such message.
+    lock (threading.Lock): Guards the store between client threads.
+    public (collections.deque of Message): Held messages sent to everyone, oldest first.
+    private (dict of int: collections.deque of Message): Held whispers, oldest first, listed under both the sender's and recipient's user id.
+    slotViews (list of tuple of int): The user ids of the private lists each slot's message was added to, or (None,) for the public list.
+    encoded (dict of int: (bytes, bytes)): Cached photonUtilities.encodeMessageParts() output for held messages.
+  """
+  def __init__(self, capacity, messages=(), loader=None):
+    """
+    Args:
+      capacity (int): The most messages that can be held.
+      messages (list of Message, optional): Messages to start with, oldest first.
+      loader (function, optional): Loads an evicted message from the database by id.
+    """
+    if capacity < 1:
+      raise ValueError("Store size must be at least 1")
+    self.slots = [None] * capacity
+    self.index = {}
+    self.oldest = 0
+    self.count = 0
+    self.capacity = capacity
+    self.loader = loader
+    self.lock = Lock()
+    self.public = deque()
+    self.private = {}
+    self.slotViews = [()] * capacity
+    self.encoded = {}
+    for message in messages:
+      self.add(message)
+
+
+  def add(self, message):
+    """
+    Adds a message, evicting the oldest message if the store is full.
+
+    Args:
+      message (Message): The message to add. Must already have its id.
+    """
+    with self.lock:
+      if self.count == self.capacity:
+        evicted = self.slots[self.oldest]
+        del self.index[evicted.messageId]
+        self.encoded.pop(evicted.messageId, None)
+        for userId in self.slotViews[self.oldest]: # The evicted message is the oldest held, so it is at the front of every list it is in
+          if userId == None:
+            self.public.popleft()
+          else:
+            self.private[userId].popleft()
+            if len(self.private[userId]) == 0:
+              del self.private[userId]
+        self.slots[self.oldest] = None
+        self.slotViews[self.oldest] = ()
+        self.oldest = (self.oldest + 1) % self.capacity
+        self.count -= 1
+      slot = (self.oldest + self.count) % self.capacity
+      self.slots[slot] = message
+      self.index[message.messageId] = slot
+      self.count += 1
+
+      if message.recipientId == 1:
+        self.public.append(message)
+        self.slotViews[slot] = (None,)
+      else:
+        userIds = tuple({message.senderId, message.recipientId})
+        for userId in userIds:
+          self.private.setdefault(userId, deque()).append(message)
+        self.slotViews[slot] = userIds
+
+
+  def get(self, messageId):
+    """
+    Gets a message by id.
+
+    Args:
+      messageId (int): The id of the message.
+
+    Returns:
+      (Message): The message, or None if it does not exist.
+    """
+    with self.lock:
+      slot = self.index.get(messageId)
+      if slot != None:
+        return self.slots[slot]
+    if self.loader != None:
+      return self.loader(messageId)
+    return None
+
+
+  def edit(self, messageId, contents):
+    """
+    Updates the contents of a held message.
+
+    Args:
+      messageId (int): The id of the message.
+      contents (string): The new contents.
+
+    Returns:
+      (string): The old contents, or None if the message is not held.
+    """
+    with self.lock:
+      slot = self.index.get(messageId)
+      if slot == None:
+        return None
+      message = self.slots[slot]
+      oldContents = message.contents
+      message.contents = contents
+      message.edited = True
+      self.encoded.pop(messageId, None)
+      return oldContents
+
+
+  def delete(self, messageId):
+    """
+    Replaces a held message with the deleted message placeholder, as the database does.
+
+    Args:
+      messageId (int): The id of the message.
+
+    Returns:
+      (string, int): The old contents and sender id, or None if the message is not held. The sender id is 1 if the message had already been deleted.
+    """
+    with self.lock:
+      slot = self.index.get(messageId)
+      if slot == None:
+        return None
+      message = self.slots[slot]
+      previous = (message.contents, message.senderId)
+      message.contents = "_message deleted_"
+      message.senderId = 1
+      message.senderName = "SERVER"
+      message.colour = INFO
+      self.encoded.pop(messageId, None)
+      return previous
+
+
+  def encodedHistory(self, userId, count, byteBudget):
+    """
+    Gets the newest messages a user can see, already encoded, in a single pass over the public messages and the user's whispers.
+
+    Args:
+      userId (int): The id of the user.
+      count (int): The most messages to return.
+      byteBudget (int): The most bytes the encoded messages can take up in total.
+
+    Returns:
+      (list of (bytes, bytes)): The messages encoded with photonUtilities.encodeMessageParts(), oldest first.
+    """
+    with self.lock:
+      publicMessages = reversed(self.public)
+      privateMessages = reversed(self.private.get(userId, ()))
+      nextPublic = next(publicMessages, None)
+      nextPrivate = next(privateMessages, None)
+      history = []
+      size = 0
+      while len(history) < count and (nextPublic != None or nextPrivate != None):
+        if nextPrivate == None or (nextPublic != None and nextPublic.messageId > nextPrivate.messageId): # Newest first
+          message = nextPublic
+          nextPublic = next(publicMessages, None)
+        else:
+          message = nextPrivate
+          nextPrivate = next(privateMessages, None)
+
+        encoded = self.encoded.get(message.messageId)
+        if encoded == None:
+          encoded = encodeMessageParts(message)
+          self.encoded[message.messageId] = encoded
+        size += len(encoded[0]) + len(encoded[1])
+        if size > byteBudget:
+          break
+        history.append(encoded)
+      history.reverse()
+      return history
+
+
+  def __len__(self):
+    return self.count
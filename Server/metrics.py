@@ -0,0 +1,269 @@
+from threading import *
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Load classes and functions from shared libs
+import sys
+sys.path.insert(0, '../Libs')
+from photonUtilities import *
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Counter:
+  """
+  A count that only goes up, eg. messages received.
+
+  Attributes:
+    value (int): The current count.
+    lock (threading.Lock): Guards value.
+  """
+  kind = "counter"
+
+  def __init__(self):
+    self.value = 0
+    self.lock = Lock()
+
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+
+  def samples(self):
+    """ Returns (name suffix, labels, value) for each value to report. """
+    return [("", None, self.value)]
+
+
+class Gauge:
+  """
+  A value that can go up and down, eg. a queue's depth. It is read from a function whenever it is reported, so costs nothing until then.
+
+  Attributes:
+    function (function): Returns the current value, or a dict of label value to value if label is set.
+    label (string): The name of the label that tells apart the values function returns, or None for a single value.
+  """
+  kind = "gauge"
+
+  def __init__(self, function, label=None):
+    self.function = function
+    self.label = label
+
+
+  def samples(self):
+    """ Returns (name suffix, labels, value) for each value to report. """
+    if self.label == None:
+      return [("", None, self.function())]
+    return [("", {self.label: key}, value) for key, value in self.function().items()]
+
+
+class Histogram:
+  """
+  Records how long something takes, in the style of an HDR histogram.
+  Times are counted in microsecond buckets that are linear within each power of two, with SUBBUCKETS buckets per power, so any percentile is accurate to within 1 / SUBBUCKETS of the true value at every scale, in a fixed amount of memory.
+
+  Attributes:
+    counts (list of int): How many times fell into each bucket.
+    count (int): How many times have been recorded.
+    sum (float): The total of every time recorded, in seconds.
+    max (float): The longest time recorded, in seconds.
+    lock (threading.Lock): Guards all of the above.
+  """
+  kind = "summary"
+  SUBBITS = 3
+  SUBBUCKETS = 2 ** SUBBITS
+  POWERS = 40 # Enough for times of up to 2 ** 40 microseconds, about 12 days
+
+  def __init__(self):
+    self.counts = [0] * (self.SUBBUCKETS * self.POWERS)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+    self.lock = Lock()
+
+
+  def observe(self, seconds):
+    """
+    Records one time.
+
+    Args:
+      seconds (float): The time taken.
+    """
+    value = int(seconds * 1000000)
+    if value < self.SUBBUCKETS: # Small enough to count exactly
+      index = max(value, 0)
+    else:
+      shift = value.bit_length() - self.SUBBITS - 1 # Keeps the top SUBBITS bits after the leading 1
+      index = min((shift + 1) * self.SUBBUCKETS + (value >> shift) - self.SUBBUCKETS, len(self.counts) - 1)
+    with self.lock:
+      self.counts[index] += 1
+      self.count += 1
+      self.sum += seconds
+      if seconds > self.max:
+        self.max = seconds
+
+
+  def bucketLimit(self, index):
+    """ Returns the largest time in seconds that falls into a bucket. """
+    if index < self.SUBBUCKETS:
+      return index / 1000000
+    shift = index // self.SUBBUCKETS - 1
+    return (((self.SUBBUCKETS + index % self.SUBBUCKETS + 1) << shift) - 1) / 1000000
+
+
+  def percentiles(self, fractions=QUANTILES):
+    """
+    Estimates percentiles of the recorded times.
+
+    Args:
+      fractions (tuple of float, optional): The percentiles to estimate, as fractions between 0 and 1.
+
+    Returns:
+      (list of float): The estimate of each percentile in seconds, or 0 if nothing has been recorded.
+    """
+    with self.lock:
+      counts = list(self.counts)
+      count = self.count
+      maximum = self.max
+    results = []
+    for fraction in fractions:
+      target = max(1, fraction * count)
+      seen = 0
+      result = 0.0
+      for index in range(len(counts)):
+        seen += counts[index]
+        if seen >= target:
+          result = min(self.bucketLimit(index), maximum)
+          break
+      results.append(result if count > 0 else 0.0)
+    return results
+
+
+  def samples(self):
+    """ Returns (name suffix, labels, value) for each value to report. """
+    samples = [("", {"quantile": str(fraction)}, value) for fraction, value in zip(QUANTILES, self.percentiles())]
+    with self.lock:
+      samples += [("_sum", None, self.sum), ("_count", None, self.count), ("_max", None, self.max)]
+    return samples
+
+
+class MetricsRegistry:
+  """
+  Every metric the server reports, by name.
+
+  Attributes:
+    metrics (dict of string: (Counter or Gauge or Histogram, string)): Each metric and its description, in the order they were added.
+  """
+  def __init__(self):
+    self.metrics = {}
+
+
+  def add(self, name, metric, description=""):
+    """
+    Adds a metric, so it is reported.
+
+    Args:
+      name (string): The name to report the metric under, eg. "messages_total".
+      metric (Counter or Gauge or Histogram): The metric.
+      description (string, optional): What the metric measures.
+
+    Returns:
+      (Counter or Gauge or Histogram): The metric.
+    """
+    self.metrics[name] = (metric, description)
+    return metric
+
+
+  def counter(self, name, description=""):
+    return self.add(name, Counter(), description)
+
+
+  def gauge(self, name, function, description="", label=None):
+    return self.add(name, Gauge(function, label), description)
+
+
+  def histogram(self, name, description=""):
+    return self.add(name, Histogram(), description)
+
+
+  def render(self):
+    """
+    Formats every metric in the Prometheus text format.
+
+    Returns:
+      (string): One line per value, each preceded by the metric's description and type.
+    """
+    lines = []
+    for name, (metric, description) in self.metrics.items():
+      try:
+        samples = metric.samples()
+      except Exception as err: # A gauge whose source has gone away should not break the rest
+        reportError(err)
+        continue
+      lines.append(f"# HELP {name} {description}")
+      lines.append(f"# TYPE {name} {metric.kind}")
+      for suffix, labels, value in samples:
+        labelText = "" if labels == None else "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+        lines.append(f"{name}{suffix}{labelText} {value}")
+    return "\n".join(lines) + "\n"
+
+
+  def summary(self):
+    """
+    Summarises every metric in a line each, with times in milliseconds, for people to read.
+
+    Returns:
+      (list of string): The lines.
+    """
+    lines = []
+    for name, (metric, description) in self.metrics.items():
+      try:
+        if isinstance(metric, Histogram):
+          if metric.count > 0:
+            p50, p90, p99, p999 = metric.percentiles()
+            lines.append(f"{name}: n={metric.count} p50={p50 * 1000:.2f}ms p99={p99 * 1000:.2f}ms max={metric.max * 1000:.2f}ms")
+        elif isinstance(metric, Gauge) and metric.label != None:
+          values = metric.function()
+          if len(values) > 0:
+            lines.append(f"{name}: " + ", ".join(f"{key}={formatValue(value)}" for key, value in values.items()))
+        else:
+          lines.append(f"{name}: {formatValue(metric.samples()[0][2])}")
+      except Exception as err:
+        reportError(err)
+    return lines
+
+
+def formatValue(value):
+  return f"{value:.4g}" if isinstance(value, float) else str(value)
+
+
+def startScrapeServer(registry, port):
+  """
+  Serves every metric in the Prometheus text format at http://127.0.0.1:<port>/metrics, on its own thread.
+  Only listens on the loopback interface, so the metrics can only be scraped from the server's own machine.
+
+  Args:
+    registry (MetricsRegistry): The metrics to serve.
+    port (int): The port to listen on.
+
+  Returns:
+    (http.server.ThreadingHTTPServer): The running server.
+  """
+  class ScrapeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path != "/metrics":
+        self.send_error(404)
+        return
+      body = registry.render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args): # Scrapes are too frequent to be worth logging
+      pass
+
+  server = ThreadingHTTPServer(("127.0.0.1", port), ScrapeHandler)
+  server.daemon_threads = True
+  Thread(target=server.serve_forever, daemon=True).start()
+  return server
@@ -0,0 +1,102 @@
+from threading import *
+from collections import deque
+
+# Slow consumer policies, used when a client's outbound queue is full
+DROPOLDEST = "dropOldest" # Discard the oldest queued frame to make room
+COALESCE = "coalesce" # Replace a queued frame with the same coalesce key (eg. an older list of online users), then discard the oldest frame if still full
+DISCONNECT = "disconnect" # Give up on the client
+
+class OutboundQueue:
+  """
+  A bounded queue of frames waiting to be written to one client.
+  Any thread may queue frames; a single writer drains them, so one slow client only ever delays its own frames.
+
+  Attributes:
+    frames (collections.deque of (bytes, string)): The queued frames and their coalesce keys.
+    maxSize (int): The most frames that can be queued at once.
+    policy (string): What to do when a frame is queued while the queue is full. One of DROPOLDEST, COALESCE or DISCONNECT.
+    dropped (int): The number of frames that have been discarded.
+    closed (bool): Whether the queue has been closed.
+    condition (threading.Condition): Wakes the writer when frames are queued.
+  """
+  def __init__(self, maxSize, policy=DROPOLDEST):
+    """
+    Args:
+      maxSize (int): The most frames that can be queued at once.
+      policy (string, optional): What to do when a frame is queued while the queue is full.
+    """
+    if maxSize < 1:
+      raise ValueError("Queue size must be at least 1")
+    if policy not in (DROPOLDEST, COALESCE, DISCONNECT):
+      raise ValueError(f"Unknown slow consumer policy: {policy}")
+    self.frames = deque()
+    self.maxSize = maxSize
+    self.policy = policy
+    self.dropped = 0
+    self.closed = False
+    self.condition = Condition()
+
+
+  def put(self, frame, coalesceKey=None):
+    """
+    Queues a frame to be written.
+
+    Args:
+      frame (bytes): The framed packet.
+      coalesceKey (string, optional): Frames with the same key supersede each other, so only the latest needs to be sent.
+
+    Returns:
+      (bool): False if the queue is full and the policy is to disconnect the client.
+    """
+    with self.condition:
+      if self.closed:
+        return True
+
+      if self.policy == COALESCE and coalesceKey != None:
+        for queued in self.frames:
+          if queued[1] == coalesceKey:
+            self.frames.remove(queued) # Superseded by this frame
+            self.dropped += 1
+            break
+
+      if len(self.frames) >= self.maxSize:
+        if self.policy == DISCONNECT:
+          return False
+        self.frames.popleft()
+        self.dropped += 1
+
+      self.frames.append((frame, coalesceKey))
+      self.condition.notify()
+      return True
+
+
+  def getBatch(self, block=True):
+    """
+    Removes every queued frame.
+
+    Args:
+      block (bool, optional): Whether to wait until there is at least one frame.
+
+    Returns:
+      (list of bytes): The frames in the order they were queued, or None once the queue has been closed.
+    """
+    with self.condition:
+      while block and len(self.frames) == 0 and not self.closed:
+        self.condition.wait()
+      if self.closed:
+        return None
+      frames = [queued[0] for queued in self.frames]
+      self.frames.clear()
+      return frames
+
+
+  def close(self):
+    """ Closes the queue, discarding any frames that have not been written and waking the writer. """
+    with self.condition:
+      self.closed = True
+      self.frames.clear()
+      self.condition.notify_all()
+
+
+  def __len__(self):
+    return len(self.frames)
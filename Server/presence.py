@@ -0,0 +1,177 @@
+from threading import *
+
+class PresenceRegistry:
+  """
+  Keeps track of every connected client, and of who is logged in on which connection.
+  Every lookup, addition and removal is a dictionary operation under one lock, so it is safe to use from any client thread.
+
+  Attributes:
+    connections (dict of int: Client): Every connected client, by connection id.
+    usernames (dict of string: Client): Logged in clients, by username.
+    userIds (dict of int: Client): Logged in clients, by user id.
+    nextConnectionId (int): The id that will be given to the next connection.
+    joined (set of string): Users who have logged in since the last presence delta was taken, and are still logged in.
+    left (set of string): Users who have left since the last presence delta was taken, and have not logged back in.
+    sequence (int): The sequence number of the last presence delta taken.
+    lock (threading.Lock): Guards all of the above.
+  """
+  def __init__(self):
+    self.connections = {}
+    self.usernames = {}
+    self.userIds = {}
+    self.nextConnectionId = 1
+    self.joined = set()
+    self.left = set()
+    self.sequence = 0
+    self.lock = Lock()
+
+
+  def connect(self, client):
+    """
+    Registers a new connection.
+
+    Args:
+      client (Client): The newly connected client.
+
+    Returns:
+      (int): The connection id given to the client, unique for as long as the server runs.
+    """
+    with self.lock:
+      connectionId = self.nextConnectionId
+      self.nextConnectionId += 1
+      self.connections[connectionId] = client
+      return connectionId
+
+
+  def login(self, client, username, userId):
+    """
+    Marks a connected client as logged in, unless that user is already logged in elsewhere.
+    Checking and claiming the username happen together, so two connections logging in as the same user at once cannot both succeed.
+
+    Args:
+      client (Client): The client that is logging in.
+      username (string): The username of the account.
+      userId (int): The id of the account.
+
+    Returns:
+      (bool): False if the user is already logged in.
+    """
+    with self.lock:
+      if username in self.usernames or userId in self.userIds:
+        return False
+      self.usernames[username] = client
+      self.userIds[userId] = client
+      self.left.discard(username) # Only the latest change is sent, even if it undoes an earlier one; a snapshot may have been taken in between
+      self.joined.add(username)
+      return True
+
+
+  def disconnect(self, client, username, userId):
+    """
+    Removes a client that has lost connection. Does nothing if the client has already been removed.
+
+    Args:
+      client (Client): The client to remove.
+      username (string): The username the client logged in as.
+      userId (int): The user id the client logged in as.
+
+    Returns:
+      (bool): True if the client was logged in, so its leaving should be announced.
+    """
+    with self.lock:
+      if self.connections.get(client.id) is client:
+        del self.connections[client.id]
+      if self.usernames.get(username) is not client: # Never logged in, or already removed
+        return False
+      del self.usernames[username]
+      if self.userIds.get(userId) is client:
+        del self.userIds[userId]
+      self.joined.discard(username) # As in login()
+      self.left.add(username)
+      return True
+
+
+  def getByUsername(self, username):
+    """
+    Gets the client logged in as a user.
+
+    Args:
+      username (string): The username of the user.
+
+    Returns:
+      (Client): The client, or None if the user is not logged in.
+    """
+    with self.lock:
+      return self.usernames.get(username)
+
+
+  def getByUserId(self, userId):
+    """
+    Gets the client logged in as a user.
+
+    Args:
+      userId (int): The id of the user.
+
+    Returns:
+      (Client): The client, or None if the user is not logged in.
+    """
+    with self.lock:
+      return self.userIds.get(userId)
+
+
+  def get(self, connectionId):
+    """
+    Gets a client by its connection id.
+
+    Args:
+      connectionId (int): The id of the connection.
+
+    Returns:
+      (Client): The client, or None if it is no longer connected.
+    """
+    with self.lock:
+      return self.connections.get(connectionId)
+
+
+  def loggedIn(self):
+    """
+    Gets every logged in client.
+
+    Returns:
+      (list of Client): A copy, so it can be iterated while clients come and go.
+    """
+    with self.lock:
+      return list(self.usernames.values())
+
+
+  def takeDelta(self):
+    """
+    Gets who has logged in and left since the last delta was taken, and starts collecting the next delta.
+
+    Returns:
+      (list of string, list of string, int): The usernames that joined, the usernames that left and the delta's sequence number, or None if there have been no changes.
+    """
+    with self.lock:
+      if len(self.joined) == 0 and len(self.left) == 0:
+        return None
+      self.sequence += 1
+      delta = (sorted(self.joined), sorted(self.left), self.sequence)
+      self.joined = set()
+      self.left = set()
+      return delta
+
+
+  def snapshot(self):
+    """
+    Gets every logged in username, along with the sequence number of the last delta taken.
+    Users who have joined or left since then are already included, or left out, so applying the next delta on top of the snapshot must ignore users that are already present, or already absent.
+
+    Returns:
+      (list of string, int): The sorted usernames and the sequence number.
+    """
+    with self.lock:
+      return sorted(self.usernames), self.sequence
+
+
+  def __len__(self):
+    return len(self.connections)
@@ -0,0 +1,49 @@
+# Compares the binary wire codec in photonUtilities against pickle.
+# Run from the Tests directory: python codecBenchmark.py
+
+import pickle
+import timeit
+
+import sys
+sys.path.insert(0, '../Libs')
+from packets import *
+from photonUtilities import *
+
+
+def samplePackets():
+  """ Builds one realistic instance of each commonly sent packet type. """
+  message = Message(12, "someuser", "Hey, is anyone around to look at the build?", "19-03-21 14:02", 1, BLACK, 48213)
+  history = [Message(i % 40, f"user{i % 40}", f"Message number {i} with a bit of text in it", "19-03-21 14:02", 1, BLACK, i) for i in range(200)]
+  return [
+    ("MESSAGE", MessagePacket(message)),
+    ("MESSAGELIST (200)", MessageListPacket(history)),
+    ("LOGINREQUEST", LoginRequestPacket("someuser", hashString("password123"))),
+    ("LOGINRESPONSE", LoginResponsePacket(True, userId=12, admin=False)),
+    ("ONLINEUSERS (100)", OnlineUsersPacket([f"user{i}" for i in range(100)])),
+    ("COMMAND", CommandPacket("whisper", ["otheruser", "hello", "there"])),
+    ("COMMANDRESPONSE", CommandResponsePacket("ping", True, response="Pong!", timeSent="19-03-21 14:02")),
+    ("EDITMESSAGE", EditMessagePacket(48213, "Hey, is anyone around?")),
+    ("DELETEMESSAGE", DeleteMessagePacket(48213)),
+  ]
+
+
+def timePerCall(function, argument):
+  """ Returns the best average time of a call in nanoseconds. """
+  timer = timeit.Timer(lambda: function(argument))
+  loops, total = timer.autorange()
+  best = min(timer.repeat(repeat=3, number=loops))
+  return best / loops * 1e9
+
+
+def __main__():
+  print(f"{'packet':<20}{'pickle B':>10}{'codec B':>10}{'pickle enc ns':>15}{'codec enc ns':>15}{'pickle dec ns':>15}{'codec dec ns':>15}")
+  for name, packet in samplePackets():
+    pickled = pickle.dumps(packet)
+    encoded = encode(packet)
+    print(f"{name:<20}{len(pickled):>10}{len(encoded):>10}"
+          f"{timePerCall(pickle.dumps, packet):>15.0f}{timePerCall(encode, packet):>15.0f}"
+          f"{timePerCall(pickle.loads, pickled):>15.0f}{timePerCall(decode, encoded):>15.0f}")
+
+
+if __name__ == "__main__":
+   __main__()
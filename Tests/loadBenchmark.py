@@ -0,0 +1,200 @@
+# Starts a server against a fresh database and drives simulated users at it, reporting delivery latency, throughput and server memory.
+# Run from the Tests directory: python loadBenchmark.py [--users 50] [--rate 200] [--seconds 10] [--mode threaded] [--json results.json]
+# Every message is delivered to every user, so the server handles users * rate deliveries per second.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from threading import *
+
+from loadBot import *
+
+SERVERDIRECTORY = os.path.abspath("../Server")
+LIBSDIRECTORY = os.path.abspath("../Libs")
+WHISPERS = 0.02 # The fraction of a bot's actions that are whispers to another bot
+EDITS = 0.02 # ...edits of its last message
+DELETES = 0.01 # ...and deletions of its last message, the rest being timed messages to everyone
+
+
+def freePort():
+  with socket.socket() as probe:
+    probe.bind(("", 0))
+    return probe.getsockname()[1]
+
+
+def startServer(directory, mode):
+  """
+  Starts Server/main.py in a directory of its own, so its database, log and journal are created there.
+
+  Args:
+    directory (string): The directory to run the server in.
+    mode (string): The server mode, "threaded" or "asyncio".
+
+  Returns:
+    (subprocess.Popen, int): The server process and the port it listens on.
+  """
+  port = freePort()
+  config = {"dbFile": "bench.db", "port": port, "serverMode": mode, "consoleLogging": False, "metricsPort": 0}
+  with open(os.path.join(directory, "config.json"), "w") as configFile:
+    json.dump(config, configFile)
+  environment = dict(os.environ, PYTHONPATH=os.pathsep.join([LIBSDIRECTORY, SERVERDIRECTORY]))
+  output = open(os.path.join(directory, "server.out"), "w")
+  server = subprocess.Popen([sys.executable, os.path.join(SERVERDIRECTORY, "main.py")], cwd=directory, env=environment, stdout=output, stderr=subprocess.STDOUT)
+
+  deadline = time.monotonic() + 30 # Migrations run on startup
+  while time.monotonic() < deadline:
+    if server.poll() != None:
+      raise RuntimeError(f"Server exited during startup; see {os.path.join(directory, 'server.out')}")
+    try:
+      socket.create_connection((socket.gethostname(), port), timeout=1).close()
+      return server, port
+    except OSError:
+      time.sleep(0.1)
+  server.kill()
+  raise RuntimeError("Server did not start listening in time")
+
+
+def residentMemory(pid):
+  """ Returns a process's resident set size in bytes, or None where /proc is not available. """
+  try:
+    with open(f"/proc/{pid}/status") as status:
+      for line in status:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    return None
+
+
+def drive(bot, bots, interval, stopTime, counts):
+  """
+  Has one bot act every interval seconds until stopTime, mostly sending timed messages.
+  Acts on a fixed schedule rather than sleeping between actions, so a slow server does not lower the offered rate.
+  """
+  nextTime = time.perf_counter() + random.uniform(0, interval) # Spread the bots' actions out
+  sent = 0
+  while nextTime < stopTime:
+    delay = nextTime - time.perf_counter()
+    if delay > 0:
+      time.sleep(delay)
+    action = random.random()
+    if action < WHISPERS:
+      bot.whisper(random.choice(bots).username, "psst")
+    elif action < WHISPERS + EDITS:
+      bot.editLast("edited")
+    elif action < WHISPERS + EDITS + DELETES:
+      bot.deleteLast()
+    else:
+      bot.send()
+      sent += 1
+    nextTime += interval
+  counts[bot.number] = sent
+
+
+def percentile(sortedValues, fraction):
+  if len(sortedValues) == 0:
+    return 0.0
+  return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+def run(users, rate, seconds, mode):
+  """
+  Runs one benchmark.
+
+  Args:
+    users (int): The number of simulated users.
+    rate (float): The total actions per second, shared evenly between the users.
+    seconds (float): How long to send for.
+    mode (string): The server mode, "threaded" or "asyncio".
+
+  Returns:
+    (dict of string: *): The results.
+  """
+  directory = tempfile.mkdtemp()
+  server, port = startServer(directory, mode)
+  bots = []
+  try:
+    host = socket.gethostname()
+    loginTimes = []
+    for i in range(users):
+      bot = LoadBot(i, f"bench{i}", host, port)
+      bot.register()
+      loginTimes.append(bot.login())
+      bots.append(bot)
+    time.sleep(1) # Let the join announcements settle
+    idleMemory = residentMemory(server.pid)
+
+    peakMemory = [idleMemory or 0]
+    sampling = Event()
+    def sampleMemory():
+      while not sampling.wait(0.25):
+        peakMemory[0] = max(peakMemory[0], residentMemory(server.pid) or 0)
+    Thread(target=sampleMemory, daemon=True).start()
+
+    counts = [0] * users
+    start = time.perf_counter()
+    stopTime = start + seconds
+    drivers = [Thread(target=drive, args=(bot, bots, users / rate, stopTime, counts)) for bot in bots]
+    for driver in drivers:
+      driver.start()
+    for driver in drivers:
+      driver.join()
+    sendTime = time.perf_counter() - start
+
+    expected = sum(counts) * users # Every message goes to every user, its sender included
+    deadline = time.perf_counter() + 10
+    while sum(len(bot.latencies) for bot in bots) < expected and time.perf_counter() < deadline: # Wait for the backlog to drain
+      time.sleep(0.1)
+    sampling.set()
+    drainTime = time.perf_counter() - start
+
+    latencies = sorted(latency for bot in bots for latency in bot.latencies)
+    loginTimes.sort()
+    return {
+      "users": users, "rate": rate, "seconds": seconds, "mode": mode,
+      "sent": sum(counts), "delivered": len(latencies), "expected": expected,
+      "sentPerSecond": sum(counts) / sendTime, "deliveredPerSecond": len(latencies) / drainTime,
+      "latencyP50": percentile(latencies, 0.5), "latencyP99": percentile(latencies, 0.99), "latencyMax": latencies[-1] if len(latencies) > 0 else 0.0,
+      "loginP50": percentile(loginTimes, 0.5), "loginP99": percentile(loginTimes, 0.99),
+      "idleMemory": idleMemory, "peakMemory": peakMemory[0] or None,
+    }
+  finally:
+    for bot in bots:
+      bot.close()
+    server.terminate()
+    server.wait()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def formatMemory(size):
+  return "n/a" if size == None else f"{size / 1048576:.1f} MB"
+
+
+def __main__():
+  parser = argparse.ArgumentParser(description="Benchmarks a Photon server end to end with simulated users.")
+  parser.add_argument("--users", type=int, default=50, help="simulated users (default 50)")
+  parser.add_argument("--rate", type=float, default=200, help="messages per second sent by all users together (default 200)")
+  parser.add_argument("--seconds", type=float, default=10, help="how long to send for (default 10)")
+  parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded", help="server mode (default threaded)")
+  parser.add_argument("--json", metavar="FILE", help="also save the results to this file, to compare against later")
+  args = parser.parse_args()
+
+  results = run(args.users, args.rate, args.seconds, args.mode)
+  print(f"{results['users']} users, {results['mode']} server, {results['rate']:g} msgs/s offered for {results['seconds']:g}s")
+  print(f"Logins:     p50 {results['loginP50'] * 1000:.2f}ms  p99 {results['loginP99'] * 1000:.2f}ms")
+  print(f"Sent:       {results['sent']} messages, {results['sentPerSecond']:.1f} msgs/s")
+  print(f"Delivered:  {results['delivered']} of {results['expected']}, {results['deliveredPerSecond']:.1f} deliveries/s")
+  print(f"Latency:    p50 {results['latencyP50'] * 1000:.2f}ms  p99 {results['latencyP99'] * 1000:.2f}ms  max {results['latencyMax'] * 1000:.2f}ms")
+  print(f"Server RSS: {formatMemory(results['idleMemory'])} idle, {formatMemory(results['peakMemory'])} peak")
+  if args.json != None:
+    with open(args.json, "w") as jsonFile:
+      json.dump(results, jsonFile, indent=2)
+
+
+if __name__ == "__main__":
+  __main__()
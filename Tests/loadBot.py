@@ -0,0 +1,160 @@
+# A headless client that speaks the real protocol, for load testing the server without PyQt5 or a display.
+# Used by loadBenchmark.py, or run on its own from the Tests directory against a running server to try every operation once:
+#   python loadBot.py <username> [host] [port]
+
+import socket
+import time
+from collections import deque
+from threading import *
+
+import sys
+sys.path.insert(0, '../Libs')
+from packets import *
+from photonUtilities import *
+
+BENCHPREFIX = "bench" # Starts the contents of every timed message, followed by the sender's bot number and the time it was sent
+
+
+class LoadBot:
+  """
+  One simulated user. Packets from the server are read by a receiver thread, which times the delivery of every timed message.
+  Times are time.perf_counter() values, so delivery latency can only be measured between bots in the same process.
+
+  Attributes:
+    number (int): Identifies the bot within a benchmark.
+    username (string): The username the bot registers and logs in with.
+    socket (socket.socket): The connection to the server.
+    stream (photonUtilities.PacketStream): Frames packets sent and received over the socket.
+    userId (int): The id of the bot's account, once logged in.
+    latencies (list of float): The delivery latency, in seconds, of every timed message received.
+    received (dict of string: int): How many packets of each type have been received.
+    ownMessageIds (collections.deque of int): The ids of the bot's recent messages, for editing and deleting.
+    receiverThread (threading.Thread): Reads packets from the server once logged in.
+  """
+  def __init__(self, number, username, host, port):
+    """
+    Connects to the server.
+
+    Args:
+      number (int): Identifies the bot within a benchmark.
+      username (string): The username to register and log in with.
+      host (string): The server's host name.
+      port (int): The server's port.
+    """
+    self.number = number
+    self.username = username
+    self.socket = socket.create_connection((host, port))
+    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.stream = PacketStream(self.socket)
+    self.userId = None
+    self.latencies = []
+    self.received = {}
+    self.ownMessageIds = deque(maxlen=100)
+    self.receiverThread = None
+
+
+  def register(self, password="password"):
+    """ Creates the bot's account. Returns whether it was created. """
+    self.stream.sendPacket(RegisterPacket(self.username, hashString(password)))
+    return self.stream.receivePacket().valid
+
+
+  def login(self, password="password"):
+    """
+    Logs in, waits for the message history, then starts the receiver thread.
+
+    Returns:
+      (float): How long the login took, in seconds, up to receiving the history.
+
+    Raises:
+      ValueError: If the login is rejected.
+    """
+    start = time.perf_counter()
+    self.stream.sendPacket(LoginRequestPacket(self.username, hashString(password)))
+    response = self.stream.receivePacket()
+    if not response.valid:
+      raise ValueError(f"Login failed for {self.username}: {response.err}")
+    self.userId = response.id
+    self.stream.sendPacket(Packet("READYTOLISTEN"))
+    while self.stream.receivePacket().type != "MESSAGELIST": # Announcements of other bots may arrive first
+      pass
+    elapsed = time.perf_counter() - start
+    self.receiverThread = Thread(target=self.receive, daemon=True)
+    self.receiverThread.start()
+    return elapsed
+
+
+  def receive(self):
+    """ Reads every packet from the server until the connection closes. Should be run asynchronously. """
+    try:
+      while True:
+        packet = self.stream.receivePacket()
+        self.received[packet.type] = self.received.get(packet.type, 0) + 1
+        if packet.type == "MESSAGE":
+          message = packet.message
+          if message.contents.startswith(BENCHPREFIX):
+            self.latencies.append(time.perf_counter() - float(message.contents.split(" ", 3)[2]))
+          if message.senderId == self.userId:
+            self.ownMessageIds.append(message.messageId)
+    except (OSError, ConnectionResetError, ValueError): # Closed, either by us or by the server
+      pass
+
+
+  def send(self, text=""):
+    """ Sends a timed message to everyone. """
+    self.stream.sendPacket(MessagePacket(Message(self.userId, self.username, f"{BENCHPREFIX} {self.number} {time.perf_counter()!r} {text}")))
+
+
+  def whisper(self, username, text):
+    self.stream.sendPacket(CommandPacket("whisper", [username, text]))
+
+
+  def editLast(self, newContents):
+    """ Edits the bot's most recent message. Returns False if it has not had one delivered yet. """
+    if len(self.ownMessageIds) == 0:
+      return False
+    self.stream.sendPacket(EditMessagePacket(self.ownMessageIds[-1], newContents))
+    return True
+
+
+  def deleteLast(self):
+    """ Deletes the bot's most recent message. Returns False if it has not had one delivered yet. """
+    if len(self.ownMessageIds) == 0:
+      return False
+    self.stream.sendPacket(DeleteMessagePacket(self.ownMessageIds.pop()))
+    return True
+
+
+  def close(self):
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self.socket.close()
+    if self.receiverThread != None:
+      self.receiverThread.join(1)
+
+
+def __main__():
+  username = sys.argv[1]
+  host = sys.argv[2] if len(sys.argv) > 2 else socket.gethostname()
+  port = int(sys.argv[3]) if len(sys.argv) > 3 else 9998
+
+  bot = LoadBot(0, username, host, port)
+  print(f"Registered: {bot.register()}")
+  loginTime = bot.login()
+  print(f"Logged in as user {bot.userId} in {loginTime * 1000:.2f}ms")
+  bot.send("hello")
+  time.sleep(0.5)
+  print(f"Message delivered back in {bot.latencies[0] * 1000:.2f}ms" if len(bot.latencies) > 0 else "Message was not delivered")
+  bot.whisper(username, "hello to myself")
+  print(f"Edited: {bot.editLast('hello again')}")
+  time.sleep(0.2)
+  print(f"Deleted: {bot.deleteLast()}")
+  time.sleep(0.2)
+  bot.close()
+  print(f"Received: {bot.received}")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,112 @@
+# Checks that presence deltas keep every client's list of online users right, including clients whose full list was taken between two changes to the same user.
+# Exits with status 1 if any list goes wrong.
+# Run from the Tests directory: python presenceCheck.py
+
+from bisect import bisect_left
+
+import sys
+sys.path.insert(0, '../Server')
+from presence import *
+
+
+class FakeClient:
+  def __init__(self, registry):
+    self.id = registry.connect(self)
+
+
+class ListView:
+  """ A client's list of online users, updated the way Client/main.py does it. """
+  def __init__(self, snapshot):
+    self.users, self.sequence = snapshot
+
+  def apply(self, delta):
+    joined, left, sequence = delta
+    if sequence <= self.sequence: # Already included in the full list
+      return
+    assert sequence == self.sequence + 1, "missed a delta"
+    self.sequence = sequence
+    for username in left:
+      index = bisect_left(self.users, username)
+      if index < len(self.users) and self.users[index] == username:
+        del self.users[index]
+    for username in joined:
+      index = bisect_left(self.users, username)
+      if index == len(self.users) or self.users[index] != username:
+        self.users.insert(index, username)
+
+
+def run(events):
+  """
+  Plays a list of events, with carol already logged in, taking a snapshot for a new client before every event and a delta at the end.
+
+  Args:
+    events (list of (string, string)): ("login" or "logout", username) pairs.
+
+  Returns:
+    (list of string): A description of each client whose list ended up wrong.
+  """
+  registry = PresenceRegistry()
+  clients = {"carol": FakeClient(registry)}
+  registry.login(clients["carol"], "carol", hash("carol")) # Already online before the events
+  registry.takeDelta()
+  views = []
+  for action, username in events:
+    views.append(ListView(registry.snapshot()))
+    if action == "login":
+      clients[username] = FakeClient(registry)
+      registry.login(clients[username], username, hash(username))
+    else:
+      registry.disconnect(clients.pop(username), username, hash(username))
+  views.append(ListView(registry.snapshot()))
+
+  delta = registry.takeDelta()
+  expected, sequence = registry.snapshot()
+  failures = []
+  for i in range(len(views)):
+    view = views[i]
+    if delta != None:
+      view.apply(delta)
+    if view.users != expected or view.sequence != sequence:
+      failures.append(f"snapshot {i} shows {view.users}, should be {expected}")
+  return failures
+
+
+CASES = {
+  "login": [("login", "alice")],
+  "login then logout": [("login", "alice"), ("login", "bob"), ("logout", "alice")],
+  "logout then login": [("logout", "carol"), ("login", "carol")],
+  "login, logout and login": [("login", "alice"), ("logout", "alice"), ("login", "alice")],
+  "logout, login and logout": [("login", "bob"), ("logout", "carol"), ("login", "carol"), ("logout", "carol"), ("logout", "bob")],
+}
+
+
+def __main__():
+  failures = 0
+  for name, events in CASES.items():
+    results = run(events)
+    if len(results) > 0:
+      print(f"FAIL {name}: " + "; ".join(results))
+      failures += 1
+    else:
+      print(f"ok   {name}")
+
+  # The reported case: a new client's snapshot holds alice, then she logs out in the same interval as bob logs in
+  registry = PresenceRegistry()
+  alice, bob = FakeClient(registry), FakeClient(registry)
+  registry.login(alice, "alice", 1)
+  view = ListView(registry.snapshot())
+  registry.disconnect(alice, "alice", 1)
+  registry.login(bob, "bob", 2)
+  view.apply(registry.takeDelta())
+  if view.users != ["bob"]:
+    print(f"FAIL snapshot between login and logout: shows {view.users}, should be ['bob']")
+    failures += 1
+  else:
+    print("ok   snapshot between login and logout")
+
+  print(f"{failures} presence checks failed" if failures > 0 else "All presence checks passed")
+  return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+  sys.exit(__main__())
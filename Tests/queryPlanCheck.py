@@ -0,0 +1,94 @@
+# Checks that none of the server's hot read queries scan a whole table, using EXPLAIN QUERY PLAN.
+# Exits with status 1 if any do, eg. after an index is dropped or a query is rewritten so it can no longer use one.
+# Run from the Tests directory: python queryPlanCheck.py
+
+import os
+import tempfile
+
+import sys
+sys.path.insert(0, '../Libs')
+sys.path.insert(0, '../Server')
+from photonUtilities import *
+from database import *
+
+TABLES = ("User", "Message", "Flag")
+
+
+def populate(database):
+  """ Adds a few users, messages, whispers and reports, so every query has something to find. """
+  alice = database.addUser("alice", hashString("pw")).result()
+  bob = database.addUser("bob", hashString("pw")).result()
+  for i in range(50):
+    database.addMessage(Message(alice, "alice", f"hello number {i}", getDateTime()))
+    database.addMessage(Message(bob, "bob", f"whisper number {i}", getDateTime(), alice))
+  database.addReport(3, bob, "rude").result()
+  return alice, bob
+
+
+def hotQueries(database, alice):
+  """
+  The read methods to check, and the tables each is expected to scan.
+  loadMessages() reads the newest rows straight off the end of the primary key and listUsers() lists every user, so their scans are intended.
+  """
+  return [
+    ("queryLogin", lambda: database.queryLogin("alice", hashString("pw")), ()),
+    ("userExists", lambda: database.userExists("bob"), ()),
+    ("loadMessage", lambda: database.loadMessage(3), ()),
+    ("loadMessages", lambda: database.loadMessages(10), ("Message",)),
+    ("loadHistory", lambda: database.loadHistory(alice, 40, 10), ()),
+    ("searchMessages", lambda: database.searchMessages(alice, ["hello"], 10), ()),
+    ("getUserDetails", lambda: database.getUserDetails("alice"), ()),
+    ("listUsers", lambda: database.listUsers(), ("User",)),
+  ]
+
+
+def tableScans(connection, statement):
+  """ Returns the tables a statement scans without an index. """
+  scans = []
+  for row in connection.execute("EXPLAIN QUERY PLAN " + statement):
+    detail = row[3].split(" ")
+    if detail[0] == "SCAN" and detail[1] in TABLES and "INDEX" not in detail:
+      scans.append(detail[1])
+  return scans
+
+
+def __main__():
+  directory = tempfile.mkdtemp()
+  database = Database(os.path.join(directory, "plans.db")) # The schema and indexes come from the migrations
+  alice, bob = populate(database)
+
+  # Route every read through one connection that records the statements run on it, with their parameters filled in
+  statements = []
+  database.readPool = ReadPool(database.file, 1)
+  connection = database.readPool.checkout()
+  connection.set_trace_callback(statements.append)
+  database.readPool.checkin(connection)
+  database.loginCache.clear()
+
+  failures = 0
+  for name, query, allowedScans in hotQueries(database, alice):
+    statements.clear()
+    query()
+    ran = [statement for statement in statements if not statement.startswith("--")] # FTS5 traces its internal statements as comments
+    connection.set_trace_callback(None)
+    scans = [table for statement in ran for table in tableScans(connection, statement) if table not in allowedScans]
+    connection.set_trace_callback(statements.append)
+    if len(ran) == 0:
+      print(f"FAIL {name}: ran no queries")
+      failures += 1
+    elif len(scans) > 0:
+      print(f"FAIL {name}: scans {', '.join(scans)}")
+      failures += 1
+    else:
+      print(f"ok   {name}")
+
+  print(f"{failures} hot queries scan a table" if failures > 0 else "No hot queries scan a table")
+  return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+  status = 1
+  try:
+    status = __main__()
+  finally:
+    os._exit(status) # The database writer thread never returns
@@ -0,0 +1,62 @@
+# Measures producer/consumer throughput of photonUtilities.CircularQueue.
+# Run from the Tests directory: python queueBenchmark.py
+
+import time
+from threading import Thread
+
+import sys
+sys.path.insert(0, '../Libs')
+from photonUtilities import *
+
+ITEMS = 200000
+QUEUESIZE = 999
+
+
+def run(producerCount, batchSize):
+  """
+  Pushes ITEMS items through a queue from producerCount threads to one consumer.
+
+  Args:
+    producerCount (int): The number of producer threads.
+    batchSize (int): How many items the consumer takes per call. 1 uses get(), anything larger uses getBatch().
+
+  Returns:
+    (float): Items per second.
+  """
+  queue = CircularQueue(QUEUESIZE)
+  perProducer = ITEMS // producerCount
+
+  def produce():
+    for i in range(perProducer):
+      queue.put(i)
+
+  def consume():
+    remaining = perProducer * producerCount
+    while remaining > 0:
+      if batchSize == 1:
+        queue.get()
+        remaining -= 1
+      else:
+        remaining -= len(queue.getBatch(batchSize))
+
+  threads = [Thread(target=produce) for i in range(producerCount)]
+  consumer = Thread(target=consume)
+  start = time.perf_counter()
+  consumer.start()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  consumer.join()
+  return perProducer * producerCount / (time.perf_counter() - start)
+
+
+def __main__():
+  print(f"{'producers':>10}{'batch':>8}{'items/s':>14}")
+  for producerCount in (1, 4, 16):
+    for batchSize in (1, 64, 512):
+      print(f"{producerCount:>10}{batchSize:>8}{run(producerCount, batchSize):>14.0f}")
+
+
+if __name__ == "__main__":
+   __main__()
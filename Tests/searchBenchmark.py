@@ -0,0 +1,82 @@
+# Populates a synthetic chat database and times full-text message searches against it.
+# Run from the Tests directory: python searchBenchmark.py [message count]
+
+import itertools
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import sys
+sys.path.insert(0, '../Libs')
+sys.path.insert(0, '../Server')
+from photonUtilities import *
+from database import *
+
+USERCOUNT = 200
+VOCABULARYSIZE = 20000
+REPEATS = 20
+
+
+def populate(file, messageCount):
+  """ Creates a database of random messages, with word frequencies roughly following Zipf's law as in real chat. """
+  random.seed(1)
+  vocabulary = [f"word{i}" for i in range(VOCABULARYSIZE)]
+  cumulativeWeights = list(itertools.accumulate(1 / (i + 1) for i in range(VOCABULARYSIZE)))
+  connection = sqlite3.connect(file)
+  createBaseSchema(connection)
+  connection.executemany("INSERT INTO User(user_id, name, password, admin) VALUES (?, ?, ?, 0)", [(i, f"user{i}", hashString("pw")) for i in range(2, USERCOUNT + 1)])
+
+  def rows():
+    for _ in range(messageCount):
+      sender = random.randint(2, USERCOUNT)
+      recipient = random.randint(2, USERCOUNT) if random.random() < 0.05 else 1 # Some whispers
+      contents = " ".join(random.choices(vocabulary, cum_weights=cumulativeWeights, k=random.randint(3, 20)))
+      yield (sender, contents, "19-03-21 14:02", recipient)
+
+  connection.executemany("INSERT INTO Message(sender_id, contents, timeSent, recipient_id) VALUES (?, ?, ?, ?)", rows())
+  connection.commit()
+  connection.close()
+
+
+def timeSearch(database, terms, page=0, pageSize=10):
+  """ Returns the median time of a search in milliseconds, and how many results it returned. """
+  times = []
+  for _ in range(REPEATS):
+    start = time.perf_counter()
+    results = database.searchMessages(2, terms, pageSize, page * pageSize)
+    times.append((time.perf_counter() - start) * 1000)
+  return statistics.median(times), len(results)
+
+
+def __main__():
+  messageCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  directory = tempfile.mkdtemp()
+  file = os.path.join(directory, "search.db")
+
+  start = time.perf_counter()
+  populate(file, messageCount)
+  print(f"Populated {messageCount} messages in {time.perf_counter() - start:.1f}s")
+
+  start = time.perf_counter()
+  database = Database(file, historyLoadCount=0, messageCacheSize=1)
+  print(f"Ran migrations, building the indexes and search index, in {time.perf_counter() - start:.1f}s")
+
+  print(f"{'search':<30}{'results':>10}{'median ms':>12}")
+  for name, terms, page in [("rare word", ["word15000"], 0),
+                            ("uncommon word", ["word2000"], 0),
+                            ("common word", ["word50"], 0),
+                            ("very common word", ["word1"], 0),
+                            ("two words", ["word10", "word300"], 0),
+                            ("common word, page 10", ["word50"], 9),
+                            ("no matches", ["nothing"], 0)]:
+    milliseconds, results = timeSearch(database, terms, page)
+    print(f"{name:<30}{results:>10}{milliseconds:>12.2f}", flush=True)
+
+  os._exit(0) # The database writer thread never returns
+
+
+if __name__ == "__main__":
+  __main__()
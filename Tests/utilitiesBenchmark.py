@@ -0,0 +1,154 @@
+# Times the hot functions in Libs/photonUtilities, and compares runs to catch regressions.
+# Run from the Tests directory:
+#   python utilitiesBenchmark.py --json baseline.json    Run every benchmark and save the results
+#   python utilitiesBenchmark.py --compare baseline.json Run again and compare against the saved results
+#   python utilitiesBenchmark.py --compare old.json new.json
+# Comparisons exit with status 1 if anything's best and median times both got slower by more than the threshold (15% by default).
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import timeit
+
+import sys
+sys.path.insert(0, '../Libs')
+from packets import *
+from photonUtilities import *
+
+REPEATS = 15 # Enough for the median to settle, see compare()
+
+
+def benchmarks():
+  """
+  Builds every benchmark, with inputs of the sizes the server and client really see.
+
+  Returns:
+    (list of (string, function)): The name of each benchmark and the function to time.
+  """
+  random.seed(1)
+  usernames = [f"user{random.randint(0, 99999)}" for i in range(200)]
+  messageIds = [random.randint(0, 10 ** 6) for i in range(1000)]
+  message = Message(12, "someuser", "Hey, is anyone around to look at the build?", "19-03-21 14:02", 1, BLACK, 48213)
+  history = [Message(i % 40, f"user{i % 40}", f"Message number {i} with a bit of text in it", "19-03-21 14:02", 1, BLACK, i) for i in range(200)]
+  packets = [("message", MessagePacket(message)),
+             ("history (200)", MessageListPacket(history)),
+             ("online users (100)", OnlineUsersPacket(usernames[:100], 7)),
+             ("command", CommandPacket("whisper", ["otheruser", "hello", "there"]))]
+
+  queue = CircularQueue(1024)
+  def queueRoundTrip():
+    for i in range(100):
+      queue.put(i)
+    for i in range(100):
+      queue.get()
+  def queueBatchRoundTrip():
+    for i in range(100):
+      queue.put(i)
+    queue.getBatch(100)
+
+  frames = b"".join(encodeFrame(MessagePacket(message)) for i in range(100))
+  frameReader = FrameReader()
+
+  results = [("hashString (12 chars)", lambda: hashString("password1234")),
+             ("hashString (64 chars)", lambda: hashString("correct horse battery staple " * 2 + "abcdef")),
+             ("integerMergeSort (1000)", lambda: integerMergeSort(list(messageIds))),
+             ("stringListMergeSort (200)", lambda: stringListMergeSort(list(usernames)))]
+  for name, packet in packets:
+    encoded = encode(packet)
+    results.append((f"encode {name}", lambda packet=packet: encode(packet)))
+    results.append((f"decode {name}", lambda encoded=encoded: decode(encoded)))
+  results += [("CircularQueue put/get (100)", queueRoundTrip),
+              ("CircularQueue put/getBatch (100)", queueBatchRoundTrip),
+              ("FrameReader.feed (100 frames)", lambda: frameReader.feed(frames))]
+  return results
+
+
+def run(nameFilter=None):
+  """
+  Times every benchmark whose name contains nameFilter.
+
+  Returns:
+    (dict of string: *): When and where the benchmarks ran, and the best and median time per call of each, in nanoseconds.
+  """
+  timers = []
+  for name, function in benchmarks():
+    if nameFilter != None and nameFilter not in name:
+      continue
+    timer = timeit.Timer(function)
+    loops, total = timer.autorange()
+    timers.append((name, timer, loops, []))
+  for i in range(REPEATS): # Each benchmark's repeats are spread over the whole run, so a busy spell on the machine cannot slow all of them
+    for name, timer, loops, times in timers:
+      times.append(timer.timeit(loops) / loops * 1e9)
+
+  results = {}
+  for name, timer, loops, times in timers:
+    results[name] = {"best": min(times), "median": statistics.median(times), "loops": loops}
+    print(f"{name:<36}{min(times):>14.0f}{statistics.median(times):>14.0f}")
+  return {"time": datetime.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(), "platform": platform.platform(), "results": results}
+
+
+def compare(old, new, threshold):
+  """
+  Compares two runs, flagging every benchmark whose best and median times both got slower by more than threshold.
+  A single noisy repeat can move either one on its own, but a real slowdown moves both.
+
+  Returns:
+    (int): The number of regressions.
+  """
+  print(f"Comparing {old['time']} (Python {old['python']}) with {new['time']} (Python {new['python']})")
+  print(f"{'benchmark':<36}{'old ns':>14}{'new ns':>14}{'change':>10}{'median':>10}")
+  regressions = 0
+  for name, result in new["results"].items():
+    if name not in old["results"]:
+      print(f"{name:<36}{'':>14}{result['best']:>14.0f}{'new':>10}")
+      continue
+    before = old["results"][name]
+    change = result["best"] / before["best"] - 1
+    medianChange = result["median"] / before["median"] - 1
+    flag = ""
+    if min(change, medianChange) > threshold:
+      flag = "  REGRESSION"
+      regressions += 1
+    elif max(change, medianChange) < -threshold:
+      flag = "  faster"
+    print(f"{name:<36}{before['best']:>14.0f}{result['best']:>14.0f}{change:>+10.1%}{medianChange:>+10.1%}{flag}")
+  print(f"{regressions} regressions of more than {threshold:.0%}" if regressions > 0 else f"No regressions of more than {threshold:.0%}")
+  return regressions
+
+
+def load(file):
+  with open(file) as jsonFile:
+    return json.load(jsonFile)
+
+
+def __main__():
+  parser = argparse.ArgumentParser(description="Benchmarks the hot functions in Libs/photonUtilities.")
+  parser.add_argument("--json", metavar="FILE", help="save the results to this file")
+  parser.add_argument("--compare", nargs="+", metavar="FILE", help="compare against one saved run, or compare two saved runs without running anything")
+  parser.add_argument("--threshold", type=float, default=0.15, help="how much slower the best and median times must both be to count as a regression, as a fraction (default 0.15)")
+  parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+  args = parser.parse_args()
+
+  if args.compare != None and len(args.compare) > 2:
+    parser.error("--compare takes one or two files")
+  if args.compare != None and len(args.compare) == 2:
+    old, new = load(args.compare[0]), load(args.compare[1])
+  else:
+    old = load(args.compare[0]) if args.compare != None else None
+    print(f"{'benchmark':<36}{'best ns':>14}{'median ns':>14}")
+    new = run(args.filter)
+    if args.json != None:
+      with open(args.json, "w") as jsonFile:
+        json.dump(new, jsonFile, indent=2)
+
+  if old != None:
+    print()
+    sys.exit(1 if compare(old, new, args.threshold) > 0 else 0)
+
+
+if __name__ == "__main__":
+  __main__()